@@ -8,18 +8,45 @@ __version__ = "1.0"
 
 #__docformat__ = "javadoc"
 
-import parallel
 import time
-import parallel.parallelutil
+
+try:
+	import parallel
+	import parallel.parallelutil
+except ImportError:
+	# only needed by the parallel port controllers
+	parallel = None
 
 class BitBangController:
-	'''Implements an abstract basic bit-bang controller for programming PIC microcontrollers.'''
+	'''Implements an abstract basic bit-bang controller for programming PIC microcontrollers.
+
+	The values set for the lines are applied with commit(). In buffered mode each
+	committed state is queued as one byte (see get_state) and the whole waveform is
+	sent to the port with a single write_burst() call on flush().
+	A commit that would not change the lines is skipped; writes_issued and
+	writes_skipped count both cases.
+	'''
+
+	# bits of a packed pin state
+	PGD = 0x01
+	PGC = 0x02
+	MCLR = 0x04
+	VDD = 0x08
 
 	# public members
 	mclr = False
 	vdd = False
 	pgd = False
 	pgc = False
+	buffered = False
+
+	# ultimo estado aplicado, None si es desconocido
+	last_state = None
+	writes_issued = 0
+	writes_skipped = 0
+
+	def __init__(self):
+		self.buffer = bytearray()
 
 	def begin(self):
 		'''Initializes any subsystem needed. It must be implemented.'''
@@ -46,23 +73,112 @@ class BitBangController:
 		self.pgc=i
 
 	def read_pgd(self):
-		'''Reads the value of the PGD line. It must be implemented.'''
+		'''Reads the value of the PGD line. It must be implemented.
+		Implementations must flush() any buffered state before sampling the line.'''
 		raise NotImplementedError("BitBangController::read_pgd - Not implemented")
 
+	def get_state(self):
+		'''Returns the values set for MCLR, VDD, PGC & PGD packed in a byte.'''
+		estado = 0
+		if self.pgd:
+			estado |= self.PGD
+		if self.pgc:
+			estado |= self.PGC
+		if self.mclr:
+			estado |= self.MCLR
+		if self.vdd:
+			estado |= self.VDD
+		return estado
+
+	def set_state(self, estado):
+		'''Sets the values of MCLR, VDD, PGC & PGD from a packed state.'''
+		self.pgd = (estado & self.PGD) != 0
+		self.pgc = (estado & self.PGC) != 0
+		self.mclr = (estado & self.MCLR) != 0
+		self.vdd = (estado & self.VDD) != 0
+
+	def set_buffered(self, i):
+		'''Enables or disables the buffered mode. Disabling it flushes the pending states.'''
+		if not i:
+			self.flush()
+		self.buffered = i
+
 	def commit(self):
-		'''Applies the values set for MCLR, VDD, PGC & PGD to the port. It must be implemented.'''
-		raise NotImplementedError("BitBangController::commit - Not implemented")
+		'''Applies the values set for MCLR, VDD, PGC & PGD to the port.
+		In buffered mode the state is queued until the next flush().
+		Nothing is written if the state has not changed since the last commit.'''
+		estado = self.get_state()
+		if estado == self.last_state:
+			self.writes_skipped += 1
+			return
+		self.last_state = estado
+		self.writes_issued += 1
+		if self.buffered:
+			self.buffer.append(estado)
+		else:
+			self.write_state(estado)
+
+	def replay(self, estados):
+		'''Applies a precompiled waveform, as if every packed state in it had been set
+		and committed. Consecutive states in the waveform must be different.'''
+		if not estados:
+			return
+		if estados[0] == self.last_state:
+			self.writes_skipped += 1
+			estados = estados[1:]
+			if not estados:
+				return
+		self.set_state(estados[-1])
+		self.last_state = estados[-1]
+		self.writes_issued += len(estados)
+		if self.buffered:
+			self.buffer.extend(estados)
+		else:
+			self.write_burst(estados)
+
+	def invalidate(self):
+		'''Forgets the last state applied, so the next commit is always written.'''
+		self.last_state = None
+
+	def flush(self):
+		'''Sends the queued states to the port in one burst.'''
+		if self.buffer:
+			estados = self.buffer
+			self.buffer = bytearray()
+			self.write_burst(estados)
+
+	def write_state(self, estado):
+		'''Writes a packed pin state to the port. It must be implemented.'''
+		raise NotImplementedError("BitBangController::write_state - Not implemented")
+
+	def write_burst(self, estados):
+		'''Writes a sequence of packed pin states to the port.
+		Backends able to send a byte burst in one call should override it.'''
+		for estado in estados:
+			self.write_state(estado)
 
 
 
 class BitBangParallel(BitBangController):
 	'''Implements an abstract bit-bang controller for programming PIC microcontrollers using the parallel port.'''
+	def __init__(self, puerto=0):
+		'''Parameters:
+		puerto -- the parallel port, as a number or a device name (see pyparallel)
+		'''
+		BitBangController.__init__(self)
+		self.puerto = puerto
+
 	def begin(self):
 		'''Creates a new parallel interface.'''
-		self.p=parallel.Parallel()
+		if parallel is None:
+			raise ImportError("BitBangParallel::begin - pyparallel is not installed")
+		self.p=parallel.Parallel(self.puerto)
+		self.invalidate()
 
 	def end(self):
 		'''Deletes its parallel interface.'''
+		self.flush()
+		self.invalidate()
 		self.p=None
 
 
@@ -75,18 +191,16 @@ class BitBangCheapParport(BitBangParallel):
 	ACK -- PGD as input	
 	'''
 
-	def commit(self):
-		'''Applies the values set for MCLR, VDD, PGC & PGD to the port.'''
-		mclr = self.mclr << 2
-		pgc = self.pgc << 1
-		pgd = self.pgd
-		registro = mclr | pgc | pgd
+	def write_state(self, estado):
+		'''Writes a packed pin state to the data register. VDD is not wired.'''
+		registro = estado & (self.MCLR | self.PGC | self.PGD)
 
 		self.p.setData(registro)
 
 	def read_pgd(self):
-		'''Sets PGD as 1 and reads the ACK line.'''
+		'''Sets PGD as 1 and reads the ACK line.
+		PGD is left released (1), so sampling several bits writes the port only once.'''
 		self.set_pgd(1)
 		self.commit()
-		self.pgd=self.p.getInAcknowledge()
-		return self.pgd
+		self.flush()
+		return self.p.getInAcknowledge()
@@ -0,0 +1,529 @@
+'''Software emulator of a 16-bit PIC microcontroller seen through its ICSP pins
+
+@author     Javier Casas (javcasas AT gmail DOT com)
+@version    1.0
+'''
+__author__ = "Javier Casas (javcasas AT gmail DOT com)"
+__version__ = "1.0"
+
+import time
+
+import BitBang
+import ChipIdentifier
+import CommandProgrammer
+
+
+# registros del micro (direcciones de memoria de datos)
+TBLPAG = 0x0032
+NVMCON = 0x0760
+NVMKEY = 0x0766
+VISI = 0x0784
+
+# bits de NVMCON
+WR = 0x8000
+WREN = 0x4000
+
+# operaciones de NVMCON (NVMOP, con WREN)
+NVM_WRITE_CONFIG = 0x4000
+NVM_WRITE_ROW = 0x4001
+NVM_ERASE_PAGE = 0x4042
+NVM_ERASE_BULK = 0x404F
+
+# direcciones de la memoria de programa
+EXECUTIVE = 0x800000
+CONFIG = 0xF80000
+DEVID = 0xFF0000
+DEVREV = 0xFF0002
+
+EXECUTIVE_VERSION = 0x26
+
+ROW_SIZE = 64		# instrucciones por fila
+PAGE_SIZE = 512		# instrucciones por pagina
+ERASED = 0xFFFFFF
+
+
+class BitBangEmulator(BitBang.BitBangController):
+	'''Emulates a PIC24H/dsPIC33F target attached to a bit-bang controller.
+
+	It decodes the waveform committed on the pins: the ICSP key entry, the SIX
+	and REGOUT serial commands, and executes the subset of the instruction set
+	used by CommandProgrammer.Programmer (MOV, CLR, BSET, GOTO, NOP, TBLRD and
+	TBLWT) against a sparse model of the program memory and the NVM controller.
+	If it has a Programming Executive, it also answers the Enhanced ICSP
+	commands of CommandProgrammer.EnhancedCommandProgrammer.
+	The emulated executive is written from those same commands: it accepts
+	exactly the argument layouts the host sends, so it checks the rest of the
+	programmer against the host encoding, not the encoding against the chip.
+	Like the executive of the real PIC24H/dsPIC33F, it answers NACK to ERASEP
+	and CRCP unless it is made with extended=True.
+	No hardware is needed, so the counters it keeps give deterministic
+	throughput numbers for every layer above BitBang.
+	'''
+
+	def __init__(self, devid=0x080A, rev=0x3003, executive=False, extended=False):
+		'''Makes a new blank chip.
+		Parameters:
+		devid -- device identifier, it must be in ChipIdentifier.ids
+		rev -- chip revision
+		executive -- if True, the chip has a Programming Executive
+		extended -- if True, the Programming Executive also has ERASEP and CRCP
+		'''
+		BitBang.BitBangController.__init__(self)
+		if devid not in ChipIdentifier.ids:
+			raise ValueError("BitBangEmulator::__init__ - Unknown device id " + hex(devid))
+		self.devid = devid
+		self.rev = rev
+		self.executive = executive
+		self.extended = extended
+
+		# memoria de programa: direccion par -> instruccion de 24 bits
+		self.flash = {}
+		# latches de escritura, mismo formato que flash
+		self.latches = {}
+		# memoria de datos: direccion par -> palabra de 16 bits (W0..W15 en 0x00..0x1E)
+		self.ram = {}
+
+		# segundos que tarda cada operacion NVMOP (por defecto, instantaneas)
+		self.latencies = {}
+		self.nvm_end = 0.0
+
+		self.pins = 0
+		self.output = 1
+		self.mode = "off"
+		self.phase = None
+		self.reset_stats()
+
+	def begin(self):
+		'''Nothing to initialize.'''
+		pass
+
+	def end(self):
+		'''Sends any buffered waveform.'''
+		self.flush()
+
+	def read_pgd(self):
+		'''Releases PGD and reads the value driven by the emulated chip.'''
+		self.set_pgd(1)
+		self.commit()
+		self.flush()
+		self.reads += 1
+		return self.output
+
+	def reset_stats(self):
+		'''Clears the counters.'''
+		self.writes = 0
+		self.bursts = 0
+		self.edges = 0
+		self.instructions = 0
+		self.regouts = 0
+		self.reads = 0
+		self.commands = 0
+
+	def stats(self):
+		'''Returns the counters as a dictionary:
+		writes -- pin states written
+		bursts -- calls to write_burst
+		edges -- PGC rising edges
+		instructions -- SIX instructions executed
+		regouts -- REGOUT commands
+		reads -- PGD samples
+		commands -- Programming Executive commands
+		'''
+		return {"writes": self.writes, "bursts": self.bursts, "edges": self.edges,
+			"instructions": self.instructions, "regouts": self.regouts, "reads": self.reads,
+			"commands": self.commands}
+
+	def read_word(self, addr):
+		'''Returns the 24-bit program memory word at addr.'''
+		addr &= 0xFFFFFE
+		if addr == DEVID:
+			return self.devid
+		if addr == DEVREV:
+			return self.rev
+		return self.flash.get(addr, ERASED)
+
+	def write_word(self, addr, val):
+		'''Sets the 24-bit program memory word at addr, bypassing the NVM controller.'''
+		addr &= 0xFFFFFE
+		val &= 0xFFFFFF
+		if val == ERASED:
+			self.flash.pop(addr, None)
+		else:
+			self.flash[addr] = val
+
+	# Pines
+
+	def write_burst(self, estados):
+		'''Applies a sequence of packed pin states.'''
+		self.bursts += 1
+		for estado in estados:
+			self.write_state(estado)
+
+	def write_state(self, estado):
+		'''Applies a packed pin state to the emulated chip.'''
+		self.writes += 1
+		anterior = self.pins
+		self.pins = estado
+		if not estado & self.VDD:
+			if anterior & self.VDD:
+				self.mode = "off"
+				self.phase = None
+				self.output = 1
+			return
+
+		cambio = anterior ^ estado
+		if cambio & self.MCLR:
+			if estado & self.MCLR:
+				self._mclr_high()
+			else:
+				self._mclr_low()
+
+		if (cambio & self.PGC) and (estado & self.PGC):
+			self.edges += 1
+			bit = 0
+			if estado & self.PGD:
+				bit = 1
+			if self.mode == "key":
+				self._key_edge(bit)
+			elif self.mode == "icsp":
+				self._icsp_edge(bit)
+			elif self.mode == "pe":
+				self._pe_edge(bit)
+
+	def _mclr_low(self):
+		# con MCLR a 0 se puede introducir la clave
+		self.mode = "key"
+		self.key = 0
+		self.key_bits = 0
+		self.output = 1
+
+	def _mclr_high(self):
+		if self.mode == "key" and self.key_bits == 32 and self.key == CommandProgrammer.CommandProgrammer.ICSPmagicCode:
+			self.mode = "icsp"
+			self.phase = "control"
+			self.bits = 0
+			self.value = 0
+			self.first = True
+		elif self.mode == "key" and self.key_bits == 32 and self.key == CommandProgrammer.CommandProgrammer.EICSPmagicCode and self.executive:
+			self.mode = "pe"
+			self.phase = "command"
+			self.bits = 0
+			self.value = 0
+			self.words = []
+		else:
+			self.mode = "run"
+
+	def _key_edge(self, bit):
+		# la clave se recibe empezando por el bit mas significativo
+		self.key = ((self.key << 1) | bit) & 0xFFFFFFFF
+		self.key_bits += 1
+
+	def _icsp_edge(self, bit):
+		# los comandos y las instrucciones se reciben empezando por el bit menos significativo
+		if self.phase == "control":
+			self.output = 1
+			self.value |= bit << self.bits
+			self.bits += 1
+			if self.bits == 4:
+				control = self.value
+				self.bits = 0
+				self.value = 0
+				if control == 0:
+					if self.first:
+						self.phase = "extra"
+						self.first = False
+					else:
+						self.phase = "six"
+				elif control == 1:
+					self.phase = "idle"
+				else:
+					raise NotImplementedError("BitBangEmulator::_icsp_edge - Unsupported control code " + hex(control))
+
+		elif self.phase == "extra":
+			#5 relojes extra en el primer SIX
+			self.bits += 1
+			if self.bits == 5:
+				self.bits = 0
+				self.phase = "six"
+
+		elif self.phase == "six":
+			self.value |= bit << self.bits
+			self.bits += 1
+			if self.bits == 24:
+				instruccion = self.value
+				self.bits = 0
+				self.value = 0
+				self.phase = "control"
+				self.execute(instruccion)
+
+		elif self.phase == "idle":
+			#8 relojes antes de sacar VISI
+			self.bits += 1
+			if self.bits == 8:
+				self.bits = 0
+				self.phase = "regout"
+				self.regouts += 1
+				self.visi = self.read_data(VISI)
+
+		elif self.phase == "regout":
+			self.output = (self.visi >> self.bits) & 1
+			self.bits += 1
+			if self.bits == 16:
+				self.bits = 0
+				self.phase = "control"
+
+	# Programming executive
+
+	def _pe_edge(self, bit):
+		# las palabras se reciben y se envian empezando por el bit mas significativo
+		if self.phase == "command":
+			self.output = 1
+			self.value = (self.value << 1) | bit
+			self.bits += 1
+			if self.bits == 16:
+				self.words.append(self.value)
+				self.bits = 0
+				self.value = 0
+				if len(self.words) >= max(self.words[0] & 0xFFF, 1):
+					respuesta = self.pe_command(self.words)
+					self.words = []
+					self.response = []
+					for palabra in respuesta:
+						for i in range(15, -1, -1):
+							self.response.append((palabra >> i) & 1)
+					self.response.reverse()
+					self.phase = "response"
+					self.output = 0		# respuesta preparada
+
+		elif self.phase == "response":
+			self.output = self.response.pop()
+			if not self.response:
+				self.phase = "command"
+
+	def pe_command(self, words):
+		'''Executes a Programming Executive command. Returns the response words.
+		The commands and their layouts are the ones of CommandProgrammer.EnhancedCommandProgrammer (see the class docstring).
+		'''
+		pe = CommandProgrammer.EnhancedCommandProgrammer
+		self.commands += 1
+		opcode = words[0] >> 12
+		args = words[1:]
+		datos = []
+		codigo = 0
+		resultado = pe.PASS
+
+		if opcode == pe.SCHECK:
+			pass
+		elif opcode == pe.READC and len(args) == 2:
+			direccion = ((args[0] & 0xFF) << 16) | args[1]
+			for i in range(args[0] >> 8):
+				datos.append(self.read_word(direccion + 2 * i) & 0xFFFF)
+		elif opcode == pe.READP and len(args) == 3 and (args[0] % 4) == 0:
+			direccion = ((args[1] & 0xFF) << 16) | args[2]
+			palabras = [self.read_word(direccion + 2 * i) for i in range(args[0])]
+			datos.extend(CommandProgrammer.packInstructionArray(palabras))
+		elif opcode == pe.PROGC and len(args) == 3:
+			self.write_word(((args[0] & 0xFF) << 16) | args[1], args[2])
+		elif opcode == pe.PROGP and len(args) == 2 + ROW_SIZE * 3 / 2:
+			direccion = ((args[0] & 0xFF) << 16) | args[1]
+			palabras = CommandProgrammer.unpackInstructionArray(args[2:])
+			for i in range(0, ROW_SIZE):
+				palabra = palabras[i]
+				actual = direccion + 2 * i
+				self.write_word(actual, self.read_word(actual) & palabra)
+				if self.read_word(actual) != palabra:
+					resultado = pe.FAIL
+		elif opcode == pe.ERASEP and self.extended and len(args) == 2:
+			direccion = ((args[0] & 0xFF) << 16) | args[1]
+			inicio = direccion & ~(PAGE_SIZE * 2 - 1)
+			for i in range(inicio, inicio + (args[0] >> 8) * PAGE_SIZE * 2, 2):
+				self.flash.pop(i, None)
+		elif (opcode == pe.QBLANK or (opcode == pe.CRCP and self.extended)) and len(args) == 4:
+			direccion = ((args[0] & 0xFF) << 16) | args[1]
+			n = (args[2] << 16) | args[3]
+			palabras = [self.read_word(direccion + 2 * i) for i in range(n)]
+			if opcode == pe.CRCP:
+				datos.append(CommandProgrammer.crc16(palabras))
+			elif palabras.count(ERASED) == n:
+				codigo = 0xF0
+			else:
+				codigo = 0x0F
+		elif opcode == pe.QVER:
+			codigo = EXECUTIVE_VERSION
+		else:
+			resultado = pe.NACK
+
+		return [(resultado << 12) | (opcode << 8) | codigo, 2 + len(datos)] + datos
+
+	# Memoria de datos
+
+	def read_data(self, addr, byte=False):
+		'''Reads a word (or a byte) of the data memory.'''
+		palabra = self.ram.get(addr & 0xFFFE, 0)
+		if (addr & 0xFFFE) == NVMCON:
+			palabra &= ~WR
+			if self.nvm_end > time.time():
+				palabra |= WR
+		if byte:
+			if addr & 1:
+				return (palabra >> 8) & 0xFF
+			return palabra & 0xFF
+		return palabra
+
+	def write_data(self, addr, val, byte=False):
+		'''Writes a word (or a byte) of the data memory.'''
+		direccion = addr & 0xFFFE
+		if byte:
+			palabra = self.ram.get(direccion, 0)
+			if addr & 1:
+				val = (palabra & 0x00FF) | ((val & 0xFF) << 8)
+			else:
+				val = (palabra & 0xFF00) | (val & 0xFF)
+		val &= 0xFFFF
+		self.ram[direccion] = val
+		if direccion == NVMCON and (val & WR):
+			self._nvm_operation(val)
+
+	def _w(self, n):
+		return self.ram.get(n << 1, 0)
+
+	def _set_w(self, n, val):
+		self.ram[n << 1] = val & 0xFFFF
+
+	# Controlador NVM
+
+	def _nvm_operation(self, nvmcon):
+		op = nvmcon & ~WR
+		if op == NVM_WRITE_ROW:
+			for addr, val in self.latches.items():
+				self.write_word(addr, self.read_word(addr) & val)
+		elif op == NVM_WRITE_CONFIG:
+			# los registros de configuracion se escriben directamente, solo la parte baja
+			for addr, val in self.latches.items():
+				self.write_word(addr, val & 0xFFFF)
+		elif op == NVM_ERASE_PAGE:
+			for addr in self.latches.keys():
+				inicio = addr & ~(PAGE_SIZE * 2 - 1)
+				for i in range(inicio, inicio + PAGE_SIZE * 2, 2):
+					self.flash.pop(i, None)
+		elif op == NVM_ERASE_BULK:
+			for addr in self.flash.keys():
+				if addr < EXECUTIVE or addr >= CONFIG:
+					del self.flash[addr]
+		else:
+			raise NotImplementedError("BitBangEmulator::_nvm_operation - Unsupported NVMCON value " + hex(nvmcon))
+		self.latches = {}
+		self.nvm_end = time.time() + self.latencies.get(op, 0.0)
+
+	# Nucleo
+
+	def _ea(self, modo, reg, paso, post):
+		'''Effective address of an addressing mode. Applies the pre-modifications
+		and appends the post-modifications to post.'''
+		if modo == 0:		# Wn
+			return reg << 1
+		direccion = self._w(reg)
+		if modo == 1:		# [Wn]
+			return direccion
+		if modo == 2:		# [Wn--]
+			post.append((reg, -paso))
+			return direccion
+		if modo == 3:		# [Wn++]
+			post.append((reg, paso))
+			return direccion
+		if modo == 4:		# [--Wn]
+			direccion = (direccion - paso) & 0xFFFF
+		elif modo == 5:		# [++Wn]
+			direccion = (direccion + paso) & 0xFFFF
+		else:
+			raise NotImplementedError("BitBangEmulator::_ea - Unsupported addressing mode " + str(modo))
+		self._set_w(reg, direccion)
+		return direccion
+
+	def execute(self, instruccion):
+		'''Executes a 24-bit instruction received by SIX.'''
+		self.instructions += 1
+		i = instruccion & 0xFFFFFF
+
+		if i == 0x000000:
+			#NOP
+			return
+		if (i & 0xFF0000) == 0x040000:
+			#GOTO: no se emula el contador de programa
+			return
+		if (i & 0xF00000) == 0x200000:
+			#MOV #lit16, Wnd
+			self._set_w(i & 0xF, (i >> 4) & 0xFFFF)
+			return
+		if (i & 0xF80000) == 0x880000:
+			#MOV Wns, f
+			self.write_data(((i >> 4) & 0x7FFF) << 1, self._w(i & 0xF))
+			return
+		if (i & 0xF80000) == 0x800000:
+			#MOV f, Wnd
+			self._set_w(i & 0xF, self.read_data(((i >> 4) & 0x7FFF) << 1))
+			return
+		if (i & 0xFF0000) == 0xA80000:
+			#BSET f, #bit4
+			direccion = i & 0x1FFE
+			bit = (((i >> 13) & 0x7) << 1) | (i & 1)
+			self.write_data(direccion, self.read_data(direccion) | (1 << bit))
+			return
+		if (i & 0xFFF87F) == 0xEB0000:
+			#CLR Wd
+			self._set_w((i >> 7) & 0xF, 0)
+			return
+		if (i & 0xFE0000) == 0xBA0000:
+			self._table(i)
+			return
+
+		raise NotImplementedError("BitBangEmulator::execute - Unsupported instruction " + hex(i))
+
+	def _table(self, i):
+		#TBLRDL, TBLRDH, TBLWTL, TBLWTH
+		escritura = (i & 0x010000) != 0
+		alta = (i & 0x8000) != 0
+		byte = (i & 0x4000) != 0
+		paso = 1
+		if not byte:
+			paso = 2
+		post = []
+		origen = self._ea((i >> 4) & 0x7, i & 0xF, paso, post)
+		destino = self._ea((i >> 11) & 0x7, (i >> 7) & 0xF, paso, post)
+
+		if escritura:
+			direccion = (self.ram.get(TBLPAG, 0) << 16) | destino
+			self._table_write(direccion, self.read_data(origen, byte), alta, byte)
+		else:
+			direccion = (self.ram.get(TBLPAG, 0) << 16) | origen
+			self.write_data(destino, self._table_read(direccion, alta, byte), byte)
+
+		for reg, incremento in post:
+			self._set_w(reg, self._w(reg) + incremento)
+
+	def _table_read(self, direccion, alta, byte):
+		palabra = self.read_word(direccion)
+		if alta:
+			if byte and (direccion & 1):
+				return 0	# phantom byte
+			return (palabra >> 16) & 0xFF
+		if byte and (direccion & 1):
+			return (palabra >> 8) & 0xFF
+		if byte:
+			return palabra & 0xFF
+		return palabra & 0xFFFF
+
+	def _table_write(self, direccion, val, alta, byte):
+		par = direccion & 0xFFFFFE
+		palabra = self.latches.get(par, ERASED)
+		if alta:
+			if byte and (direccion & 1):
+				return		# phantom byte
+			palabra = (palabra & 0x00FFFF) | ((val & 0xFF) << 16)
+		elif byte and (direccion & 1):
+			palabra = (palabra & 0xFF00FF) | ((val & 0xFF) << 8)
+		elif byte:
+			palabra = (palabra & 0xFFFF00) | (val & 0xFF)
+		else:
+			palabra = (palabra & 0xFF0000) | (val & 0xFFFF)
+		self.latches[par] = palabra
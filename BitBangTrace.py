@@ -0,0 +1,327 @@
+'''Pin-level traces of bit-bang controllers
+
+Records every pin state sent to the port and every PGD sample of a bit-bang controller,
+with their times, in a binary trace file. The trace can be fed back into a controller or
+the emulator, and summarized by operation.
+
+@author     Javier Casas (javcasas AT gmail DOT com)
+@version    1.0
+'''
+__author__ = "Javier Casas (javcasas AT gmail DOT com)"
+__version__ = "1.0"
+
+import sys
+import time
+import struct
+
+import BitBang
+
+
+# Formato
+#
+# Cabecera: "P24T", version. Despues, registros de tipo (1 byte) y tiempo en nanosegundos
+# desde el inicio de la traza (8 bytes), seguidos de:
+#   STATE -- el estado escrito (1 byte)
+#   BURST -- la duracion de la escritura en nanosegundos (8 bytes), el numero de estados (4 bytes) y los estados
+#   READ -- el valor leido de PGD (1 byte)
+#   MARK -- la longitud del texto (2 bytes) y el texto
+#   BEGIN, END -- nada
+MAGIC = "P24T"
+FORMAT = 1
+HEADER = struct.Struct("<4sI")
+RECORD = struct.Struct("<BQ")
+
+STATE = 1
+BURST = 2
+READ = 3
+MARK = 4
+BEGIN = 5
+END = 6
+
+_BYTE = struct.Struct("<B")
+_BURST = struct.Struct("<QI")
+_TEXT = struct.Struct("<H")
+
+
+class BitBangRecorder:
+	'''Wraps a bit-bang controller, recording what is sent to its port in a trace file.
+	It is used as the controller itself: every method and member not defined here is the one of the wrapped controller.
+	'''
+
+	def __init__(self, bb, fichero):
+		'''Parameters:
+		bb -- the BitBang.BitBangController recorded
+		fichero -- the name of the trace file, or a file object open for writing in binary mode
+		'''
+		self.bb = bb
+		if isinstance(fichero, basestring):
+			fichero = open(fichero, "wb")
+		self.trace = fichero
+		self.trace.write(HEADER.pack(MAGIC, FORMAT))
+		self.start = time.time()
+		# True mientras se escribe una rafaga, que se registra entera
+		self.inBurst = False
+		#las escrituras del controlador pasan por aqui, aunque las haga el mismo (p.e. en read_pgd)
+		self.write_state_port = bb.write_state
+		self.write_burst_port = bb.write_burst
+		bb.write_state = self.write_state
+		bb.write_burst = self.write_burst
+
+	def __getattr__(self, nombre):
+		return getattr(self.bb, nombre)
+
+	def _now(self):
+		return int((time.time() - self.start) * 1e9)
+
+	def _record(self, tipo, datos="", t=None):
+		if t is None:
+			t = self._now()
+		self.trace.write(RECORD.pack(tipo, t) + datos)
+
+	def write_state(self, estado):
+		if not self.inBurst:
+			self._record(STATE, _BYTE.pack(estado))
+		self.write_state_port(estado)
+
+	def write_burst(self, estados):
+		t = self._now()
+		#muchos controladores escriben las rafagas estado a estado
+		self.inBurst = True
+		try:
+			self.write_burst_port(estados)
+		finally:
+			self.inBurst = False
+		self._record(BURST, _BURST.pack(self._now() - t, len(estados)) + str(estados), t)
+
+	def read_pgd(self):
+		valor = self.bb.read_pgd()
+		self._record(READ, _BYTE.pack(1 if valor else 0))
+		return valor
+
+	def begin(self):
+		self._record(BEGIN)
+		self.bb.begin()
+
+	def end(self):
+		self.bb.end()
+		self._record(END)
+
+	def mark(self, texto):
+		'''Records a text in the trace, for example the name of the operation that starts.
+		The states queued in buffered mode are sent first, so they are recorded before the mark,
+		in the operation that committed them.
+		'''
+		self.bb.flush()
+		texto = str(texto)
+		self._record(MARK, _TEXT.pack(len(texto)) + texto)
+
+	def close(self):
+		'''Stops recording and closes the trace file. The controller is left as it was.'''
+		self.bb.flush()
+		del self.bb.write_state
+		del self.bb.write_burst
+		self.trace.close()
+
+
+def readTrace(fichero):
+	'''Yields the records of a trace file as tuples (type, time in seconds, data), data being
+	the state written for STATE, a pair (duration in seconds, states) for BURST, the value
+	read for READ, the text for MARK and None for BEGIN and END.
+	Parameters:
+	fichero -- the name of the trace file, or a file object open for reading in binary mode
+	'''
+	if isinstance(fichero, basestring):
+		fichero = open(fichero, "rb")
+	cabecera = fichero.read(HEADER.size)
+	if len(cabecera) < HEADER.size or HEADER.unpack(cabecera) != (MAGIC, FORMAT):
+		raise ValueError("BitBangTrace::readTrace - Not a trace file")
+	while True:
+		registro = fichero.read(RECORD.size)
+		if len(registro) < RECORD.size:
+			return
+		(tipo, t) = RECORD.unpack(registro)
+		t /= 1e9
+		if tipo in (STATE, READ):
+			yield (tipo, t, _BYTE.unpack(fichero.read(_BYTE.size))[0])
+		elif tipo == BURST:
+			(duracion, n) = _BURST.unpack(fichero.read(_BURST.size))
+			yield (tipo, t, (duracion / 1e9, bytearray(fichero.read(n))))
+		elif tipo == MARK:
+			(n,) = _TEXT.unpack(fichero.read(_TEXT.size))
+			yield (tipo, t, fichero.read(n))
+		elif tipo in (BEGIN, END):
+			yield (tipo, t, None)
+		else:
+			raise ValueError("BitBangTrace::readTrace - Unknown record type " + str(tipo))
+
+
+def replayTrace(fichero, bb, realTime=False):
+	'''Feeds a trace back into a bit-bang controller: the states are sent in the same bursts,
+	and PGD is sampled where it was sampled in the trace.
+	Parameters:
+	fichero -- the name of the trace file, or a file object
+	bb -- the BitBang.BitBangController, for example a BitBangEmulator.BitBangEmulator
+	realTime -- if True, every record is replayed at the time it was recorded, instead of as fast as possible
+	Returns the list of PGD samples that differ from the trace, as tuples (time, recorded, read)
+	'''
+	diferencias = []
+	inicio = time.time()
+	for (tipo, t, datos) in readTrace(fichero):
+		if realTime:
+			espera = inicio + t - time.time()
+			if espera > 0:
+				time.sleep(espera)
+		if tipo == STATE:
+			bb.replay(bytearray([datos]))
+			bb.flush()
+		elif tipo == BURST:
+			bb.replay(datos[1])
+			bb.flush()
+		elif tipo == READ:
+			valor = 1 if bb.read_pgd() else 0
+			if valor != datos:
+				diferencias.append((t, datos, valor))
+		elif tipo == BEGIN:
+			bb.begin()
+		elif tipo == END:
+			bb.end()
+	return diferencias
+
+
+def markOperations(programador, grabador, operaciones=("enter", "leave", "readMem", "readDevId", "writeMemSteps",
+		"writeConfigMemSteps", "eraseChipSteps", "erasePagesSteps", "writeDone")):
+	'''Makes a CommandProgrammer.Programmer write a MARK in the trace when each of its operations
+	starts ("+name") and ends ("-name"), so traceStats can summarize them.
+	The *Steps methods are marked with the name of the operation, and they end when their last step is run.
+	Parameters:
+	programador -- the Programmer
+	grabador -- the BitBangRecorder of its controller
+	operaciones -- the names of the methods marked
+	'''
+	def pasos(nombre, generador):
+		grabador.mark("+" + nombre)
+		try:
+			for espera in generador:
+				yield espera
+		finally:
+			grabador.mark("-" + nombre)
+
+	def marcar(nombre, metodo):
+		def operacion(*args, **kwargs):
+			grabador.mark("+" + nombre)
+			try:
+				res = metodo(*args, **kwargs)
+			finally:
+				grabador.mark("-" + nombre)
+			return res
+		return operacion
+
+	def marcarPasos(nombre, metodo):
+		def operacion(*args, **kwargs):
+			return pasos(nombre, metodo(*args, **kwargs))
+		return operacion
+
+	for nombre in operaciones:
+		metodo = getattr(programador, nombre, None)
+		if metodo is None:
+			continue
+		if nombre.endswith("Steps"):
+			setattr(programador, nombre, marcarPasos(nombre[:-len("Steps")], metodo))
+		else:
+			setattr(programador, nombre, marcar(nombre, metodo))
+
+
+def traceStats(fichero, hueco=0.001):
+	'''Summarizes a trace by operation (see markOperations).
+	Parameters:
+	fichero -- the name of the trace file, or a file object
+	hueco -- pauses between port accesses longer than this many seconds are counted as idle time
+	Returns a dictionary with an entry for each operation, and "total" for the whole trace. Each entry is a dictionary:
+	count -- times the operation was run
+	time -- seconds spent in it
+	states -- pin states written
+	edges -- PGC rising edges
+	reads -- PGD samples
+	idle -- seconds spent in pauses longer than hueco
+	gap -- longest pause, in seconds
+	edgesPerSecond -- edges divided by time
+	'''
+	def entrada():
+		return {"count": 0, "time": 0.0, "states": 0, "edges": 0, "reads": 0, "idle": 0.0, "gap": 0.0}
+	res = {"total": entrada()}
+	# operaciones en curso: nombre, hora de inicio
+	abiertas = []
+	anterior = None
+	ultimo = None
+	primero = None
+	pgc = BitBang.BitBangController.PGC
+
+	for (tipo, t, datos) in readTrace(fichero):
+		if primero is None:
+			primero = t
+		activas = [res["total"]] + [res[nombre] for (nombre, inicio) in abiertas]
+		if tipo in (STATE, BURST, READ):
+			#pausa desde el ultimo acceso al puerto
+			if ultimo is not None and t - ultimo > 0:
+				pausa = t - ultimo
+				for e in activas:
+					e["gap"] = max(e["gap"], pausa)
+					if pausa > hueco:
+						e["idle"] += pausa
+			ultimo = t
+		if tipo == STATE or tipo == BURST:
+			if tipo == STATE:
+				estados = [datos]
+			else:
+				estados = datos[1]
+				ultimo = t + datos[0]
+			flancos = 0
+			for estado in estados:
+				if estado & pgc and (anterior is None or not anterior & pgc):
+					flancos += 1
+				anterior = estado
+			for e in activas:
+				e["states"] += len(estados)
+				e["edges"] += flancos
+		elif tipo == READ:
+			for e in activas:
+				e["reads"] += 1
+		elif tipo == MARK and datos[:1] == "+":
+			nombre = datos[1:]
+			if nombre not in res:
+				res[nombre] = entrada()
+			res[nombre]["count"] += 1
+			abiertas.append((nombre, t))
+		elif tipo == MARK and datos[:1] == "-":
+			for i in range(len(abiertas) - 1, -1, -1):
+				if abiertas[i][0] == datos[1:]:
+					res[datos[1:]]["time"] += t - abiertas[i][1]
+					del abiertas[i]
+					break
+
+	if primero is not None:
+		res["total"]["count"] = 1
+		res["total"]["time"] = (ultimo or primero) - primero
+	for e in res.values():
+		e["edgesPerSecond"] = 0.0
+		if e["time"] > 0:
+			e["edgesPerSecond"] = e["edges"] / e["time"]
+	return res
+
+
+def main():
+	'''Prints the summary of the trace files given as arguments'''
+	if len(sys.argv) < 2:
+		print "Usage: BitBangTrace.py trace..."
+		sys.exit(2)
+	for fichero in sys.argv[1:]:
+		print fichero
+		estadisticas = traceStats(fichero)
+		print "%-16s %6s %10s %10s %10s %8s %10s %10s %10s" % ("operation", "count", "time (s)", "states", "edges", "reads", "edges/s", "idle (s)", "gap (ms)")
+		for nombre in sorted(estadisticas):
+			e = estadisticas[nombre]
+			print "%-16s %6d %10.4f %10d %10d %8d %10.0f %10.4f %10.3f" % (nombre, e["count"], e["time"], e["states"],
+				e["edges"], e["reads"], e["edgesPerSecond"], e["idle"], e["gap"] * 1000)
+
+if __name__ == "__main__":
+	main()
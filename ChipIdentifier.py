@@ -61,6 +61,22 @@ revtables={
 
 
 
+# tiempos maximos de las operaciones de la memoria no volatil, en segundos
+#	row -- programar una fila (P13)
+#	config -- escribir un registro de configuracion (P20)
+#	page -- borrar una pagina
+#	bulk -- borrado total (P11)
+defaultTimings = {"row": 0.00128, "config": 0.025, "page": 0.02, "bulk": 0.33}
+
+timings={
+	#tabla de revisiones : (tiempos maximos, margen de seguridad sobre los tiempos medidos)
+	"dsPIC33FJ06GS101": (defaultTimings, 0.25),
+	"dsPIC33FJ12GP201": (defaultTimings, 0.25),
+	"PIC24HJ12GP20x": (defaultTimings, 0.25)
+	}
+
+
+
 class ChipIdentifier():
 	"""Identifies 16 bit PIC microcontrollers based on chip id and revision number"""
 
@@ -71,6 +87,8 @@ class ChipIdentifier():
 	flash=0
 	ram=0
 	programmingExecutive=0
+	timings=defaultTimings
+	margin=0.25
 
 	def setDevId(self, devid):
 		"""Identifies a PIC microcontroller, setting internal vars
@@ -85,12 +103,14 @@ class ChipIdentifier():
 		flash -- chip flash memory size in addresses
 		ram -- chip ram memory size in bytes
 		programmingExecutive -- chip PE size in addresses
+		timings -- maximum times of the NVM operations in seconds, see defaultTimings
+		margin -- safety margin added to the NVM operation times measured
 		"""
 		#dev id array de 2 enteros
 		def revtable(tabla, revid):
 			if tabla in revtables:
 				if revid in revtables[tabla]:
-					return revtables[tabla, id]
+					return revtables[tabla][revid]
 
 			return ("Unknown revision, RevId:" + hex(revid))
 
@@ -105,6 +125,7 @@ class ChipIdentifier():
 			self.flash=flash
 			self.ram=ram
 			self.programmingExecutive=pe
+			(self.timings, self.margin)=timings.get(trev, (defaultTimings, 0.25))
 		else:
 			self.id=0
 			self.descId="Unknown chip"
@@ -113,6 +134,8 @@ class ChipIdentifier():
 			self.flash=0
 			self.ram=0
 			programmingExecutive=0
+			self.timings=defaultTimings
+			self.margin=0.25
 
 	def fullDesc(self):
 		"""Generates a human-readable chip description"""
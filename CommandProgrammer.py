@@ -8,7 +8,12 @@ __author__ = "Javier Casas (javcasas AT gmail net)"
 __version__ = "1.0"
 
 
+import sys
 import time
+import heapq
+import collections
+from array import array
+import BitBang
 import ChipIdentifier
 
 def getBit(cad,n):
@@ -37,20 +42,490 @@ def listaBits(principio, fin):
 	else:
 		return range(principio, fin + 1)
 
+def packInstructionWords(datos):
+	"""Packs 4 24-bits instructions into 6 16-bits integers as specified in the datasheet.
+	Returns a list of 6 items
+	"""
+	#datos es un array de 4 ints, de los cuales se interpretan los 24 bits de menor valor
+	#Devuelve un array de 6 ints, de los cuales son vlidos los 16 bits de menor valor
+	res=[1,1,1,1,1,1]
+
+	res[0]=datos[0] & 0xffff
+	res[1]=(((datos[1] & 0xff0000) >> 8) | ((datos[0] & 0xff0000) >> 16)) & 0xffff
+	res[2]=datos[1] & 0xffff
+	res[3]=datos[2] & 0xffff
+	res[4]=(((datos[3] & 0xff0000) >> 8) | ((datos[2] & 0xff0000) >> 16)) & 0xffff
+	res[5]=datos[3] & 0xffff
+
+	return res
+
+def unpackInstructionWords(datos):
+	"""Unpacks 6 16-bits packed instructions into 4 24-bits integers as specified in the datasheet.
+	Returns a list of 4 items
+	"""
+	#datos es un array de 6 ints, de los cuales son vlidos los 16 bits de menor valor		
+	#devuelve un array de 4 ints, de los cuales se interpretan los 24 bits de menor valor
+	res=[1,1,1,1]
+
+	res[0] = datos[0]
+	msb = (datos[1] & 0xff) << 16
+	res[0] = res[0] | msb
+
+	res[1] = datos[2]
+	msb = (datos[1] & 0xff00) << 8
+	res[1] |= msb
+
+	res[2] = datos[3]
+	msb = (datos[4] & 0xff) << 16
+	res[2] |= msb		
+
+	res[3] = datos[5]
+	msb = (datos[4] & 0xff00) << 8
+	res[3] |= msb
+
+	return res
+
+# posicion en cada pareja de palabras (8 bytes) de cada byte empaquetado (6 bytes)
+_EMPAQUETADO = ((0, 0), (1, 1), (2, 2), (3, 6), (4, 4), (5, 5))
+
+def packInstructionArray(palabras):
+	"""Packs any even number of 24-bits instructions at once, as packInstructionWords does with each group of 4.
+	Returns an array('H') of 3 items for every 2 instructions
+	"""
+	#cada pareja de palabras A, B en little endian (A0 A1 A2 A3 B0 B1 B2 B3)
+	#se empaqueta como A0 A1 A2 B2 B0 B1, los bytes se mueven con slices
+	if not (isinstance(palabras, array) and palabras.itemsize == 4):
+		palabras = array("I", palabras)
+	if sys.byteorder == "big":
+		palabras = array(palabras.typecode, palabras)
+		palabras.byteswap()
+	origen = bytearray(palabras.tostring())
+	destino = bytearray(len(origen) / 8 * 6)
+	for (d, o) in _EMPAQUETADO:
+		destino[d::6] = origen[o::8]
+	res = array("H")
+	res.fromstring(str(destino))
+	if sys.byteorder == "big":
+		res.byteswap()
+	return res
+
+def unpackInstructionArray(datos):
+	"""Unpacks any number of groups of 3 16-bits packed values at once, as unpackInstructionWords does with each group of 6.
+	Returns an array('i') of 2 instructions for every 3 items
+	"""
+	if not (isinstance(datos, array) and datos.typecode == "H"):
+		datos = array("H", datos)
+	if sys.byteorder == "big":
+		datos = array("H", datos)
+		datos.byteswap()
+	origen = bytearray(datos.tostring())
+	destino = bytearray(len(origen) / 6 * 8)
+	for (d, o) in _EMPAQUETADO:
+		destino[o::8] = origen[d::6]
+	res = array("i")
+	res.fromstring(str(destino))
+	if sys.byteorder == "big":
+		res.byteswap()
+	return res
+
+def _crcTable():
+	tabla = []
+	for i in range(256):
+		crc = i << 8
+		for j in range(8):
+			if crc & 0x8000:
+				crc = ((crc << 1) ^ 0x1021) & 0xffff
+			else:
+				crc = (crc << 1) & 0xffff
+		tabla.append(crc)
+	return tabla
+
+_CRC_TABLE = _crcTable()
+
+def crc16(palabras, crc=0xffff):
+	"""Returns the CRC-16-CCITT (polynomial 0x1021) of a sequence of 24-bit instruction words,
+	taking the 3 bytes of each word from the least significant one, as the CRCP command does.
+	Parameters:
+	palabras -- iterable of instruction words
+	crc -- initial value, for computing the CRC of a range in several parts
+	"""
+	tabla = _CRC_TABLE
+	for palabra in palabras:
+		crc = ((crc << 8) & 0xff00) ^ tabla[(crc >> 8) ^ (palabra & 0xff)]
+		crc = ((crc << 8) & 0xff00) ^ tabla[(crc >> 8) ^ ((palabra >> 8) & 0xff)]
+		crc = ((crc << 8) & 0xff00) ^ tabla[(crc >> 8) ^ ((palabra >> 16) & 0xff)]
+	return crc
+
+
+_PGD = BitBang.BitBangController.PGD
+_PGC = BitBang.BitBangController.PGC
+
+def _waveform(estados):
+	"""Removes the repeated consecutive states of a waveform"""
+	res = bytearray()
+	anterior = None
+	for estado in estados:
+		if estado != anterior:
+			res.append(estado)
+			anterior = estado
+	return res
+
+def _clocks(estados, base, n):
+	"""Appends n PGC pulses with the current PGD value of base"""
+	for i in range(n):
+		estados.append(base | _PGC)
+		estados.append(base)
+
+def compileSIX(comando, primera_ejecucion=False, base=0):
+	"""Returns the packed pin states that send a SIX command, as a bytearray.
+	Parameters:
+	comando -- the command in 24-bit format
+	primera_ejecucion -- If True, adds 5 extra clocks for the first instruction
+	base -- the state of the MCLR and VDD lines
+	"""
+	estados = [base]
+	_clocks(estados, base, 4) #4 ceros
+	if primera_ejecucion:
+		_clocks(estados, base, 5) #5 ceros extra
+	for i in listaBits(0,23):
+		dato = base
+		if getBit(comando, i):
+			dato |= _PGD
+		estados.append(dato)
+		_clocks(estados, dato, 1)
+	return _waveform(estados)
+
+def compileREGOUT(base=0):
+	"""Returns the packed pin states that send the REGOUT control code and the
+	8 idle clocks, as a bytearray. The 16 VISI bits must be clocked separately."""
+	estados = [base | _PGD]
+	_clocks(estados, base | _PGD, 1)
+	estados.append(base)
+	_clocks(estados, base, 11)
+	return _waveform(estados)
+
+
+class WaveformCache:
+	"""LRU cache of precompiled waveforms"""
+
+	def __init__(self, size=256):
+		"""Parameters:
+		size -- maximum number of waveforms kept
+		"""
+		self.size = size
+		self.waveforms = collections.OrderedDict()
+		self.hits = 0
+		self.misses = 0
+
+	def get(self, clave, compilar):
+		"""Returns the waveform for clave, calling compilar() to build it if it is not cached"""
+		try:
+			onda = self.waveforms.pop(clave)
+			self.hits += 1
+		except KeyError:
+			onda = compilar()
+			self.misses += 1
+			if len(self.waveforms) >= self.size:
+				self.waveforms.popitem(False)
+		self.waveforms[clave] = onda
+		return onda
+
+	def six(self, comando, primera_ejecucion=False, base=0):
+		"""Returns the waveform of a SIX command"""
+		comando &= 0xffffff
+		return self.get((comando, primera_ejecucion, base), lambda: compileSIX(comando, primera_ejecucion, base))
+
+	def regout(self, base=0):
+		"""Returns the waveform of the REGOUT header"""
+		return self.get(("REGOUT", base), lambda: compileREGOUT(base))
+
+	def stats(self):
+		"""Returns the hits, misses and entries of the cache as a dictionary"""
+		return {"hits": self.hits, "misses": self.misses, "entries": len(self.waveforms)}
+
+
+# opcodes fijos de los algoritmos de lectura, escritura y borrado
+fixedOpcodes = [0x000000, 0x040200, 0xeb0300, 0xeb0380, 0x880190, 0x883b0a, 0x803b00,
+	0x883c20, 0x883c21, 0x883c22, 0x883c23, 0x883c24, 0x883c25,
+	0xba1b96, 0xbadbb6, 0xbadbd6, 0xba1bb6,
+	0xbb0bb6, 0xbbdbb6, 0xbbebb6, 0xbb1bb6, 0xbb1b80,
+	0x24001a, 0x24000a, 0x2404fa, 0x200007, 0x200f80, 0xa8e761]
+
+def makeWaveformCache(size=256):
+	"""Returns a WaveformCache preseeded with fixedOpcodes for a MCU in ICSP mode"""
+	cache = WaveformCache(size)
+	base = BitBang.BitBangController.MCLR | BitBang.BitBangController.VDD
+	cache.six(0, True, base)
+	for comando in fixedOpcodes:
+		cache.six(comando, False, base)
+	cache.regout(base)
+	cache.hits = cache.misses = 0
+	return cache
+
+
+def _joinWaveforms(ondas):
+	"""Joins several waveforms into one, removing the repeated states at the joints"""
+	res = bytearray()
+	for onda in ondas:
+		if res and onda and res[-1] == onda[0]:
+			res.extend(onda[1:])
+		else:
+			res.extend(onda)
+	return res
+
+
+class InstructionStream:
+	"""A sequence of SIX commands and REGOUTs built ahead of time, and run at once with CommandProgrammer.execute.
+	Every run of SIX commands between REGOUTs is sent as a single waveform, NOPs included: they are
+	the delays required by the datasheet, so they are kept, but they do not cost a call each.
+	"""
+
+	def __init__(self, clave=None):
+		"""Parameters:
+		clave -- if not None, the waveforms of the stream are cached with this key.
+		    It must identify the commands of the stream, so only streams that do not depend on data should have one.
+		"""
+		self.clave = clave
+		# comandos de 24 bits, None para cada REGOUT
+		self.items = []
+
+	def SIX(self, comando):
+		"""Appends a SIX command"""
+		self.items.append(comando & 0xffffff)
+
+	def REGOUT(self):
+		"""Appends a REGOUT, its value is returned by CommandProgrammer.execute"""
+		self.items.append(None)
+
+	def extend(self, stream):
+		"""Appends the commands of another stream"""
+		self.items.extend(stream.items)
+
+	def __len__(self):
+		return len(self.items)
+
+	def segments(self):
+		"""Returns the stream as a list of tuples of consecutive SIX commands, with None for each REGOUT"""
+		res = []
+		tramo = []
+		for comando in self.items:
+			if comando is None:
+				if tramo:
+					res.append(tuple(tramo))
+					tramo = []
+				res.append(None)
+			else:
+				tramo.append(comando)
+		if tramo:
+			res.append(tuple(tramo))
+		return res
+
+
+def runSteps(pasos):
+	"""Runs the steps of an operation in the calling thread.
+	Parameters:
+	pasos -- an iterable yielding the seconds to wait between steps, as the *Steps methods
+	    of Programmer do. The thread sleeps for each of them.
+	"""
+	for espera in pasos:
+		if espera > 0:
+			time.sleep(espera)
+
+
+class Scheduler:
+	"""Runs several tasks in one thread, interleaving them while they wait.
+	A task is a generator yielding the seconds it has to wait before going on, like the *Steps
+	methods of Programmer and CompletionWaiter do. While a task waits for a NVM write or erase
+	of its MCU, the tasks of the other MCUs use the thread. A task that raises an exception
+	is stopped and the others go on.
+
+		planificador = Scheduler()
+		for programador in programadores:
+			planificador.add(programador.eraseChipSteps(), programador)
+		planificador.run()
+	"""
+
+	def __init__(self):
+		# (instante, orden, nombre, tarea)
+		self.pending = []
+		self.count = 0
+		# nombre -> None si termino bien, o la excepcion que la detuvo
+		self.results = {}
+		# segundos de espera en los que no habia ninguna tarea lista
+		self.idle = 0.0
+
+	def add(self, tarea, nombre=None):
+		"""Adds a task, that starts running at once.
+		Parameters:
+		tarea -- a generator yielding the seconds to wait
+		nombre -- the key of the task in results, the task itself if None
+		"""
+		if nombre is None:
+			nombre = tarea
+		heapq.heappush(self.pending, (time.time(), self.count, nombre, tarea))
+		self.count += 1
+
+	def run(self):
+		"""Runs the tasks until all of them are finished.
+		Returns results, a dictionary nombre -> None for the tasks finished
+		and the exception raised for the tasks that failed
+		"""
+		while self.pending:
+			(instante, orden, nombre, tarea) = heapq.heappop(self.pending)
+			espera = instante - time.time()
+			if espera > 0:
+				time.sleep(espera)
+				self.idle += espera
+			try:
+				espera = tarea.next()
+			except StopIteration:
+				self.results[nombre] = None
+				continue
+			except Exception, e:
+				self.results[nombre] = e
+				continue
+			heapq.heappush(self.pending, (time.time() + espera, orden, nombre, tarea))
+		return self.results
+
+
+class CompletionWaiter:
+	"""Waits for the NVM write and erase operations to complete, polling the WR bit of NVMCON.
+	The first poll is done after the time the operation is expected to take. That time starts
+	at the datasheet maximum of the chip and is tuned with the times measured for each operation
+	and device, plus the safety margin of the chip. Later polls back off exponentially.
+	"""
+
+	# operaciones
+	ROW = "row"
+	CONFIG = "config"
+	PAGE = "page"
+	BULK = "bulk"
+
+	# reduccion de la espera cuando la operacion ya habia terminado en la primera consulta
+	shrink = 0.75
+	# crecimiento de la espera entre consultas
+	backoff = 1.5
+	minimumStep = 0.0002
+
+	def __init__(self):
+		self.latencies = {}
+		self.estimates = {}
+		self.floors = {}
+		self.setChip(ChipIdentifier.ChipIdentifier())
+
+	def setChip(self, chip):
+		"""Sets the chip whose timings and margin are used.
+		Parameters:
+		chip -- a ChipIdentifier.ChipIdentifier instance
+		"""
+		self.devid = chip.id
+		self.timings = chip.timings
+		self.margin = chip.margin
+
+	def initialWait(self, op):
+		"""Returns the seconds waited before the first poll of the operation op"""
+		return self.estimates.get((op, self.devid), self.timings[op])
+
+	def wait(self, op, poll):
+		"""Waits for the operation op to complete.
+		Parameters:
+		op -- the operation: ROW, CONFIG, PAGE or BULK
+		poll -- function returning True when the operation is complete
+		Returns the seconds elapsed. Raises IOError on timeout
+		"""
+		runSteps(self.steps(op, poll))
+		return self.last
+
+	def steps(self, op, poll):
+		"""Generator version of wait: yields the seconds to wait before each poll instead of sleeping.
+		When it is exhausted, last holds the seconds elapsed. Raises IOError on timeout.
+		"""
+		self.last = None
+		inicio = time.time()
+		espera = self.initialWait(op)
+		yield espera
+		limite = inicio + self.timings[op] * (2 + self.margin)
+		paso = max(espera * 0.1, self.minimumStep)
+		ocupada = None
+		while not poll():
+			ocupada = time.time() - inicio
+			if time.time() > limite:
+				#la operacion no ha terminado: lo que se escriba despues no seria fiable
+				raise IOError("CompletionWaiter::wait - timeout waiting for the " + op + " operation")
+			yield paso
+			paso *= self.backoff
+
+		latencia = time.time() - inicio
+		self.record(op, latencia, espera, ocupada)
+		self.last = latencia
+
+	def record(self, op, latencia, espera, ocupada=None):
+		"""Records the latency measured for op and tunes its initial wait.
+		Parameters:
+		latencia -- seconds until the operation was seen complete
+		espera -- seconds waited before the first poll
+		ocupada -- seconds until the operation was last seen in progress, None if it was
+		    already complete on the first poll
+		"""
+		clave = (op, self.devid)
+		self.latencies.setdefault(clave, []).append(latencia)
+		if ocupada is None:
+			#ya habia terminado, se prueba a esperar menos
+			estimacion = max(espera * self.shrink, self.floors.get(clave, 0.0))
+		else:
+			#tardo al menos hasta la ultima consulta
+			estimacion = ocupada * (1 + self.margin)
+			self.floors[clave] = estimacion
+		self.estimates[clave] = min(estimacion, self.timings[op])
+
+	def stats(self):
+		"""Returns a dictionary (op, devid) -> (count, minimum, maximum, initial wait) of the latencies measured"""
+		res = {}
+		for clave, latencias in self.latencies.items():
+			res[clave] = (len(latencias), min(latencias), max(latencias), self.estimates[clave])
+		return res
+
 
 class CommandProgrammer:
 	"""Basic ICSP controller for 16-bit PICs"""
 
+	# if False, the buffered waveform is only sent on flush() or when reading PGD
+	flushEachSix = True
+
+	# waveforms shared by every instance
+	cache = makeWaveformCache()
+
 	def setBigBangProgrammer(self, bb):
 		self.bb = bb
 
+	def setWaveformCache(self, cache):
+		self.cache = cache
+
+	def setBuffered(self, buffered, flushEachSix=True):
+		"""Enables the buffered waveform mode of the bit-bang controller.
+		Parameters:
+		buffered -- If True, the pin states are queued and sent in bursts
+		flushEachSix -- If True, the queue is sent after every SIX. If False, it is sent on flush() or REGOUT
+		"""
+		self.bb.set_buffered(buffered)
+		self.flushEachSix = flushEachSix
+
+	def flush(self):
+		"""Sends the buffered waveform to the port."""
+		self.bb.flush()
+
 	
 	ICSPmagicCode=0x4D434851
 	EICSPmagicCode=0x4D434850
 
 
-	def enterICSP(self):
-		"""Puts the MCU in ICSP mode, ready to accept instructions."""	
+	def enterICSP(self, clave=None):
+		"""Puts the MCU in ICSP mode, ready to accept instructions.
+		Parameters:
+		clave -- the 32-bit key to send, ICSPmagicCode by default
+		"""	
+		if clave is None:
+			clave = self.ICSPmagicCode
 		self.bb.begin()
 		
 		self.bb.set_vdd(1)
@@ -66,7 +541,7 @@ class CommandProgrammer:
 		self.bb.set_mclr(0)
 		self.bb.commit()
 		for i in listaBits(31,0):
-			bit=getBit(self.ICSPmagicCode, i)
+			bit=getBit(clave, i)
 			self.bb.set_pgd(bit)
 			self.bb.commit()
 			self.bb.set_pgc(1)
@@ -76,6 +551,7 @@ class CommandProgrammer:
 
 		self.bb.set_pgd(0)
 		self.bb.commit()
+		self.bb.flush()
 		time.sleep(0.005)
 		self.bb.set_mclr(1)
 		time.sleep(0.03)
@@ -95,49 +571,47 @@ class CommandProgrammer:
 		comando -- the command in 24-bit format
 		primera_ejecucion -- If True, adds 5 extra clocks for the first instruction, as indicated in the datasheet.
 		"""
-		self.bb.set_pgd(0)
-		self.bb.commit()
-
-		for i in listaBits(1,4): #4 ceros
-			self.bb.set_pgc(1)
-			self.bb.commit()
-			self.bb.set_pgc(0)
-			self.bb.commit()
-
-		if primera_ejecucion: #5 ceros extra
-			for i in listaBits(1,5): 
-				self.bb.set_pgc(1)
-				self.bb.commit()
-				self.bb.set_pgc(0)
-				self.bb.commit()
-
-		for i in listaBits(0,23):
-			bit=getBit(comando, i)
-			self.bb.set_pgd(bit)
-			self.bb.commit()
-			self.bb.set_pgc(1)
-			self.bb.commit()
-			self.bb.set_pgc(0)
-			self.bb.commit()
+		base = self.bb.get_state() & (self.bb.MCLR | self.bb.VDD)
+		self.bb.replay(self.cache.six(comando, primera_ejecucion, base))
+
+		if self.flushEachSix:
+			self.bb.flush()
+
+	def compile(self, stream, base):
+		"""Returns the waveforms of an InstructionStream: one for each run of SIX commands, and None for each REGOUT"""
+		ondas = []
+		for tramo in stream.segments():
+			if tramo is None:
+				ondas.append(None)
+			else:
+				ondas.append(_joinWaveforms([self.cache.six(comando, False, base) for comando in tramo]))
+		return ondas
+
+	def execute(self, *streams):
+		"""Runs one or more InstructionStreams, sending each run of SIX commands in a single burst.
+		Returns the list of the values read by the REGOUTs of the streams
+		"""
+		res = []
+		for stream in streams:
+			base = self.bb.get_state() & (self.bb.MCLR | self.bb.VDD)
+			if stream.clave is None:
+				ondas = self.compile(stream, base)
+			else:
+				ondas = self.cache.get(("STREAM", stream.clave, base), lambda: self.compile(stream, base))
+			for onda in ondas:
+				if onda is None:
+					res.append(self.REGOUT())
+				else:
+					self.bb.replay(onda)
+					if self.flushEachSix:
+						self.bb.flush()
+		return res
 
 	def REGOUT(self):
 		"""REGOUT, extracts VISI register from the MCU"""
 		res=0
-		self.bb.set_pgd(1)
-		self.bb.commit()
-		self.bb.set_pgc(1)
-		self.bb.commit()
-		self.bb.set_pgc(0)
-		self.bb.commit()
-
-		self.bb.set_pgd(0)
-		self.bb.commit()
-
-		for i in listaBits(1,11):
-			self.bb.set_pgc(1)
-			self.bb.commit()
-			self.bb.set_pgc(0)
-			self.bb.commit()
+		base = self.bb.get_state() & (self.bb.MCLR | self.bb.VDD)
+		self.bb.replay(self.cache.regout(base))
 
 		for i in listaBits(0,15):
 			self.bb.set_pgc(1)
@@ -158,6 +632,7 @@ class CommandProgrammer:
 		self.bb.commit()
 		self.bb.set_mclr(1)
 		self.bb.commit()
+		self.bb.flush()
 
 	def stopPic(self):
 		"""Removes VDD and sets MCLR to 0"""
@@ -172,21 +647,194 @@ class CommandProgrammer:
 
 
 
+class EnhancedCommandProgrammer(CommandProgrammer):
+	"""Enhanced ICSP controller for 16-bit PICs. Talks to the Programming Executive.
+	Commands and responses are sent as 16-bit words, most significant bit first.
+	The first word of a command holds the opcode (bits 15-12) and the command
+	length in words (bits 11-0). The first word of a response holds the
+	response code (bits 15-12), the opcode of the last command (bits 11-8) and
+	a query code (bits 7-0), and the second one the response length in words.
+	"""
+
+	# comandos del programming executive
+	# ERASEP y CRCP son de executives posteriores: el de los PIC24H/dsPIC33F no los tiene
+	# (ver EnhancedProgrammer.extraCommands)
+	SCHECK = 0x0
+	READC = 0x1
+	READP = 0x2
+	PROGC = 0x4
+	PROGP = 0x5
+	ERASEP = 0x9
+	QBLANK = 0xA
+	QVER = 0xB
+	CRCP = 0xC
+
+	# codigos de respuesta
+	PASS = 0x1
+	FAIL = 0x2
+	NACK = 0x3
+
+	# segundos que se espera como maximo una respuesta
+	responseTimeout = 0.5
+
+	def enterEICSP(self):
+		"""Puts the MCU in Enhanced ICSP mode, running the Programming Executive."""
+		self.enterICSP(self.EICSPmagicCode)
+		self.bb.commit()
+		self.bb.flush()
+		time.sleep(0.025) #P7
+
+	def sendWord(self, palabra):
+		"""Sends a 16-bit word to the Programming Executive"""
+		for i in listaBits(15,0):
+			self.bb.set_pgd(getBit(palabra, i))
+			self.bb.commit()
+			self.bb.set_pgc(1)
+			self.bb.commit()
+			self.bb.set_pgc(0)
+			self.bb.commit()
+
+	def receiveWord(self):
+		"""Receives a 16-bit word from the Programming Executive"""
+		res = 0
+		for i in listaBits(15,0):
+			self.bb.set_pgc(1)
+			self.bb.commit()
+			res = setBit(res, i, self.bb.read_pgd())
+			self.bb.set_pgc(0)
+			self.bb.commit()
+		return res
+
+	def waitResponse(self, timeout=None):
+		"""Waits until the Programming Executive pulls PGD low to signal that the response is ready.
+		Returns False if it does not happen before timeout seconds.
+		"""
+		if timeout is None:
+			timeout = self.responseTimeout
+		limite = time.time() + timeout
+		while self.bb.read_pgd() != 0:
+			if time.time() > limite:
+				return False
+		return True
+
+	def command(self, opcode, args=[], timeout=None):
+		"""Sends a command to the Programming Executive and receives its response.
+		Parameters:
+		opcode -- the command opcode
+		args -- the words following the command word
+		timeout -- seconds to wait for the response
+		Returns a pair (header, data), being header the first word of the response and
+		data the list of words following the length word, or None if there is no response
+		"""
+		self.sendWord((opcode << 12) | (1 + len(args)))
+		for palabra in args:
+			self.sendWord(palabra)
+
+		if not self.waitResponse(timeout):
+			return None
+
+		cabecera = self.receiveWord()
+		longitud = self.receiveWord()
+		datos = []
+		for i in range(2, longitud):
+			datos.append(self.receiveWord())
+		return cabecera, datos
+
+	def passed(self, respuesta, opcode):
+		"""Returns True if respuesta is a PASS response to opcode"""
+		if respuesta is None:
+			return False
+		cabecera = respuesta[0]
+		return (cabecera >> 12) == self.PASS and ((cabecera >> 8) & 0xf) == opcode
+
+	def sanityCheck(self, timeout=0.1):
+		"""SCHECK, returns True if the Programming Executive is running"""
+		return self.passed(self.command(self.SCHECK, [], timeout), self.SCHECK)
+
+
+
+
 class Programmer:
 	"""Implements basic commands for reading and programming a MCU"""
 
+	# instrucciones por fila y por pagina de la memoria de programa
+	rowSize = 64
+	pageSize = 512
+
+	# transacciones abiertas y sesion en curso
+	depth = 0
+	session = None
+
+	# secuencias de instrucciones fijas, compartidas por todas las instancias
+	streams = {}
+
+	def __init__(self):
+		self.waiter = CompletionWaiter()
+
 	def setCommandProgrammer(self, c):
 		self.c = c
 
+	def setCompletionWaiter(self, waiter):
+		self.waiter = waiter
+
 	def begin(self):
-		"""Begins a transaction"""
-		self.c.enterICSP()
-		self.c.SIX(0, True)
+		"""Begins a transaction.
+		Only the outermost transaction puts the MCU in ICSP mode. Inside a Session, nested
+		transactions check that the MCU is still in ICSP mode instead.
+		"""
+		if self.depth == 0:
+			self.enter()
+		elif self.session is not None:
+			self.session.check()
+		self.depth += 1
 	
 	def end(self):
 		"""Ends a transaction"""
+		if self.depth > 0:
+			self.depth -= 1
+			if self.depth == 0:
+				self.leave()
+
+	def enter(self):
+		"""Puts the MCU in ICSP mode"""
+		self.c.enterICSP()
+		self.c.SIX(0, True)
+
+	def leave(self):
+		"""Stops the ICSP mode"""
 		self.c.leaveICSP()
 
+	def flush(self):
+		"""Sends any buffered waveform to the MCU"""
+		self.c.flush()
+
+	def fixedStream(self, clave, construir):
+		"""Returns the InstructionStream of a sequence that does not depend on addresses or data,
+		building it the first time it is needed.
+		Parameters:
+		clave -- the key of the sequence
+		construir -- a function that appends the commands of the sequence to the InstructionStream it gets
+		"""
+		try:
+			return self.streams[clave]
+		except KeyError:
+			stream = InstructionStream(clave)
+			construir(stream)
+			self.streams[clave] = stream
+			return stream
+
+	def _addressStream(self, address, registro, inicio):
+		#carga la direccion en TBLPAG y en el registro indicado, tras la secuencia inicio
+		s = InstructionStream()
+		for comando in inicio:
+			s.SIX(comando)
+		msb=(address & 0xff0000) >> 16
+		s.SIX(0x200000 | (msb << 4))
+		s.SIX(0x880190)
+		lsb=(address & 0xffff)
+		s.SIX(registro | (lsb << 4))
+		return s
+
 	def startPic(self):
 		self.c.startPic()
 
@@ -213,97 +861,102 @@ class Programmer:
 		if (nitems % 4) != 0:
 			print "error en Programmer.readMem()"
 			return False
-		value = []
 
-		self.c.SIX(0x040200)
-		self.c.SIX(0x040200)
-		self.c.SIX(0x000000)
+		inicio = self._addressStream(address, 0x200006, [0x040200, 0x040200, 0x000000])
+		#la lectura no depende de la direccion, se compila una vez para cada nitems
+		cuerpo = self.fixedStream(("readMem", nitems), lambda s: self._readStream(s, nitems))
 
-		msb=(address & 0xff0000) >> 16
-		self.c.SIX(0x200000 | (msb << 4))
-		self.c.SIX(0x880190)
-		lsb=(address & 0xffff)
-		self.c.SIX(0x200006 | (lsb << 4))
+		#los valores empaquetados se desempaquetan todos juntos al final
+		paquetes = self.c.execute(inicio, cuerpo)
+		value = unpackInstructionArray(paquetes).tolist()
+		return value
 
-		indice = 0
+	def _readStream(self, s, nitems):
+		#lee nitems palabras de la direccion cargada, 6 REGOUT por cada 4 palabras
 		for indice in range(0, nitems, 4):
-			res = [1,1,1,1,1,1]
-			self.c.SIX(0xeb0380)
-			self.c.SIX(0x000000)
+			s.SIX(0xeb0380)
+			s.SIX(0x000000)
 
-			self.c.SIX(0xba1b96)
-			self.c.SIX(0x000000)
-			self.c.SIX(0x000000)
+			s.SIX(0xba1b96)
+			s.SIX(0x000000)
+			s.SIX(0x000000)
 
-			self.c.SIX(0xbadbb6)
-			self.c.SIX(0x000000)
-			self.c.SIX(0x000000)
+			s.SIX(0xbadbb6)
+			s.SIX(0x000000)
+			s.SIX(0x000000)
 
-			self.c.SIX(0xbadbd6)
-			self.c.SIX(0x000000)
-			self.c.SIX(0x000000)
+			s.SIX(0xbadbd6)
+			s.SIX(0x000000)
+			s.SIX(0x000000)
 
-			self.c.SIX(0xba1bb6)
-			self.c.SIX(0x000000)
-			self.c.SIX(0x000000)
+			s.SIX(0xba1bb6)
+			s.SIX(0x000000)
+			s.SIX(0x000000)
 
-			self.c.SIX(0xba1b96)
-			self.c.SIX(0x000000)
-			self.c.SIX(0x000000)
+			s.SIX(0xba1b96)
+			s.SIX(0x000000)
+			s.SIX(0x000000)
 
-			self.c.SIX(0xbadbb6)
-			self.c.SIX(0x000000)
-			self.c.SIX(0x000000)
+			s.SIX(0xbadbb6)
+			s.SIX(0x000000)
+			s.SIX(0x000000)
 
-			self.c.SIX(0xbadbd6)
-			self.c.SIX(0x000000)
-			self.c.SIX(0x000000)
+			s.SIX(0xbadbd6)
+			s.SIX(0x000000)
+			s.SIX(0x000000)
 
-			self.c.SIX(0xba1bb6)
-			self.c.SIX(0x000000)
-			self.c.SIX(0x000000)
+			s.SIX(0xba1bb6)
+			s.SIX(0x000000)
+			s.SIX(0x000000)
 
-			self.c.SIX(0xa883c20)
-			self.c.SIX(0x000000)
-			res[0] = self.c.REGOUT()
-			self.c.SIX(0x000000)
+			s.SIX(0xa883c20)
+			s.SIX(0x000000)
+			s.REGOUT()
+			s.SIX(0x000000)
 
-			self.c.SIX(0xa883c21)
-			self.c.SIX(0x000000)
-			res[1] = self.c.REGOUT()
-			self.c.SIX(0x000000)
+			s.SIX(0xa883c21)
+			s.SIX(0x000000)
+			s.REGOUT()
+			s.SIX(0x000000)
 
-			self.c.SIX(0xa883c22)
-			self.c.SIX(0x000000)
-			res[2] = self.c.REGOUT()
-			self.c.SIX(0x000000)
+			s.SIX(0xa883c22)
+			s.SIX(0x000000)
+			s.REGOUT()
+			s.SIX(0x000000)
 
-			self.c.SIX(0xa883c23)
-			self.c.SIX(0x000000)
-			res[3] = self.c.REGOUT()
-			self.c.SIX(0x000000)
+			s.SIX(0xa883c23)
+			s.SIX(0x000000)
+			s.REGOUT()
+			s.SIX(0x000000)
 
-			self.c.SIX(0xa883c24)
-			self.c.SIX(0x000000)
-			res[4] = self.c.REGOUT()
-			self.c.SIX(0x000000)
+			s.SIX(0xa883c24)
+			s.SIX(0x000000)
+			s.REGOUT()
+			s.SIX(0x000000)
 
-			self.c.SIX(0xa883c25)
-			self.c.SIX(0x000000)
-			res[5] = self.c.REGOUT()
-			self.c.SIX(0x000000)
+			s.SIX(0xa883c25)
+			s.SIX(0x000000)
+			s.REGOUT()
+			s.SIX(0x000000)
 
-			res2=self.unpackInstructionWords(res)
-			for i in res2:
-				value.append(i)
+		s.SIX(0x040200)
+		s.SIX(0x000000)
 
 
-		self.c.SIX(0x040200)
-		self.c.SIX(0x000000)
-
-		return value
-
 
+	def readBlocks(self, address, nitems, bloque=64):
+		"""Reads nitems instruction words of the program memory from address, a block at a time.
+		It must be run as a transaction (inside begin-end calls)
+		Parameters:
+		address -- The address to read from
+		nitems -- the number of items read
+		bloque -- the number of items of each block, up to 64
+		Yields a pair (address, values) as soon as each block is read
+		"""
+		for i in range(0, nitems, bloque):
+			n = min(bloque, nitems - i)
+			direccion = address + (i << 1)
+			yield (direccion, self.readMem(direccion, (n + 3) & ~3)[:n])
 
 	def writeMem(self, address, value):
 		"""Writes the program memory at the address specified.
@@ -314,85 +967,75 @@ class Programmer:
 		    Must be an iterable of 64 items (0..63)
 		    Each item is a full instruction word (24 bits)
 		"""
+		runSteps(self.writeMemSteps(address, value))
+
+	def writeMemSteps(self, address, value):
+		"""Generator version of writeMem, yielding the seconds to wait for the write (see Scheduler)"""
 
 		#Direccin de 24 bits
 		#value 64 enteros de 24 bits
 
-		indice = 0
-		self.c.SIX(0x040200)
-		self.c.SIX(0x040200)
-		self.c.SIX(0x24001a)
-		self.c.SIX(0x883b0a)
-
-		msb=(address & 0xff0000) >> 16
-		self.c.SIX(0x200000 | (msb << 4))
-		self.c.SIX(0x880190)
-		lsb=(address & 0xffff)
-		self.c.SIX(0x200007 | (lsb << 4))
+		#la fila entera se envia en una rafaga
+		s = self._addressStream(address, 0x200007, [0x040200, 0x040200, 0x24001a, 0x883b0a])
+		grupo = self.fixedStream(("writeMem",), self._writeGroupStream)
 
+		#se empaqueta la fila entera de una vez
+		paquetes = packInstructionArray(value[0:64])
 		for indice in range(0, 64, 4):
-			dat=value[indice:indice + 4]
-			datos = self.packInstructionWords(dat)
-			self.c.SIX(0x200000 | (datos[0] << 4))
-			self.c.SIX(0x200001 | (datos[1] << 4))
-			self.c.SIX(0x200002 | (datos[2] << 4))
-			self.c.SIX(0x200003 | (datos[3] << 4))
-			self.c.SIX(0x200004 | (datos[4] << 4))
-			self.c.SIX(0x200005 | (datos[5] << 4))
-
-			self.c.SIX(0xeb0300)
-			self.c.SIX(0x000000)
-			self.c.SIX(0xbb0bb6)
-			self.c.SIX(0x000000)
-			self.c.SIX(0x000000)
-			self.c.SIX(0xbbdbb6)
-			self.c.SIX(0x000000)
-			self.c.SIX(0x000000)
-			self.c.SIX(0xbbebb6)
-			self.c.SIX(0x000000)
-			self.c.SIX(0x000000)
-			self.c.SIX(0xbb1bb6)
-			self.c.SIX(0x000000)
-			self.c.SIX(0x000000)
-			self.c.SIX(0xbb0bb6)
-			self.c.SIX(0x000000)
-			self.c.SIX(0x000000)
-			self.c.SIX(0xbbdbb6)
-			self.c.SIX(0x000000)
-			self.c.SIX(0x000000)
-			self.c.SIX(0xbbebb6)
-			self.c.SIX(0x000000)
-			self.c.SIX(0x000000)
-			self.c.SIX(0xbb1bb6)
-			self.c.SIX(0x000000)
-			self.c.SIX(0x000000)
-
-		self.c.SIX(0xa8e761)
-		self.c.SIX(0x000000)
-		self.c.SIX(0x000000)
-		self.c.SIX(0x000000)
-		self.c.SIX(0x000000)
-
-		time.sleep(0.002) #P13: 1.28 ms
-
-		continuar = True
-		reintentos = 0
-		while(continuar):
-			self.c.SIX(0x803b00)
-			self.c.SIX(0x883c20)
-			self.c.SIX(0x000000)
-			res = self.c.REGOUT()
-			self.c.SIX(0x040200)
-			self.c.SIX(0x000000)
-
-			continuar = (res & 0x8000) == 0
-			reintentos += 1
-			if reintentos > 20:
-				print "Timeout en writeMem"
-				continuar = False
+			datos = paquetes[indice * 3 / 2:indice * 3 / 2 + 6]
+			s.SIX(0x200000 | (datos[0] << 4))
+			s.SIX(0x200001 | (datos[1] << 4))
+			s.SIX(0x200002 | (datos[2] << 4))
+			s.SIX(0x200003 | (datos[3] << 4))
+			s.SIX(0x200004 | (datos[4] << 4))
+			s.SIX(0x200005 | (datos[5] << 4))
+			s.extend(grupo)
+
+		s.extend(self.fixedStream(("startWrite",), self._startWriteStream))
+		self.c.execute(s)
+		self.c.flush()
+
+		for espera in self.waitWriteSteps(CompletionWaiter.ROW): #P13: 1.28 ms
+			yield espera
 
 		#self.c.leaveICSP()
-		return
+
+	def _writeGroupStream(self, s):
+		#escribe en los latches las 4 palabras cargadas en W0..W5
+		s.SIX(0xeb0300)
+		s.SIX(0x000000)
+		s.SIX(0xbb0bb6)
+		s.SIX(0x000000)
+		s.SIX(0x000000)
+		s.SIX(0xbbdbb6)
+		s.SIX(0x000000)
+		s.SIX(0x000000)
+		s.SIX(0xbbebb6)
+		s.SIX(0x000000)
+		s.SIX(0x000000)
+		s.SIX(0xbb1bb6)
+		s.SIX(0x000000)
+		s.SIX(0x000000)
+		s.SIX(0xbb0bb6)
+		s.SIX(0x000000)
+		s.SIX(0x000000)
+		s.SIX(0xbbdbb6)
+		s.SIX(0x000000)
+		s.SIX(0x000000)
+		s.SIX(0xbbebb6)
+		s.SIX(0x000000)
+		s.SIX(0x000000)
+		s.SIX(0xbb1bb6)
+		s.SIX(0x000000)
+		s.SIX(0x000000)
+
+	def _startWriteStream(self, s):
+		#activa WR y espera a que empiece la operacion
+		s.SIX(0xa8e761)
+		s.SIX(0x000000)
+		s.SIX(0x000000)
+		s.SIX(0x000000)
+		s.SIX(0x000000)
 
 	def readConfigMem(self):
 		"""Reads all the configuration registers.
@@ -407,73 +1050,158 @@ class Programmer:
 		Parameters:
 		datos -- the configuration registers in an iterable form of 12 items
 		"""
+		runSteps(self.writeConfigMemSteps(datos))
+
+	def writeConfigMemSteps(self, datos):
+		"""Generator version of writeConfigMem, yielding the seconds to wait for the writes (see Scheduler)"""
 		#escribe toda la memoria de configuracion
 
-		self.c.SIX(0x040200)
-		self.c.SIX(0x040200)
-		self.c.SIX(0x000000)
+		self.c.execute(self.fixedStream(("writeConfigMem",), self._configStream))
+		registro = self.fixedStream(("writeConfigRegister",), self._configRegisterStream)
+
+		for i in listaBits(0,11):
+			dat=datos[i] & 0xffff
+			s = InstructionStream()
+			s.SIX(0x200000 | (dat << 4))
+			self.c.execute(s, registro)
+			self.c.flush()
 
-		self.c.SIX(0x200007)
+			for espera in self.waitWriteSteps(CompletionWaiter.CONFIG): #P20
+				yield espera
 
-		self.c.SIX(0x24000a)
-		self.c.SIX(0x883b0a)
 
-		self.c.SIX(0x200f80)
-		self.c.SIX(0x880190)
 
-		for i in listaBits(0,11):
-			dat=datos[i] & 0xffff
-			self.c.SIX(0x200000 | (dat << 4))
-	
-			self.c.SIX(0xbb1b80)
-			self.c.SIX(0x000000)
-			self.c.SIX(0x000000)
-	
-			self.c.SIX(0xa8e761)
-			self.c.SIX(0x000000)
-			self.c.SIX(0x000000)
-			self.c.SIX(0x000000)
-			self.c.SIX(0x000000)
 
-			time.sleep(0.025) #P20
 
-			continuar = True
-			reintentos = 0
-			while(continuar):
-				self.c.SIX(0x803b00)
-				self.c.SIX(0x883c20)
-				self.c.SIX(0x000000)
-				reg = self.c.REGOUT()
-				self.c.SIX(0x040200)
-				self.c.SIX(0x000000)
-				continuar = (reg & 0x8000) == 0
-				reintentos += 1
-				if reintentos > 20:
-					print "Timeout en writeMem"
-					continuar = False
+	def _configStream(self, s):
+		#prepara la escritura de los registros de configuracion desde 0xf80000
+		s.SIX(0x040200)
+		s.SIX(0x040200)
+		s.SIX(0x000000)
 
+		s.SIX(0x200007)
 
+		s.SIX(0x24000a)
+		s.SIX(0x883b0a)
 
+		s.SIX(0x200f80)
+		s.SIX(0x880190)
 
+	def _configRegisterStream(self, s):
+		#escribe el registro cargado en W0 y pasa al siguiente
+		s.SIX(0xbb1b80)
+		s.SIX(0x000000)
+		s.SIX(0x000000)
+
+		self._startWriteStream(s)
 
 	def eraseChip(self):
 		"""Erases the microcontroller memory.
 		It must be run as a transaction (inside begin-end calls)
 		"""
+		runSteps(self.eraseChipSteps())
+
+	def eraseChipSteps(self):
+		"""Generator version of eraseChip, yielding the seconds to wait for the erase (see Scheduler)"""
 		#Borra el chip
-		self.c.SIX(0x040200)
-		self.c.SIX(0x040200)
-		self.c.SIX(0x000000)
-		self.c.SIX(0x2404fa)
-		self.c.SIX(0x883b0a)
-		self.c.SIX(0xa8e761)
-		self.c.SIX(0x000000)
-		self.c.SIX(0x000000)
-		self.c.SIX(0x000000)
-		self.c.SIX(0x000000)
+		self.c.execute(self.fixedStream(("eraseChip",), self._eraseChipStream))
+		self.c.flush()
 
 		#esperamos P11 (330 ms)
-		time.sleep(0.33)
+		for espera in self.waitWriteSteps(CompletionWaiter.BULK):
+			yield espera
+
+	def _eraseChipStream(self, s):
+		s.SIX(0x040200)
+		s.SIX(0x040200)
+		s.SIX(0x000000)
+		s.SIX(0x2404fa)
+		s.SIX(0x883b0a)
+		self._startWriteStream(s)
+
+	def erasePages(self, address, npages=1):
+		"""Erases npages pages of program memory from address.
+		It must be run as a transaction (inside begin-end calls)
+		Parameters:
+		address -- An address inside the first page
+		npages -- The number of pages erased
+		"""
+		runSteps(self.erasePagesSteps(address, npages))
+
+	def erasePagesSteps(self, address, npages=1):
+		"""Generator version of erasePages, yielding the seconds to wait for the erases (see Scheduler)"""
+		for i in range(npages):
+			direccion = address + i * self.pageSize * 2
+			s = self._addressStream(direccion, 0x200001, [0x040200, 0x040200, 0x000000, 0x24042a, 0x883b0a])
+
+			#escritura ficticia para fijar la pagina
+			s.SIX(0xbb0881)
+			s.SIX(0x000000)
+			s.SIX(0x000000)
+
+			s.extend(self.fixedStream(("startWrite",), self._startWriteStream))
+			self.c.execute(s)
+			self.c.flush()
+
+			for espera in self.waitWriteSteps(CompletionWaiter.PAGE):
+				yield espera
+
+	def eraseRows(self, address, nrows=1):
+		"""Erases nrows rows of program memory from address.
+		The NVM controller can only erase whole pages, so the rest of the rows of the pages
+		involved are read back before erasing and programmed again afterwards.
+		It must be run as a transaction (inside begin-end calls)
+		Parameters:
+		address -- An address inside the first row
+		nrows -- The number of rows erased
+		"""
+		runSteps(self.eraseRowsSteps(address, nrows))
+
+	def eraseRowsSteps(self, address, nrows=1):
+		"""Generator version of eraseRows, yielding the seconds to wait for the erases and writes (see Scheduler)"""
+		fila = self.rowSize * 2
+		pagina = self.pageSize * 2
+		inicio = address & ~(fila - 1)
+		fin = inicio + nrows * fila
+		for p in range(inicio & ~(pagina - 1), fin, pagina):
+			conservar = []
+			for f in range(p, p + pagina, fila):
+				if f < inicio or f >= fin:
+					datos = self.readMem(f, self.rowSize)
+					if datos.count(0xffffff) != len(datos):
+						conservar.append((f, datos))
+			for espera in self.erasePagesSteps(p):
+				yield espera
+			for (f, datos) in conservar:
+				for espera in self.writeMemSteps(f, datos):
+					yield espera
+
+	def writeDone(self):
+		"""Polls NVMCON once. Returns True if its WR bit is cleared, meaning that the last write or erase is complete.
+		It must be run as a transaction (inside begin-end calls)
+		"""
+		res = self.c.execute(self.fixedStream(("writeDone",), self._writeDoneStream))[0]
+		return (res & 0x8000) == 0
+
+	def _writeDoneStream(self, s):
+		#lee NVMCON
+		s.SIX(0x803b00)
+		s.SIX(0x883c20)
+		s.SIX(0x000000)
+		s.REGOUT()
+		s.SIX(0x040200)
+		s.SIX(0x000000)
+
+	def waitWrite(self, op):
+		"""Waits for the current write or erase operation op (see CompletionWaiter) to complete.
+		It must be run as a transaction (inside begin-end calls)
+		Returns the seconds elapsed. Raises IOError on timeout
+		"""
+		return self.waiter.wait(op, self.writeDone)
+
+	def waitWriteSteps(self, op):
+		"""Generator version of waitWrite, yielding the seconds to wait between polls (see CompletionWaiter.steps)"""
+		return self.waiter.steps(op, self.writeDone)
 
 	def readDevId(self):
 		"""Reads the device identifier and device revision.
@@ -482,50 +1210,255 @@ class Programmer:
 		"""
 		#Lee la descripcin del chip
 		dat=self.readMem(0xff0000, 4)
+		chip=ChipIdentifier.ChipIdentifier()
+		chip.setDevId(dat[0:2])
+		self.waiter.setChip(chip)
 		return dat[0:2]
 
+	def crc(self, address, nitems):
+		"""Returns the CRC of nitems instruction words from address, as computed by crc16,
+		or None if the MCU cannot compute it. Plain ICSP mode cannot.
+		"""
+		return None
+
 	def packInstructionWords(self, datos):
 		"""Packs 4 24-bits instructions into 6 16-bits integers as specified in the datasheet.
 		Returns a list of 6 items
 		"""
-		#datos es un array de 4 ints, de los cuales se interpretan los 24 bits de menor valor
-		#Devuelve un array de 6 ints, de los cuales son vlidos los 16 bits de menor valor
-		res=[1,1,1,1,1,1]
-
-		res[0]=datos[0] & 0xffff
-		res[1]=(((datos[1] & 0xff0000) >> 8) | ((datos[0] & 0xff0000) >> 16)) & 0xffff
-		res[2]=datos[1] & 0xffff
-		res[3]=datos[2] & 0xffff
-		res[4]=(((datos[3] & 0xff0000) >> 8) | ((datos[2] & 0xff0000) >> 16)) & 0xffff
-		res[5]=datos[3] & 0xffff
-
-		return res
+		return packInstructionWords(datos)
 
 	def unpackInstructionWords(self, datos):
 		"""Unpacks 6 16-bits packed instructions into 4 24-bits integers as specified in the datasheet.
 		Returns a list of 4 items
 		"""
-		#datos es un array de 6 ints, de los cuales son vlidos los 16 bits de menor valor		
-		#devuelve un array de 4 ints, de los cuales se interpretan los 24 bits de menor valor
-		res=[1,1,1,1]
+		return unpackInstructionWords(datos)
 
-		res[0] = datos[0]
-		msb = (datos[1] & 0xff) << 16
-		res[0] = res[0] | msb
 
-		res[1] = datos[2]
-		msb = (datos[1] & 0xff00) << 8
-		res[1] |= msb
 
-		res[2] = datos[3]
-		msb = (datos[4] & 0xff) << 16
-		res[2] |= msb		
 
-		res[3] = datos[5]
-		msb = (datos[4] & 0xff00) << 8
-		res[3] |= msb
+class EnhancedProgrammer(Programmer):
+	"""Implements the Programmer commands through the Programming Executive (Enhanced ICSP).
+	It needs an EnhancedCommandProgrammer. If the MCU does not answer in Enhanced ICSP mode,
+	it falls back to the plain ICSP commands of Programmer.
+	"""
 
-		return res
+	# None -- not checked yet, True -- the PE answers, False -- plain ICSP
+	executive = None
+
+	# comandos del executive que no tiene el de los PIC24H/dsPIC33F (ERASEP, CRCP).
+	# Ningun chip de ChipIdentifier los tiene: sin ellos se borra en modo ICSP y no se calculan CRCs
+	extraCommands = ()
+
+	def enter(self):
+		"""Puts the MCU in Enhanced ICSP mode if it has a Programming Executive, or in ICSP mode if not"""
+		if self.executive != False:
+			self.c.enterEICSP()
+			if self.c.sanityCheck():
+				self.executive = True
+				return
+			self.c.leaveICSP()
+			self.executive = False
+		Programmer.enter(self)
+
+	def _command(self, opcode, args, nombre):
+		respuesta = self.c.command(opcode, args)
+		if not self.c.passed(respuesta, opcode):
+			print "Error en EnhancedProgrammer." + nombre + "()"
+			return None
+		return respuesta
+
+	def _required(self, opcode, args, nombre):
+		#las escrituras y borrados rechazados no se pueden ignorar
+		respuesta = self._command(opcode, args, nombre)
+		if respuesta is None:
+			raise IOError("EnhancedProgrammer::" + nombre + " - the Programming Executive rejected the command")
+		return respuesta
+
+	def readMem(self, address, nitems=64):
+		"""Reads address of the program memory of the microcontroller (READP).
+		It must be run as a transaction (inside begin-end calls)
+		Parameters:
+		address -- The address to read from
+		nitems -- the number of items read
+		    Must be multiple of 4
+		Returns a list of the values read
+		"""
+		if not self.executive:
+			return Programmer.readMem(self, address, nitems)
+		if address >= 0xf80000:
+			return self._readConfig(address, nitems)
+
+		if (nitems % 4) != 0:
+			print "error en EnhancedProgrammer.readMem()"
+			return False
+		respuesta = self._command(self.c.READP, [nitems, (address & 0xff0000) >> 16, address & 0xffff], "readMem")
+		if respuesta is None:
+			return False
+
+		return unpackInstructionArray(respuesta[1]).tolist()
+
+	def _readConfig(self, address, nitems):
+		#READC lee los registros de configuracion y la identificacion del chip
+		respuesta = self._command(self.c.READC, [(nitems << 8) | ((address & 0xff0000) >> 16), address & 0xffff], "readMem")
+		if respuesta is None:
+			return False
+		return respuesta[1]
+
+	def writeMemSteps(self, address, value):
+		"""Writes a row of the program memory at the address specified (PROGP).
+		The Programming Executive times the write itself, so there is nothing to wait for.
+		Raises IOError if the Programming Executive rejects the write.
+		See Programmer.writeMem
+		"""
+		if not self.executive:
+			for espera in Programmer.writeMemSteps(self, address, value):
+				yield espera
+			return
+
+		args = [(address & 0xff0000) >> 16, address & 0xffff]
+		args.extend(packInstructionArray(value[0:64]))
+		self._required(self.c.PROGP, args, "writeMem")
+
+	def writeConfigMemSteps(self, datos):
+		"""Writes all the configuration registers (PROGC).
+		Raises IOError if the Programming Executive rejects a write.
+		See Programmer.writeConfigMem
+		"""
+		if not self.executive:
+			for espera in Programmer.writeConfigMemSteps(self, datos):
+				yield espera
+			return
+
+		for i in listaBits(0,11):
+			self._required(self.c.PROGC, [0xf8, i << 1, datos[i] & 0xffff], "writeConfigMem")
+
+	def eraseChipSteps(self):
+		"""Erases the microcontroller memory.
+		The Programming Executive cannot bulk erase, so the erase is done in plain ICSP mode.
+		See Programmer.eraseChip
+		"""
+		if not self.executive:
+			for espera in Programmer.eraseChipSteps(self):
+				yield espera
+			return
+
+		for espera in self._icspSteps(Programmer.eraseChipSteps(self)):
+			yield espera
+
+	def _icspSteps(self, pasos):
+		#ejecuta los pasos de una operacion en modo ICSP y vuelve al Programming Executive
+		self.c.leaveICSP()
+		Programmer.enter(self)
+		try:
+			for espera in pasos:
+				yield espera
+		finally:
+			self.c.leaveICSP()
+			self.c.enterEICSP()
+
+	def erasePagesSteps(self, address, npages=1):
+		"""Erases npages pages of program memory from address (ERASEP).
+		If the Programming Executive has no ERASEP (see extraCommands), the erase is done in plain ICSP mode.
+		Raises IOError if the Programming Executive rejects the erase.
+		See Programmer.erasePages
+		"""
+		if not self.executive:
+			for espera in Programmer.erasePagesSteps(self, address, npages):
+				yield espera
+			return
+		if self.c.ERASEP not in self.extraCommands:
+			for espera in self._icspSteps(Programmer.erasePagesSteps(self, address, npages)):
+				yield espera
+			return
+		self._required(self.c.ERASEP, [(npages << 8) | ((address & 0xff0000) >> 16), address & 0xffff], "erasePages")
+
+	def blankCheck(self, address, nitems):
+		"""Returns True if nitems instruction words from address are blank (QBLANK).
+		It needs the Programming Executive.
+		"""
+		respuesta = self._command(self.c.QBLANK, [(address & 0xff0000) >> 16, address & 0xffff, nitems >> 16, nitems & 0xffff], "blankCheck")
+		return respuesta is not None and (respuesta[0] & 0xff) == 0xf0
+
+	def crc(self, address, nitems):
+		"""Returns the CRC of nitems instruction words from address, as computed by crc16 (CRCP).
+		Returns None without Programming Executive, if it has no CRCP (see extraCommands), or on error.
+		"""
+		if not self.executive or self.c.CRCP not in self.extraCommands:
+			return None
+		respuesta = self._command(self.c.CRCP, [(address & 0xff0000) >> 16, address & 0xffff, nitems >> 16, nitems & 0xffff], "crc")
+		if respuesta is None:
+			return None
+		return respuesta[1][0]
+
+	def executiveVersion(self):
+		"""Returns the version of the Programming Executive (QVER)"""
+		respuesta = self._command(self.c.QVER, [], "executiveVersion")
+		if respuesta is None:
+			return None
+		return respuesta[0] & 0xff
+
+
+
+
+class Session:
+	"""Keeps the MCU in ICSP mode across several operations of a Programmer, so begin() and
+	end() do not enter and leave ICSP mode every time. It can be used as a context manager:
+
+		with Session(programador):
+			leer(programador)
+			escribir(programador, extractor)
+
+	On every nested begin() it reads the device identifier, and enters ICSP mode again
+	if the MCU has dropped out of it.
+	"""
+
+	def __init__(self, programador):
+		"""Parameters:
+		programador -- the Programmer
+		"""
+		self.p = programador
+		self.devid = None
+		# segundos que ha costado cada entrada en modo ICSP
+		self.entries = []
+
+	def __enter__(self):
+		self.open()
+		return self
+
+	def __exit__(self, tipo, valor, traza):
+		self.close()
+		return False
+
+	def open(self):
+		"""Puts the MCU in ICSP mode until close() is called"""
+		inicio = time.time()
+		self.p.begin()
+		self.entries.append(time.time() - inicio)
+		self.p.session = self
+		self.devid = self.p.readDevId()
+
+	def close(self):
+		"""Ends the session, leaving ICSP mode"""
+		self.p.session = None
+		self.p.end()
+
+	def check(self):
+		"""Enters ICSP mode again if the MCU has dropped out of it.
+		Returns True if it had to enter again
+		"""
+		dat = self.p.readMem(0xff0000, 4)
+		if dat and dat[0:2] == self.devid:
+			return False
+		inicio = time.time()
+		self.p.leave()
+		self.p.enter()
+		self.entries.append(time.time() - inicio)
+		self.devid = self.p.readDevId()
+		return True
+
+	def setupTime(self):
+		"""Returns the seconds spent entering ICSP mode during the session"""
+		return sum(self.entries)
 
 
 
@@ -566,6 +1499,8 @@ def test2():
 	cads.append(0x456789)
 	res=p.packInstructionWords(cads)
 	res2=p.unpackInstructionWords(res)
+	if list(packInstructionArray(cads)) != res or unpackInstructionArray(res).tolist() != res2:
+		print "error en test 2: packInstructionArray"
 	if cads != res2:
 		print "error en test 2:"
 		for i in cads:
@@ -0,0 +1,203 @@
+'''On-disk cache of parsed program images
+
+@author     Javier Casas (javcasas AT gmail DOT com)
+@version    1.0
+'''
+__author__ = "Javier Casas (javcasas AT gmail DOT com)"
+__version__ = "1.0"
+
+import os
+import struct
+import hashlib
+import mmap
+from array import array
+
+import intelhex
+
+
+# version del formato de los ficheros de la cache: se cambia cuando cambia su estructura.
+# Los cambios en como se construyen las imagenes ya cambian la clave (ver sourceVersion)
+FORMAT = 1
+MAGIC = "P24I"
+# cabecera: magic, formato, numero de segmentos, de rangos y de filas
+HEADER = struct.Struct("<4sIIII")
+
+
+def sourceVersion(modulos):
+	"""Returns a version made from the source code of some modules, for the key of the images.
+	Any change in the code that decodes a HEX file or builds its slices and rows gives a new version,
+	so it needs no manual bump.
+	Parameters:
+	modulos -- the modules, for example [intelhex, pic24programmer]
+	"""
+	h = hashlib.sha1()
+	for modulo in modulos:
+		fichero = modulo.__file__
+		if fichero.endswith((".pyc", ".pyo")):
+			fichero = fichero[:-1]
+		try:
+			f = open(fichero, "rb")
+			try:
+				h.update(f.read())
+			finally:
+				f.close()
+		except IOError:
+			#sin fuente, se usa el nombre del modulo y su version
+			h.update("%s\0%s" % (modulo.__name__, getattr(modulo, "__version__", "")))
+		h.update("\0")
+	return h.hexdigest()
+
+
+class ImageCache:
+	"""Keeps the images decoded from Intel HEX files in a directory, so the same file is only parsed once.
+	Each image is stored in a binary file with its data segments, the ranges of extractor24bits.make_slices
+	and its non-empty rows. The file name is a hash of the contents of the HEX file and of the version
+	of the tool, so a new HEX file or a new version never uses a stale image. Images are served from
+	a memory map of the file, without copying them. When the files take more than limit bytes, the least recently used ones are removed.
+	"""
+
+	def __init__(self, directorio, version="", limite=64 * 1024 * 1024):
+		"""Parameters:
+		directorio -- the directory of the cache, it is created if needed
+		version -- version of the tool, part of the key of every image (see sourceVersion)
+		limite -- maximum bytes taken by the cache files
+		"""
+		self.directorio = directorio
+		self.version = version
+		self.limite = limite
+		self.hits = 0
+		self.misses = 0
+
+	def key(self, contenido):
+		"""Returns the key of the image of a HEX file
+		Parameters:
+		contenido -- the contents of the HEX file
+		"""
+		h = hashlib.sha1()
+		h.update("%s\0%d\0" % (self.version, FORMAT))
+		h.update(contenido)
+		return h.hexdigest()
+
+	def path(self, clave):
+		return os.path.join(self.directorio, clave + ".img")
+
+	def load(self, contenido):
+		"""Returns the image of a HEX file as a tuple (hex, slices, rows), or None if it is not in the cache.
+		The hex object reads its data from a memory map of the cache file: close it when it is no longer needed.
+		Parameters:
+		contenido -- the contents of the HEX file
+		"""
+		nombre = self.path(self.key(contenido))
+		try:
+			f = open(nombre, "rb")
+		except IOError:
+			self.misses += 1
+			return None
+		try:
+			#los cambios que se hagan en la imagen no llegan al fichero
+			mapa = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+		except (mmap.error, ValueError):
+			mapa = None
+		f.close()
+		res = None
+		if mapa is not None:
+			res = self._decode(mapa)
+		if res is None:
+			if mapa is not None:
+				mapa.close()
+			self.misses += 1
+			return None
+		if not res[0].segments():
+			#imagen vacia, el mapa no queda en la imagen
+			mapa.close()
+		self.hits += 1
+		#la fecha de modificacion marca el ultimo uso
+		try:
+			os.utime(nombre, None)
+		except OSError:
+			pass
+		return res
+
+	def _decode(self, mapa):
+		if len(mapa) < HEADER.size:
+			return None
+		(magic, formato, nsegmentos, nrangos, nfilas) = HEADER.unpack_from(mapa, 0)
+		if magic != MAGIC or formato != FORMAT:
+			return None
+		pos = HEADER.size
+		tablas = []
+		for n in (nsegmentos * 2, nrangos * 2, nfilas):
+			tabla = array("I")
+			if pos + n * tabla.itemsize > len(mapa):
+				return None
+			tabla.fromstring(mapa[pos:pos + n * tabla.itemsize])
+			tablas.append(tabla)
+			pos += n * tabla.itemsize
+		(segmentos, rangos, filas) = tablas
+
+		#los datos no se copian, se leen del mapa
+		contenido = intelhex.IntelHex()
+		for i in range(0, len(segmentos), 2):
+			(inicio, longitud) = (segmentos[i], segmentos[i + 1])
+			if pos + longitud > len(mapa):
+				return None
+			contenido.putmap(inicio, mapa, pos, longitud)
+			pos += longitud
+		slices = [(rangos[i], rangos[i + 1]) for i in range(0, len(rangos), 2)]
+		return (contenido, slices, list(filas))
+
+	def store(self, contenido, hex, slices, filas):
+		"""Stores the image of a HEX file and removes the least recently used images if the cache is full.
+		Parameters:
+		contenido -- the contents of the HEX file
+		hex -- the intelhex.IntelHex object decoded from it
+		slices -- the ranges returned by extractor24bits.make_slices
+		filas -- the non-empty rows returned by extractor24bits.filas
+		"""
+		segmentos = array("I")
+		datos = []
+		for (inicio, fin) in hex.segments():
+			segmentos.extend((inicio, fin - inicio))
+			datos.append(hex.tobinstr(inicio, fin - 1))
+		rangos = array("I")
+		for (inicio, fin) in slices:
+			rangos.extend((inicio, fin))
+
+		if not os.path.isdir(self.directorio):
+			os.makedirs(self.directorio)
+		nombre = self.path(self.key(contenido))
+		#se escribe con otro nombre y se renombra, para que nunca se lea un fichero a medias
+		temporal = nombre + ".%d.tmp" % os.getpid()
+		f = open(temporal, "wb")
+		try:
+			f.write(HEADER.pack(MAGIC, FORMAT, len(segmentos) / 2, len(rangos) / 2, len(filas)))
+			f.write(segmentos.tostring())
+			f.write(rangos.tostring())
+			f.write(array("I", filas).tostring())
+			for bloque in datos:
+				f.write(bloque)
+		finally:
+			f.close()
+		os.rename(temporal, nombre)
+		self.evict()
+
+	def evict(self):
+		"""Removes the least recently used images until the cache takes at most limit bytes"""
+		ficheros = []
+		for nombre in os.listdir(self.directorio):
+			if nombre.endswith(".img"):
+				ruta = os.path.join(self.directorio, nombre)
+				try:
+					info = os.stat(ruta)
+				except OSError:
+					continue
+				ficheros.append((info.st_mtime, info.st_size, ruta))
+		ficheros.sort(reverse=True)
+		total = 0
+		for (fecha, tam, ruta) in ficheros:
+			total += tam
+			if total > self.limite:
+				try:
+					os.remove(ruta)
+				except OSError:
+					pass
@@ -0,0 +1,519 @@
+'''Programmer adapter on a serial link
+
+The host sends whole SIX commands, runs of NOPs and REGOUT requests to an adapter,
+which clocks the bits on the ICSP lines itself.
+
+@author     Javier Casas (javcasas AT gmail DOT com)
+@version    1.0
+'''
+__author__ = "Javier Casas (javcasas AT gmail DOT com)"
+__version__ = "1.0"
+
+import os
+import time
+import errno
+import select
+import struct
+import collections
+import threading
+import atexit
+
+try:
+	import termios
+	import tty
+	import pty
+except ImportError:
+	# only available on POSIX systems
+	termios = None
+
+import CommandProgrammer
+
+
+# Tramas
+#
+# Del equipo al adaptador:  A5 seq orden longitud datos... suma
+# Del adaptador al equipo:  5A seq estado longitud datos... suma
+# suma hace que los bytes desde seq hasta la suma sumen 0 (como en Intel HEX).
+# Cada trama recibe una respuesta con su mismo seq. El adaptador ejecuta las tramas
+# en orden de seq: si falta una, contesta NAK con el seq esperado y descarta las
+# siguientes hasta recibirlo. Las tramas repetidas se contestan con la respuesta guardada.
+SYNC_REQUEST = 0xA5
+SYNC_RESPONSE = 0x5A
+MAX_PAYLOAD = 255
+
+# ordenes
+ENTER = 0x01		# clave (4 bytes): entra en modo ICSP o EICSP
+LEAVE = 0x02		# sale del modo ICSP
+START = 0x03		# aplica VDD y MCLR
+STOP = 0x04		# quita MCLR y VDD
+SIX = 0x10		# comandos SIX de 3 bytes
+SIX_FIRST = 0x11	# un comando SIX con los 5 ciclos extra del primero
+NOPS = 0x12		# numero (2 bytes) de comandos SIX de NOP seguidos
+REGOUT = 0x13		# numero (1 byte) de REGOUT, la respuesta trae una palabra de 2 bytes por cada uno
+SEND = 0x20		# palabras de 2 bytes para el Programming Executive
+RECEIVE = 0x21		# numero (1 byte) de palabras a recibir del Programming Executive
+WAIT = 0x22		# milisegundos (2 bytes) a esperar a que PGD baje
+
+# estados de las respuestas
+OK = 0x00
+NAK = 0x01
+TIMEOUT = 0x02
+UNKNOWN = 0x03
+
+# resultado de readFrame para una trama danada
+CORRUPT = -1
+
+# comandos SIX por trama, palabras por trama
+SIX_PER_FRAME = MAX_PAYLOAD / 3
+WORDS_PER_FRAME = MAX_PAYLOAD / 2
+
+
+def makeFrame(sync, seq, codigo, datos=""):
+	"""Returns a frame as a string
+	Parameters:
+	sync -- SYNC_REQUEST or SYNC_RESPONSE
+	seq -- the sequence number
+	codigo -- the command or the status
+	datos -- the payload, up to MAX_PAYLOAD bytes
+	"""
+	trama = bytearray([sync, seq & 0xff, codigo, len(datos)])
+	trama.extend(datos)
+	trama.append(-sum(trama[1:]) & 0xff)
+	return str(trama)
+
+
+class SerialLink:
+	"""Byte stream to a serial port, or to any file descriptor, that reads frames"""
+
+	def __init__(self, fd):
+		"""Parameters:
+		fd -- an open file descriptor
+		"""
+		self.fd = fd
+		self.buffer = bytearray()
+
+	def write(self, datos):
+		"""Writes a string"""
+		while datos:
+			n = os.write(self.fd, datos)
+			datos = datos[n:]
+
+	def _fill(self, timeout):
+		#lee lo que haya disponible, esperando como mucho timeout segundos
+		if not select.select([self.fd], [], [], timeout)[0]:
+			return False
+		try:
+			datos = os.read(self.fd, 4096)
+		except OSError, e:
+			#un pty sin nadie al otro lado da EIO
+			if e.errno != errno.EIO:
+				raise
+			time.sleep(timeout)
+			return False
+		self.buffer.extend(datos)
+		return len(datos) > 0
+
+	def readFrame(self, sync, timeout):
+		"""Reads the next frame starting with sync.
+		Returns a tuple (seq, code, payload), CORRUPT if a damaged frame is found, or None if no frame
+		arrives in timeout seconds
+		"""
+		limite = time.time() + timeout
+		while True:
+			#se descarta lo que haya antes del byte de sincronismo
+			i = self.buffer.find(chr(sync))
+			if i < 0:
+				del self.buffer[:]
+			elif i > 0:
+				del self.buffer[:i]
+			if len(self.buffer) >= 4 and len(self.buffer) >= 5 + self.buffer[3]:
+				n = self.buffer[3]
+				trama = self.buffer[:5 + n]
+				if sum(trama[1:]) & 0xff != 0:
+					del self.buffer[:1]
+					return CORRUPT
+				del self.buffer[:5 + n]
+				return (trama[1], trama[2], trama[4:4 + n])
+			espera = limite - time.time()
+			if espera <= 0 or not self._fill(espera):
+				if time.time() >= limite:
+					return None
+
+	def close(self):
+		os.close(self.fd)
+
+
+def openSerial(device, baudrate=115200):
+	"""Opens a serial port in raw mode and returns a SerialLink for it
+	Parameters:
+	device -- the device of the port, for example /dev/ttyUSB0
+	baudrate -- the speed of the port
+	"""
+	if termios is None:
+		raise ImportError("SerialProgrammer::openSerial - serial ports are only supported on POSIX systems")
+	fd = os.open(device, os.O_RDWR | os.O_NOCTTY)
+	tty.setraw(fd)
+	velocidad = getattr(termios, "B%d" % baudrate, None)
+	if velocidad is None:
+		os.close(fd)
+		raise ValueError("SerialProgrammer::openSerial - Unsupported baudrate " + str(baudrate))
+	atributos = termios.tcgetattr(fd)
+	atributos[4] = atributos[5] = velocidad
+	termios.tcsetattr(fd, termios.TCSANOW, atributos)
+	return SerialLink(fd)
+
+
+class SerialCommandProgrammer(CommandProgrammer.CommandProgrammer):
+	"""ICSP controller for an adapter on a serial link, that clocks the bits itself.
+	The commands are sent as frames with sequence numbers. Up to window frames are sent
+	without waiting for their answers, so the link is kept busy. Frames lost or damaged are sent again.
+	"""
+
+	# tramas enviadas sin esperar respuesta
+	window = 8
+	# segundos que se espera una respuesta antes de repetir las tramas
+	timeout = 1.0
+	# veces que se repiten las tramas antes de dar el adaptador por perdido
+	retries = 3
+
+	def __init__(self, link, window=None):
+		"""Parameters:
+		link -- the SerialLink to the adapter
+		window -- frames sent without waiting for their answers
+		"""
+		self.link = link
+		if window is not None:
+			self.window = window
+		self.seq = 0
+		# tramas sin respuesta: (seq, trama, ficha, segundos extra de espera), en orden
+		self.pending = collections.deque()
+		# respuestas pedidas, por ficha
+		self.results = {}
+		self.tokens = 0
+		self.failures = 0
+		# tramas de las secuencias con clave ya codificadas
+		self.encoded = {}
+
+	def _send(self, codigo, datos="", respuesta=False, espera=0):
+		#envia una trama; si respuesta, devuelve la ficha con la que se recoge con _wait
+		while len(self.pending) >= self.window:
+			self._receive()
+		trama = makeFrame(SYNC_REQUEST, self.seq, codigo, datos)
+		ficha = None
+		if respuesta:
+			self.tokens += 1
+			ficha = self.tokens
+		self.pending.append((self.seq, trama, ficha, espera))
+		self.seq = (self.seq + 1) & 0xff
+		self.link.write(trama)
+		return ficha
+
+	def _receive(self):
+		#procesa la respuesta de la trama pendiente mas antigua
+		(seq, trama, ficha, espera) = self.pending[0]
+		respuesta = self.link.readFrame(SYNC_RESPONSE, self.timeout + espera)
+		if respuesta is None or respuesta == CORRUPT:
+			self._retransmit()
+			return
+		(rseq, estado, datos) = respuesta
+		if rseq != seq:
+			#respuesta repetida de una trama ya contestada
+			return
+		if estado == NAK:
+			self._retransmit()
+			return
+		self.pending.popleft()
+		self.failures = 0
+		if ficha is not None:
+			self.results[ficha] = (estado, datos)
+		elif estado != OK:
+			raise IOError("SerialCommandProgrammer - the adapter rejected a frame, status " + str(estado))
+
+	def _retransmit(self):
+		#go-back-N: se repiten todas las tramas pendientes
+		self.failures += 1
+		if self.failures > self.retries:
+			raise IOError("SerialCommandProgrammer - the adapter does not answer")
+		for (seq, trama, ficha, espera) in self.pending:
+			self.link.write(trama)
+
+	def _wait(self, ficha):
+		#devuelve (estado, datos) de la respuesta de una trama
+		while ficha not in self.results:
+			self._receive()
+		return self.results.pop(ficha)
+
+	def _sync(self):
+		#espera a que el adaptador conteste todas las tramas enviadas
+		while self.pending:
+			self._receive()
+
+	def flush(self):
+		"""Waits until the adapter has run every command sent."""
+		self._sync()
+
+	def setBuffered(self, buffered, flushEachSix=True):
+		"""The commands are always sent in frames, see window"""
+		pass
+
+	def enterICSP(self, clave=None):
+		"""Puts the MCU in ICSP mode, ready to accept instructions.
+		Parameters:
+		clave -- the 32-bit key to send, ICSPmagicCode by default
+		"""
+		if clave is None:
+			clave = self.ICSPmagicCode
+		self._send(ENTER, struct.pack(">I", clave), espera=0.1)
+		self._sync()
+
+	def leaveICSP(self):
+		"""Stops the ICSP mode."""
+		self._send(LEAVE)
+		self._sync()
+
+	def startPic(self):
+		"""Applies VDD and sets MCLR to 1"""
+		self._send(START)
+		self._sync()
+
+	def stopPic(self):
+		"""Removes VDD and sets MCLR to 0"""
+		self._send(STOP)
+		self._sync()
+
+	def SIX(self, comando, primera_ejecucion=False):
+		"""SIX, sends a command to the MCU
+		Parameters:
+		comando -- the command in 24-bit format
+		primera_ejecucion -- If True, adds 5 extra clocks for the first instruction, as indicated in the datasheet.
+		"""
+		codigo = SIX
+		if primera_ejecucion:
+			codigo = SIX_FIRST
+		self._send(codigo, struct.pack("<I", comando & 0xffffff)[:3])
+
+	def REGOUT(self):
+		"""REGOUT, extracts VISI register from the MCU"""
+		(estado, datos) = self._wait(self._send(REGOUT, chr(1), True))
+		return struct.unpack("<H", str(datos))[0]
+
+	def encode(self, stream):
+		"""Returns the frames of an InstructionStream as a list of (command, payload, REGOUTs)"""
+		if stream.clave is not None and stream.clave in self.encoded:
+			return self.encoded[stream.clave]
+		tramas = []
+		for tramo in stream.segments():
+			if tramo is None:
+				#los REGOUT seguidos van en la misma trama
+				if tramas and tramas[-1][0] == REGOUT and tramas[-1][2] < WORDS_PER_FRAME:
+					n = tramas[-1][2] + 1
+					tramas[-1] = (REGOUT, chr(n), n)
+				else:
+					tramas.append((REGOUT, chr(1), 1))
+				continue
+			comandos = []
+			i = 0
+			while i < len(tramo):
+				#los NOP seguidos se mandan como un numero
+				j = i
+				while j < len(tramo) and tramo[j] == 0:
+					j += 1
+				if j - i >= 2:
+					self._encodeSIX(tramas, comandos)
+					comandos = []
+					tramas.append((NOPS, struct.pack("<H", j - i), 0))
+					i = j
+					continue
+				comandos.append(tramo[i])
+				i += 1
+			self._encodeSIX(tramas, comandos)
+		if stream.clave is not None:
+			self.encoded[stream.clave] = tramas
+		return tramas
+
+	def _encodeSIX(self, tramas, comandos):
+		for i in range(0, len(comandos), SIX_PER_FRAME):
+			datos = "".join([struct.pack("<I", comando)[:3] for comando in comandos[i:i + SIX_PER_FRAME]])
+			tramas.append((SIX, datos, 0))
+
+	def execute(self, *streams):
+		"""Runs one or more InstructionStreams. Their frames are sent one after another, the REGOUTs
+		included, and the answers are collected at the end.
+		Returns the list of the values read by the REGOUTs of the streams
+		"""
+		fichas = []
+		for stream in streams:
+			for (codigo, datos, n) in self.encode(stream):
+				ficha = self._send(codigo, datos, n > 0)
+				if n > 0:
+					fichas.append((ficha, n))
+		res = []
+		for (ficha, n) in fichas:
+			(estado, datos) = self._wait(ficha)
+			res.extend(struct.unpack("<%dH" % n, str(datos)))
+		return res
+
+
+class SerialEnhancedCommandProgrammer(SerialCommandProgrammer, CommandProgrammer.EnhancedCommandProgrammer):
+	"""Enhanced ICSP controller for an adapter on a serial link.
+	The words of the Programming Executive commands and responses are sent in frames too.
+	"""
+
+	def enterEICSP(self):
+		"""Puts the MCU in Enhanced ICSP mode, running the Programming Executive."""
+		self.enterICSP(self.EICSPmagicCode)
+		time.sleep(0.025) #P7
+
+	def sendWord(self, palabra):
+		"""Sends a 16-bit word to the Programming Executive"""
+		self._send(SEND, struct.pack("<H", palabra & 0xffff))
+
+	def receiveWord(self):
+		"""Receives a 16-bit word from the Programming Executive"""
+		return self._receiveWords(1)[0]
+
+	def _receiveWords(self, n):
+		res = []
+		for i in range(0, n, WORDS_PER_FRAME):
+			m = min(WORDS_PER_FRAME, n - i)
+			(estado, datos) = self._wait(self._send(RECEIVE, chr(m), True))
+			res.extend(struct.unpack("<%dH" % m, str(datos)))
+		return res
+
+	def waitResponse(self, timeout=None):
+		"""Waits until the Programming Executive pulls PGD low to signal that the response is ready.
+		Returns False if it does not happen before timeout seconds.
+		"""
+		if timeout is None:
+			timeout = self.responseTimeout
+		milisegundos = min(int(timeout * 1000), 0xffff)
+		(estado, datos) = self._wait(self._send(WAIT, struct.pack("<H", milisegundos), True, timeout))
+		return estado == OK
+
+	def command(self, opcode, args=[], timeout=None):
+		"""Sends a command to the Programming Executive and receives its response.
+		See EnhancedCommandProgrammer.command
+		"""
+		palabras = [(opcode << 12) | (1 + len(args))] + [palabra & 0xffff for palabra in args]
+		for i in range(0, len(palabras), WORDS_PER_FRAME):
+			trozo = palabras[i:i + WORDS_PER_FRAME]
+			self._send(SEND, struct.pack("<%dH" % len(trozo), *trozo))
+
+		if not self.waitResponse(timeout):
+			return None
+
+		(cabecera, longitud) = self._receiveWords(2)
+		datos = self._receiveWords(max(longitud - 2, 0))
+		return cabecera, datos
+
+
+class SerialAdapter(threading.Thread):
+	"""Stand-in for the adapter firmware, for testing without hardware.
+	It serves the frames received on a link, clocking the bits through a bit-bang controller
+	(usually a BitBangEmulator.BitBangEmulator).
+	"""
+
+	def __init__(self, link, bb):
+		"""Parameters:
+		link -- the SerialLink the frames are received from
+		bb -- the bit-bang controller of the ICSP lines
+		"""
+		threading.Thread.__init__(self)
+		self.daemon = True
+		self.link = link
+		self.c = CommandProgrammer.EnhancedCommandProgrammer()
+		self.c.setBigBangProgrammer(bb)
+		self.c.setBuffered(True, False)
+		self.running = True
+		self.expected = 0
+		# True tras un NAK, hasta recibir la trama esperada
+		self.rejecting = False
+		# ultimas respuestas enviadas, por seq
+		self.responses = {}
+		self.frames = 0
+
+	def run(self):
+		while self.running:
+			trama = self.link.readFrame(SYNC_REQUEST, 0.1)
+			if trama is None:
+				continue
+			if trama == CORRUPT:
+				self._reject()
+				continue
+			(seq, codigo, datos) = trama
+			if seq == self.expected:
+				(estado, respuesta) = self.handle(codigo, datos)
+				self.c.flush()
+				trama = makeFrame(SYNC_RESPONSE, seq, estado, respuesta)
+				self.responses[seq] = trama
+				self.responses.pop((seq - 128) & 0xff, None)
+				self.expected = (seq + 1) & 0xff
+				self.rejecting = False
+				self.frames += 1
+				self.link.write(trama)
+			elif seq in self.responses and 0 < ((self.expected - seq) & 0xff) <= 128:
+				#trama repetida, ya ejecutada
+				self.link.write(self.responses[seq])
+			else:
+				self._reject()
+
+	def _reject(self):
+		#un solo NAK por cada hueco
+		if not self.rejecting:
+			self.rejecting = True
+			self.link.write(makeFrame(SYNC_RESPONSE, self.expected, NAK))
+
+	def handle(self, codigo, datos):
+		"""Runs a command and returns its answer as a pair (status, payload)"""
+		c = self.c
+		datos = str(datos)
+		if codigo == ENTER and len(datos) == 4:
+			c.enterICSP(struct.unpack(">I", datos)[0])
+		elif codigo == LEAVE:
+			c.leaveICSP()
+		elif codigo == START:
+			c.startPic()
+		elif codigo == STOP:
+			c.stopPic()
+		elif codigo in (SIX, SIX_FIRST) and len(datos) % 3 == 0:
+			for i in range(0, len(datos), 3):
+				c.SIX(struct.unpack("<I", datos[i:i + 3] + "\0")[0], codigo == SIX_FIRST)
+		elif codigo == NOPS and len(datos) == 2:
+			for i in range(struct.unpack("<H", datos)[0]):
+				c.SIX(0)
+		elif codigo == REGOUT and len(datos) == 1:
+			valores = [c.REGOUT() for i in range(ord(datos))]
+			return (OK, struct.pack("<%dH" % len(valores), *valores))
+		elif codigo == SEND and len(datos) % 2 == 0:
+			for palabra in struct.unpack("<%dH" % (len(datos) / 2), datos):
+				c.sendWord(palabra)
+		elif codigo == RECEIVE and len(datos) == 1:
+			valores = [c.receiveWord() for i in range(ord(datos))]
+			return (OK, struct.pack("<%dH" % len(valores), *valores))
+		elif codigo == WAIT and len(datos) == 2:
+			if not c.waitResponse(struct.unpack("<H", datos)[0] / 1000.0):
+				return (TIMEOUT, "")
+		else:
+			return (UNKNOWN, "")
+		return (OK, "")
+
+	def close(self):
+		"""Stops serving frames"""
+		self.running = False
+		self.join()
+
+
+def openEmulatedAdapter(bb):
+	"""Starts a SerialAdapter driving bb on a pseudo-terminal, as if it were attached to a serial port.
+	Returns a pair (device, adapter), device being the name of the serial port to open
+	"""
+	if termios is None:
+		raise ImportError("SerialProgrammer::openEmulatedAdapter - pseudo-terminals are only supported on POSIX systems")
+	(maestro, esclavo) = pty.openpty()
+	tty.setraw(esclavo)
+	adaptador = SerialAdapter(SerialLink(maestro), bb)
+	# el extremo del puerto se mantiene abierto para que el pty no se cierre
+	adaptador.slave = esclavo
+	adaptador.start()
+	atexit.register(adaptador.close)
+	return (os.ttyname(esclavo), adaptador)
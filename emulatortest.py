@@ -0,0 +1,443 @@
+# -*- coding: utf-8 -*-
+'''Tests of the programmer against the emulated chip of BitBangEmulator, no hardware needed.
+Run it after any change to BitBang, CommandProgrammer or pic24programmer: the flash of the
+emulator is checked after every operation, so a faster waveform that breaks the protocol shows up here.
+'''
+
+import sys
+import os
+import tempfile
+import mmap
+import shutil
+import types
+
+import BitBangEmulator
+import BitBangTrace
+import ImageCache
+import CommandProgrammer
+import intelhex
+import pic24programmer
+
+errores = []
+
+def comprobar(condicion, mensaje):
+	if not condicion:
+		print "error en " + mensaje
+		errores.append(mensaje)
+
+def silencio(region, porcentaje):
+	pass
+
+def programador(enhanced, extended=False):
+	bb = BitBangEmulator.BitBangEmulator(executive=True, extended=extended)
+	if enhanced:
+		cp = CommandProgrammer.EnhancedCommandProgrammer()
+		p = CommandProgrammer.EnhancedProgrammer()
+		if extended:
+			p.extraCommands = (cp.ERASEP, cp.CRCP)
+	else:
+		cp = CommandProgrammer.CommandProgrammer()
+		p = CommandProgrammer.Programmer()
+	cp.setBigBangProgrammer(bb)
+	cp.setBuffered(True, False)
+	p.setCommandProgrammer(cp)
+	return (p, bb)
+
+def imagen(semilla=0):
+	#filas 0 y 1 de la pagina 0, fila 9 de la pagina 1 y los registros de configuracion
+	extractor = pic24programmer.extractor24bits(intelhex.IntelHex())
+	for fila in (0, 1, 9):
+		for i in range(64):
+			extractor[fila * 64 + i] = (fila << 16 | i << 8 | semilla) & 0xffffff
+	for i in range(12):
+		extractor[(0xf80000 >> 1) + i] = 0xc0 | i
+	return extractor
+
+def fila(bb, n):
+	return [bb.read_word((n * 64 + i) << 1) for i in range(64)]
+
+def test1(enhanced):
+	#escritura, verificacion y lectura
+	nombre = "test 1 (enhanced=%s)" % enhanced
+	(p, bb) = programador(enhanced)
+	extractor = imagen()
+	pic24programmer.escribir(p, extractor, silencio, "bulk")
+	for n in (0, 1, 9):
+		comprobar(fila(bb, n) == list(extractor[n * 64:n * 64 + 64]), nombre + ": fila %d escrita" % n)
+	comprobar(fila(bb, 2) == [0xffffff] * 64, nombre + ": fila 2 borrada")
+	comprobar(pic24programmer.verificar(p, extractor, silencio) == [], nombre + ": verificacion")
+
+	p.begin()
+	leido = p.readMem(9 * 64 << 1, 64)
+	bloques = list(p.readBlocks(0, 3 * 64))
+	config = p.readConfigMem()
+	p.end()
+	comprobar(leido == fila(bb, 9), nombre + ": lectura de la fila 9")
+	comprobar([d for (d, datos) in bloques] == [0, 128, 256], nombre + ": direcciones de readBlocks")
+	comprobar(sum([list(datos) for (d, datos) in bloques], []) == fila(bb, 0) + fila(bb, 1) + fila(bb, 2), nombre + ": lectura por bloques")
+	comprobar([c & 0xff for c in config] == [0xc0 | i for i in range(12)], nombre + ": registros de configuracion")
+
+	#un cambio en la imagen se detecta
+	extractor[9 * 64 + 5] = 0x123456
+	diferencias = pic24programmer.verificar(p, extractor, silencio)
+	comprobar(diferencias == [(9 * 64 + 5, 0x123456, (9 << 16) | (5 << 8))], nombre + ": verificacion de una diferencia")
+
+def test2(enhanced):
+	#escritura incremental: solo se reescriben las paginas que cambian
+	nombre = "test 2 (enhanced=%s)" % enhanced
+	(p, bb) = programador(enhanced)
+	extractor = imagen()
+	pic24programmer.escribir(p, extractor, silencio, "pages")
+
+	extractor[9 * 64 + 5] = 0x123456
+	paginas = pic24programmer.escribirIncremental(p, extractor, silencio)
+	comprobar(paginas == [512], nombre + ": paginas reescritas " + str(paginas))
+	comprobar(pic24programmer.verificar(p, extractor, silencio) == [], nombre + ": verificacion")
+	comprobar(pic24programmer.escribirIncremental(p, extractor, silencio) == [], nombre + ": nada que reescribir")
+
+def test3(enhanced):
+	#borrado de filas, conservando las demas filas de la pagina
+	nombre = "test 3 (enhanced=%s)" % enhanced
+	(p, bb) = programador(enhanced)
+	extractor = imagen()
+	pic24programmer.escribir(p, extractor, silencio, "bulk")
+	fila0 = fila(bb, 0)
+
+	p.begin()
+	p.eraseRows(1 * 64 << 1)
+	p.end()
+	comprobar(fila(bb, 0) == fila0, nombre + ": fila 0 conservada")
+	comprobar(fila(bb, 1) == [0xffffff] * 64, nombre + ": fila 1 borrada")
+	comprobar(fila(bb, 9) == list(extractor[9 * 64:10 * 64]), nombre + ": fila 9 conservada")
+
+	p.begin()
+	p.erasePages(0)
+	p.end()
+	comprobar(fila(bb, 0) == [0xffffff] * 64, nombre + ": pagina 0 borrada")
+	comprobar(fila(bb, 9) == list(extractor[9 * 64:10 * 64]), nombre + ": pagina 1 conservada")
+
+	pic24programmer.borrar(p)
+	comprobar(fila(bb, 9) == [0xffffff] * 64, nombre + ": chip borrado")
+
+def test4():
+	#un PROGP rechazado por el programming executive detiene la escritura
+	nombre = "test 4"
+	(p, bb) = programador(True)
+	extractor = imagen()
+	pic24programmer.escribir(p, extractor, silencio, "bulk")
+	#sin borrar, los bits a 0 no vuelven a 1 y la fila no se puede programar
+	extractor = imagen(0xff)
+	extractor[0xf80000 >> 1] = 0x80
+	try:
+		pic24programmer.escribir(p, extractor, silencio)
+		comprobar(False, nombre + ": escritura rechazada")
+	except IOError:
+		pass
+	comprobar(p.depth == 0, nombre + ": transaccion terminada")
+	comprobar(bb.read_word(0xf80000) == 0xc0, nombre + ": registros de configuracion sin escribir")
+
+def operacionesTrazadas(buffered):
+	#identifica el chip y escribe y lee una fila, grabando una traza con las operaciones marcadas.
+	#Devuelve las estadisticas de la traza y los flancos decodificados por el emulador en cada operacion
+	(p, bb) = programador(False)
+	p.c.setBuffered(buffered, False)
+	(fd, traza) = tempfile.mkstemp(".trace")
+	os.close(fd)
+	grabador = BitBangTrace.BitBangRecorder(bb, traza)
+	p.c.setBigBangProgrammer(grabador)
+	BitBangTrace.markOperations(p, grabador)
+	marcas = []
+	marcar = grabador.mark
+	def marca(texto):
+		marcar(texto)
+		marcas.append((texto, bb.edges))
+	grabador.mark = marca
+
+	pic24programmer.identificar(p)
+	p.begin()
+	p.writeMem(0, range(64))
+	p.readMem(0, 64)
+	p.end()
+	grabador.close()
+
+	flancos = {}
+	abiertas = []
+	for (texto, n) in marcas:
+		if texto[0] == "+":
+			abiertas.append((texto[1:], n))
+		else:
+			for i in range(len(abiertas) - 1, -1, -1):
+				if abiertas[i][0] == texto[1:]:
+					flancos[texto[1:]] = flancos.get(texto[1:], 0) + n - abiertas[i][1]
+					del abiertas[i]
+					break
+	estadisticas = BitBangTrace.traceStats(traza)
+	os.remove(traza)
+	return (estadisticas, flancos)
+
+def test5():
+	#sin buffer el emulador decodifica cada estado al aplicarlo: los flancos que ve en cada operacion
+	#deben ser los de la traza grabada con buffer
+	nombre = "test 5"
+	(estadisticas, flancos) = operacionesTrazadas(True)
+	(referencia, esperado) = operacionesTrazadas(False)
+	for operacion in ("enter", "leave", "readMem", "readDevId", "writeMem", "writeDone"):
+		comprobar(operacion in esperado and estadisticas[operacion]["edges"] == esperado[operacion],
+			nombre + ": flancos de %s: %s en la traza, %s en el emulador" % (operacion, estadisticas.get(operacion, {}).get("edges"), esperado.get(operacion)))
+	comprobar(estadisticas["total"]["edges"] == referencia["total"]["edges"], nombre + ": flancos de la traza")
+
+def test6():
+	#con un executive sin ERASEP ni CRCP (el de los PIC24H/dsPIC33F) no se envian: se borra en modo ICSP
+	#y se verifica leyendo. Con uno que los tiene, se usan
+	for extended in (False, True):
+		nombre = "test 6 (extended=%s)" % extended
+		(p, bb) = programador(True, extended)
+		extractor = imagen()
+		pic24programmer.escribir(p, extractor, silencio, "pages")
+		extractor[9 * 64 + 5] = 0x123456
+		bb.reset_stats()
+		paginas = pic24programmer.escribirIncremental(p, extractor, silencio)
+		comprobar(paginas == [512], nombre + ": paginas reescritas " + str(paginas))
+		comprobar(pic24programmer.verificar(p, extractor, silencio) == [], nombre + ": verificacion")
+		p.begin()
+		crc = p.crc(0, 64)
+		p.end()
+		comprobar((crc is not None) == extended, nombre + ": crc " + str(crc))
+		if extended:
+			comprobar(crc == CommandProgrammer.crc16(fila(bb, 0)), nombre + ": valor del crc")
+
+def test7():
+	#una escritura o un borrado que no terminan (WR no baja) detienen la operacion
+	for (operacion, latencia, funcion) in ((BitBangEmulator.NVM_WRITE_ROW, 0.1, lambda p: pic24programmer.escribir(p, imagen(), silencio)),
+			(BitBangEmulator.NVM_ERASE_BULK, 1.0, pic24programmer.borrar)):
+		nombre = "test 7 (NVMCON %#x)" % operacion
+		(p, bb) = programador(False)
+		bb.latencies[operacion] = latencia
+		try:
+			funcion(p)
+			comprobar(False, nombre + ": timeout")
+		except IOError:
+			pass
+		comprobar(p.depth == 0, nombre + ": transaccion terminada")
+
+def test8():
+	#abandonar una lectura o una verificacion a medias termina la transaccion
+	nombre = "test 8"
+	(p, bb) = programador(False)
+	extractor = imagen()
+	pic24programmer.escribir(p, extractor, silencio, "bulk")
+	bloques = pic24programmer.leerBloques(p, silencio)
+	bloques.next()
+	bloques.close()
+	comprobar(p.depth == 0, nombre + ": lectura abandonada")
+	pasos = pic24programmer.verificarPasos(p, extractor, silencio)
+	pasos.next()
+	pasos.close()
+	comprobar(p.depth == 0, nombre + ": verificacion abandonada")
+
+def test9():
+	#el extractor lee las palabras de los tramos de la imagen, con los huecos rellenos, sin copiarla
+	nombre = "test 9"
+	ih = intelhex.IntelHex()
+	for (inicio, n) in ((0, 300), (1022, 9), (4096 + 2, 513), (70000, 64)):
+		ih.puts(inicio, "".join([chr((inicio + i) * 7 & 0xff) for i in range(n)]))
+	(fd, fichero) = tempfile.mkstemp(".bin")
+	os.write(fd, "\x12\x34\x56\x00" * 200)
+	mapa = mmap.mmap(fd, 0, access=mmap.ACCESS_COPY)
+	os.close(fd)
+	ih.putmap(20000, mapa)
+	extractor = pic24programmer.extractor24bits(ih)
+	palabra = lambda i: ih[i << 2] | ih[(i << 2) + 1] << 8 | ih[(i << 2) + 2] << 16 | ih[(i << 2) + 3] << 24
+	for (inicio, fin) in ((0, 64), (60, 300), (250, 1200), (4990, 5100), (17490, 17600), (0, 0)):
+		comprobar(list(extractor[inicio:fin]) == [palabra(i) for i in range(inicio, fin)], nombre + ": palabras de %d a %d" % (inicio, fin))
+	filas = [i for i in range(0, 18000, 64) if [palabra(j) for j in range(i, i + 64)] != [0xffffffff] * 64]
+	comprobar(extractor.filas() == filas, nombre + ": filas con datos " + str(extractor.filas()))
+	extractor[3000] = 0x123456
+	comprobar(extractor[3000] == 0x123456 and 2944 in extractor.filas(), nombre + ": palabra nueva")
+	mapa.close()
+	os.remove(fichero)
+
+def test10(enhanced):
+	#escritura, verificacion y lectura a traves del adaptador serie emulado
+	nombre = "test 10 (enhanced=%s)" % enhanced
+	p = pic24programmer.createProgrammer("SerialEmulator", enhanced)
+	bb = p.adapter.c.bb
+	extractor = imagen()
+	pic24programmer.escribir(p, extractor, silencio, "bulk")
+	for n in (0, 1, 9):
+		comprobar(fila(bb, n) == list(extractor[n * 64:n * 64 + 64]), nombre + ": fila %d escrita" % n)
+	comprobar(pic24programmer.verificar(p, extractor, silencio) == [], nombre + ": verificacion")
+	p.begin()
+	leido = p.readMem(9 * 64 << 1, 64)
+	p.end()
+	comprobar(leido == fila(bb, 9), nombre + ": lectura de la fila 9")
+	p.adapter.close()
+	p.c.link.close()
+
+def test11():
+	#una trama perdida y otra danada: el adaptador contesta NAK y se repiten las tramas pendientes
+	nombre = "test 11"
+	p = pic24programmer.createProgrammer("SerialEmulator", True)
+	bb = p.adapter.c.bb
+	enviadas = [0]
+	escribir = p.c.link.write
+	def escribirConFallos(trama):
+		enviadas[0] += 1
+		if enviadas[0] == 10:
+			return
+		if enviadas[0] == 20:
+			trama = trama[:-1] + chr((ord(trama[-1]) + 1) & 0xff)
+		escribir(trama)
+	p.c.link.write = escribirConFallos
+	naks = []
+	contestar = p.adapter.link.write
+	def contestarContando(trama):
+		if ord(trama[2]) == 0x01:
+			naks.append(ord(trama[1]))
+		contestar(trama)
+	p.adapter.link.write = contestarContando
+
+	extractor = imagen()
+	pic24programmer.escribir(p, extractor, silencio, "bulk")
+	comprobar(naks != [], nombre + ": NAK del adaptador " + str(naks))
+	comprobar(enviadas[0] > p.adapter.frames, nombre + ": tramas repetidas")
+	for n in (0, 1, 9):
+		comprobar(fila(bb, n) == list(extractor[n * 64:n * 64 + 64]), nombre + ": fila %d escrita" % n)
+	comprobar(pic24programmer.verificar(p, extractor, silencio) == [], nombre + ": verificacion")
+	p.adapter.close()
+	p.c.link.close()
+
+def test12():
+	#programarGrupo devuelve el resultado de cada puerto, y un puerto que falla no detiene a los demas.
+	#Cada puerto tiene un chip emulado nuevo, en su propio proceso
+	nombre = "test 12"
+	puertos = [0, 1, 2]
+	extractor = imagen()
+	avisos = []
+	aviso = lambda puerto, ok, resultado: avisos.append(puerto)
+	for (comando, borrado) in (("identify", None), ("write", "bulk"), ("verify", None), ("read", None)):
+		del avisos[:]
+		res = pic24programmer.programarGrupo("Emulator", puertos, comando, extractor, True, borrado, aviso)
+		comprobar(sorted(res) == puertos and sorted(avisos) == puertos, nombre + ": puertos de " + comando)
+		for puerto in puertos:
+			(ok, resultado) = res.get(puerto, (None, None))
+			if comando == "identify":
+				comprobar(ok and resultado == pic24programmer.identificar(programador(True)[0]), nombre + ": identificacion del puerto %d" % puerto)
+			elif comando == "write":
+				comprobar((ok, resultado) == (True, None), nombre + ": escritura del puerto %d: %s" % (puerto, resultado))
+			elif comando == "verify":
+				#el chip no esta programado
+				esperado = pic24programmer.verificar(programador(True)[0], extractor, silencio)
+				comprobar(not ok and resultado == esperado, nombre + ": verificacion del puerto %d" % puerto)
+			else:
+				comprobar(not ok and isinstance(resultado, ValueError), nombre + ": comando desconocido en el puerto %d: %r" % (puerto, resultado))
+
+def test13(enhanced):
+	#programarIntercalado da los mismos resultados y deja la misma flash que cada comando ejecutado solo
+	nombre = "test 13 (enhanced=%s)" % enhanced
+	puertos = [0, 1]
+	extractor = imagen()
+	comandos = (("identify", pic24programmer.identificar),
+		("write", lambda p: pic24programmer.escribir(p, extractor, silencio, "bulk")),
+		("update", lambda p: pic24programmer.escribirIncremental(p, extractor, silencio)),
+		("verify", lambda p: pic24programmer.verificar(p, extractor, silencio)),
+		("erase", pic24programmer.borrar))
+	#se guardan los programadores creados, para ver la flash de cada chip emulado
+	crear = pic24programmer.createProgrammer
+	creados = []
+	def crearGuardando(*argumentos):
+		creados.append(crear(*argumentos))
+		return creados[-1]
+	pic24programmer.createProgrammer = crearGuardando
+	try:
+		for (comando, funcion) in comandos:
+			del creados[:]
+			res = pic24programmer.programarIntercalado("Emulator", puertos, comando, extractor, enhanced, "bulk", lambda puerto, ok, resultado: None)
+			(p, bb) = programador(enhanced)
+			esperado = funcion(p)
+			if comando == "verify":
+				esperado = (esperado == [], esperado)
+			else:
+				esperado = (True, esperado)
+			for (puerto, prg) in zip(puertos, creados):
+				comprobar(res[puerto] == esperado, nombre + ": resultado de %s en el puerto %d: %s" % (comando, puerto, res[puerto]))
+				comprobar(prg.c.bb.flash == bb.flash, nombre + ": flash tras %s en el puerto %d" % (comando, puerto))
+			comprobar(len(creados) == len(puertos), nombre + ": programadores de " + comando)
+	finally:
+		pic24programmer.createProgrammer = crear
+
+def test14():
+	#la cache de imagenes: un fichero se decodifica una vez, las imagenes mas antiguas se borran al llenarse
+	#y un cambio en el codigo que decodifica las imagenes cambia la clave
+	nombre = "test 14"
+	directorio = tempfile.mkdtemp()
+	ficheros = []
+	for semilla in (1, 2):
+		ficheros.append(os.path.join(directorio, "%d.hex" % semilla))
+		imagen(semilla).mihex.tofile(ficheros[-1], "hex")
+	cache = ImageCache.ImageCache(os.path.join(directorio, "cache"), "1")
+
+	leido = pic24programmer.cargarImagen(ficheros[0], cache)
+	cacheado = pic24programmer.cargarImagen(ficheros[0], cache)
+	comprobar((cache.misses, cache.hits) == (1, 1), nombre + ": fallos y aciertos %d %d" % (cache.misses, cache.hits))
+	comprobar(cacheado.make_slices() == leido.make_slices() and cacheado.filas() == leido.filas(), nombre + ": rangos y filas")
+	(p, bb) = programador(True)
+	pic24programmer.escribir(p, cacheado, silencio, "bulk")
+	comprobar(pic24programmer.verificar(p, leido, silencio) == [], nombre + ": escritura de la imagen de la cache")
+	cacheado.close()
+
+	#con sitio para una sola imagen, la menos usada se borra
+	imagenes = os.path.join(directorio, "cache")
+	cache.limite = os.path.getsize(os.path.join(imagenes, os.listdir(imagenes)[0]))
+	os.utime(os.path.join(imagenes, os.listdir(imagenes)[0]), (0, 0))
+	pic24programmer.cargarImagen(ficheros[1], cache)
+	comprobar(len(os.listdir(imagenes)) == 1, nombre + ": imagenes en la cache " + str(os.listdir(imagenes)))
+	pic24programmer.cargarImagen(ficheros[0], cache).close()
+	pic24programmer.cargarImagen(ficheros[0], cache).close()
+	comprobar((cache.misses, cache.hits) == (3, 2), nombre + ": imagen borrada %d %d" % (cache.misses, cache.hits))
+
+	#un cambio en el fuente de un modulo da otra version, y las imagenes guardadas ya no se usan
+	fuente = os.path.join(directorio, "decodificador.py")
+	modulo = types.ModuleType("decodificador")
+	modulo.__file__ = fuente + "c"
+	versiones = []
+	for texto in ("A = 1\n", "A = 2\n"):
+		f = open(fuente, "w")
+		f.write(texto)
+		f.close()
+		versiones.append(ImageCache.sourceVersion([intelhex, modulo]))
+	comprobar(versiones[0] != versiones[1], nombre + ": version del codigo")
+	for version in versiones:
+		cache = ImageCache.ImageCache(imagenes, version)
+		pic24programmer.cargarImagen(ficheros[0], cache).close()
+		pic24programmer.cargarImagen(ficheros[0], cache).close()
+		comprobar((cache.misses, cache.hits) == (1, 1), nombre + ": imagen de la version " + version)
+	shutil.rmtree(directorio)
+
+
+def main():
+
+	for enhanced in (False, True):
+		test1(enhanced)
+		test2(enhanced)
+		test3(enhanced)
+	test4()
+	test5()
+	test6()
+	test7()
+	test8()
+	test9()
+	for enhanced in (False, True):
+		test10(enhanced)
+	test11()
+	test12()
+	for enhanced in (False, True):
+		test13(enhanced)
+	test14()
+	if errores:
+		print str(len(errores)) + " errores"
+		sys.exit(1)
+	print "OK"
+
+if __name__ == "__main__":
+    main()
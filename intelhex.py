@@ -48,14 +48,313 @@ __docformat__ = "javadoc"
 
 from array import array
 from binascii import hexlify, unhexlify
+from bisect import bisect_right
+import mmap
+
+
+class MappedRun:
+    ''' View of length bytes of a memory map from base, that SegmentedBuffer
+    uses as a run without copying the mapped bytes. Indexing gives ints and
+    slicing gives bytearrays, like a bytearray run. Bytes can be changed
+    but the length cannot: SegmentedBuffer copies the view into a bytearray
+    before growing it. Map the file with ACCESS_COPY to keep the changes
+    out of the file.
+    '''
+
+    def __init__(self, m, base=0, length=None):
+        if length is None:
+            length = len(m) - base
+        self._map = m
+        self._base = int(base)
+        self._length = int(length)
+
+    def __len__(self):
+        return self._length
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            start, stop, step = i.indices(self._length)
+            return bytearray(self._map[self._base+start:self._base+max(start, stop)])
+        if i < 0:
+            i += self._length
+        if not 0 <= i < self._length:
+            raise IndexError('MappedRun index out of range')
+        return ord(self._map[self._base+i])
+
+    def __setitem__(self, i, value):
+        if isinstance(i, slice):
+            start, stop, step = i.indices(self._length)
+            if len(value) != stop - start:
+                raise ValueError('MappedRun cannot change its length')
+            self._map[self._base+start:self._base+stop] = str(bytearray(value))
+            return
+        if i < 0:
+            i += self._length
+        if not 0 <= i < self._length:
+            raise IndexError('MappedRun index out of range')
+        self._map[self._base+i] = chr(value)
+
+    def view(self, start, stop):
+        ''' Read-only buffer over the bytes from start to stop, not copied. '''
+        return buffer(self._map, self._base+start, stop-start)
+#/MappedRun
+
+
+def _view(run, start, stop):
+    ''' Read-only buffer over the bytes from start to stop of a run of
+    SegmentedBuffer, bytearray or MappedRun, without copying them.
+    '''
+    if isinstance(run, MappedRun):
+        return run.view(start, stop)
+    return buffer(run, start, stop-start)
+
+
+class SegmentedBuffer:
+    ''' Byte storage made of sorted runs of contiguous addresses.
+
+    Each run is a bytearray, so a byte takes one byte of memory instead of
+    a dictionary entry. A byte is found with a binary search over the start
+    addresses of the runs. Writes next to a run extend it, and two runs are
+    merged when a write fills the gap between them.
+
+    A run can also be a MappedRun over a memory map (see map), which is
+    only copied into a bytearray if it has to grow. The buffer owns the
+    maps it is given, and close() closes them.
+
+    It behaves as the dictionary address -> byte it replaces: get(),
+    [], in, len() and keys(). The number of bytes and the address bounds
+    are kept up to date on every write, and the runs in an address range
+    are found by binary search (see segments).
+    '''
+
+    def __init__(self):
+        self._starts = []       # start address of each run, sorted
+        self._runs = []         # bytearray of each run
+        self._last = -1         # index of the last run used
+        self._count = 0         # number of bytes stored
+        self._maps = []         # memory maps owned, closed by close()
+
+    def _find(self, addr):
+        ''' Index of the run holding addr, or -1. '''
+        i = self._last
+        if i >= 0:
+            start = self._starts[i]
+            if start <= addr < start + len(self._runs[i]):
+                return i
+        i = bisect_right(self._starts, addr) - 1
+        if i >= 0 and addr < self._starts[i] + len(self._runs[i]):
+            self._last = i
+            return i
+        return -1
+
+    def _own(self, i):
+        ''' Run i as a bytearray, copying it if it is a MappedRun. '''
+        run = self._runs[i]
+        if not isinstance(run, bytearray):
+            run = self._runs[i] = run[:]
+        return run
+
+    def get(self, addr, default=None):
+        ''' Get byte at addr, or default if there is no data there. '''
+        i = self._last
+        if i >= 0:
+            ofs = addr - self._starts[i]
+            if 0 <= ofs < len(self._runs[i]):
+                return self._runs[i][ofs]
+        i = self._find(addr)
+        if i < 0:
+            return default
+        return self._runs[i][addr - self._starts[i]]
+
+    def __getitem__(self, addr):
+        i = self._find(addr)
+        if i < 0:
+            raise KeyError(addr)
+        return self._runs[i][addr - self._starts[i]]
+
+    def __contains__(self, addr):
+        return self._find(addr) >= 0
+
+    def __setitem__(self, addr, byte):
+        i = self._last
+        if i >= 0:
+            run = self._runs[i]
+            ofs = addr - self._starts[i]
+            if 0 <= ofs < len(run):
+                run[ofs] = byte
+                return
+            if ofs == len(run) and (i + 1 == len(self._starts)
+                                    or self._starts[i+1] > addr + 1):
+                self._own(i).append(byte)
+                self._count += 1
+                return
+        i = self._find(addr)
+        if i >= 0:
+            self._runs[i][addr - self._starts[i]] = byte
+            return
+
+        self._count += 1
+        starts = self._starts
+        runs = self._runs
+        i = bisect_right(starts, addr) - 1
+        nxt = i + 1
+        joins_next = nxt < len(starts) and starts[nxt] == addr + 1
+        if i >= 0 and starts[i] + len(runs[i]) == addr:
+            # extend the previous run, merging the next one if it touches
+            self._own(i).append(byte)
+            if joins_next:
+                runs[i].extend(runs[nxt][:])
+                del starts[nxt]
+                del runs[nxt]
+            self._last = i
+        elif joins_next:
+            self._own(nxt).insert(0, byte)
+            starts[nxt] = addr
+            self._last = nxt
+        else:
+            starts.insert(nxt, addr)
+            runs.insert(nxt, bytearray([byte]))
+            self._last = nxt
+
+    def write(self, addr, data):
+        ''' Set the bytes data from addr on.
+        @param  addr    address of the first byte.
+        @param  data    bytearray, array('B') or list of bytes.
+        '''
+        n = len(data)
+        if n == 0:
+            return
+        starts = self._starts
+        runs = self._runs
+        # runs overlapping or touching [addr, addr+n)
+        first = bisect_right(starts, addr) - 1
+        if first < 0 or starts[first] + len(runs[first]) < addr:
+            first += 1
+        last = bisect_right(starts, addr + n) - 1
+        if first > last:
+            starts.insert(first, addr)
+            runs.insert(first, bytearray(data))
+            self._last = first
+            self._count += n
+            return
+        if first == last and starts[first] <= addr:
+            # inside or at the end of a run
+            run = runs[first]
+            ofs = addr - starts[first]
+            if ofs + n > len(run):
+                self._count += ofs + n - len(run)
+                run = self._own(first)
+            run[ofs:ofs+n] = bytearray(data)
+            self._last = first
+            return
+        lo = min(starts[first], addr)
+        hi = max(starts[last] + len(runs[last]), addr + n)
+        merged = bytearray(hi - lo)
+        for i in xrange(first, last + 1):
+            ofs = starts[i] - lo
+            merged[ofs:ofs+len(runs[i])] = runs[i][:]
+            self._count -= len(runs[i])
+        merged[addr-lo:addr-lo+n] = bytearray(data)
+        self._count += len(merged)
+        starts[first:last+1] = [lo]
+        runs[first:last+1] = [merged]
+        self._last = first
+
+    def map(self, addr, m, base=0, length=None):
+        ''' Add length bytes of the memory map m from base as a run at addr,
+        without copying them. If there is data in that range already, the
+        bytes are copied over it instead.
+        @param  addr    address of the first byte.
+        @param  m       memory map (mmap object).
+        @param  base    offset of the first byte in m.
+        @param  length  number of bytes, up to the end of m if None.
+        '''
+        if not [mapped for mapped in self._maps if mapped is m]:
+            self._maps.append(m)
+        run = MappedRun(m, base, length)
+        n = len(run)
+        if n == 0:
+            return
+        i = bisect_right(self._starts, addr + n) - 1
+        if i >= 0 and self._starts[i] + len(self._runs[i]) >= addr:
+            # overlaps or touches a run
+            self.write(addr, run[:])
+            return
+        self._starts.insert(i + 1, addr)
+        self._runs.insert(i + 1, run)
+        self._count += n
+        self._last = i + 1
+
+    def close(self):
+        ''' Close the memory maps given to map. The runs over them are
+        removed, the bytes copied out of them are kept.
+        '''
+        if not self._maps:
+            return
+        for i in xrange(len(self._runs) - 1, -1, -1):
+            if isinstance(self._runs[i], MappedRun):
+                self._count -= len(self._runs[i])
+                del self._starts[i]
+                del self._runs[i]
+        self._last = -1
+        for m in self._maps:
+            m.close()
+        self._maps = []
+
+    def overlaps(self, addr, n):
+        ''' True if there is data in any of the n bytes from addr. '''
+        i = bisect_right(self._starts, addr + n - 1) - 1
+        return i >= 0 and self._starts[i] + len(self._runs[i]) > addr
+
+    def __len__(self):
+        return self._count
+
+    def keys(self):
+        ''' Sorted list of the addresses with data. '''
+        res = []
+        for start, run in zip(self._starts, self._runs):
+            res.extend(xrange(start, start + len(run)))
+        return res
+
+    def segments(self, start=None, end=None):
+        ''' List of (start address, bytearray) pairs, one for each run, sorted.
+        @param  start   if not None, only the runs ending at or after start.
+        @param  end     if not None, only the runs beginning at or before end.
+        '''
+        first = 0
+        last = len(self._starts)
+        if start is not None:
+            first = bisect_right(self._starts, start) - 1
+            if first < 0 or self._starts[first] + len(self._runs[first]) <= start:
+                first += 1
+        if end is not None:
+            last = bisect_right(self._starts, end)
+        return zip(self._starts[first:last], self._runs[first:last])
+
+    def minaddr(self):
+        ''' Lowest address with data, or None if empty. '''
+        if not self._starts:
+            return None
+        return self._starts[0]
+
+    def maxaddr(self):
+        ''' Highest address with data, or None if empty. '''
+        if not self._starts:
+            return None
+        return self._starts[-1] + len(self._runs[-1]) - 1
+#/SegmentedBuffer
 
 
 class IntelHex:
     ''' Intel HEX file reader. '''
 
-    def __init__(self, fname):
+    # bytes written at once by tobinfile
+    window = 65536
+
+    def __init__(self, fname=None):
         ''' Constructor.
-        @param  fname   file name of HEX file or file object.
+        @param  fname   file name of HEX file or file object,
+                        None for an empty object.
         '''
         #public members
         self.Error = None
@@ -66,7 +365,7 @@ class IntelHex:
 
         # private members
         self._fname = fname
-        self._buf = {}
+        self._buf = SegmentedBuffer()
         self._readed = False
         self._eof = False
         self._offset = 0
@@ -88,15 +387,11 @@ class IntelHex:
         self._offset = 0
         self._eof = False
 
-        result = True
-
-        for s in f:
-            if not self.decode_record(s):
-                result = False
-                break
-
-            if self._eof:
-                break
+        if hasattr(f, "read"):
+            lines = f.read().splitlines()
+        else:
+            lines = list(f)
+        result = self.decode_records(lines)
 
         if fclose:
             fclose()
@@ -104,6 +399,106 @@ class IntelHex:
         self._readed = result
         return result
 
+    def loadfile(self, fobj, format='hex'):
+        ''' Read file into internal buffer.
+        @param  fobj    file name or file object.
+        @param  format  'hex' for HEX file, 'bin' for raw binary file
+                        loaded at address 0.
+        @return True    if successful.
+        '''
+        if format == 'hex':
+            self._fname = fobj
+            self._readed = False
+            return self.readfile()
+        elif format == 'bin':
+            # files are memory mapped, other objects are read
+            if not hasattr(fobj, "read"):
+                f = file(fobj, "rb")
+            elif hasattr(fobj, "fileno"):
+                f = fobj
+            else:
+                self._buf.write(0, bytearray(fobj.read()))
+                self._readed = True
+                return True
+            try:
+                m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+            except ValueError:
+                # empty file
+                m = None
+            if f is not fobj:
+                f.close()
+            if m is not None:
+                self.putmap(0, m)
+            self._readed = True
+            return True
+        else:
+            raise ValueError('Unknown file format: %r' % format)
+
+    def decode_records(self, lines, batch=1024):
+        ''' Decode many records of HEX file, until the end-of-file record.
+        Data records are decoded a batch of lines at a time, and the
+        payloads of consecutive records are stored with a single write.
+        Other records, and batches with lines that are not plain HEX
+        records, are decoded by decode_record.
+        @param  lines   list of lines with HEX records.
+        @param  batch   number of lines decoded at once.
+        @return True    if all lines decode OK.
+                False   if some line is invalid, see decode_record.
+        '''
+        buf = self._buf
+        pending = None          # payload of consecutive data records
+        start = end = 0         # address range of pending
+
+        for first in xrange(0, len(lines), batch):
+            chunk = [s.rstrip('\r\n') for s in lines[first:first+batch]]
+            raw = None
+            for s in chunk:
+                if not s or s[0] != ':' or not len(s) & 1:
+                    break
+            else:
+                try:
+                    raw = bytearray(unhexlify(''.join([s[1:] for s in chunk])))
+                except TypeError:
+                    pass
+
+            ofs = 0
+            for s in chunk:
+                if raw is not None:
+                    length = len(s) >> 1
+                    record_length = raw[ofs]
+                    rec = ofs
+                    ofs += length
+                    if (length == 5 + record_length and raw[rec+3] == 0
+                            and sum(raw[rec:ofs]) & 0x0FF == 0):
+                        # data record
+                        addr = raw[rec+1]*256 + raw[rec+2] + self._offset
+                        if pending is not None and addr != end:
+                            buf.write(start, pending)
+                            pending = None
+                        if buf.overlaps(addr, record_length):
+                            for i in xrange(addr, addr + record_length):
+                                if i in buf:
+                                    self.AddrOverlap = i
+                        if pending is None:
+                            pending = raw[rec+4:ofs-1]
+                            start = addr
+                        else:
+                            pending += raw[rec+4:ofs-1]
+                        end = addr + record_length
+                        continue
+
+                if pending is not None:
+                    buf.write(start, pending)
+                    pending = None
+                if not self.decode_record(s):
+                    return False
+                if self._eof:
+                    return True
+
+        if pending is not None:
+            buf.write(start, pending)
+        return True
+
     def decode_record(self, s):
         ''' Decode one record of HEX file.
         @param  s       line with HEX record.
@@ -150,11 +545,12 @@ class IntelHex:
         if record_type == 0:
             # data record
             addr += self._offset
-            for i in xrange(4, 4+record_length):
-                if not self._buf.get(addr, None) is None:
-                    self.AddrOverlap = addr
-                self._buf[addr] = bin[i]
-                addr += 1       # FIXME: addr should be wrapped on 64K boundary
+            if self._buf.overlaps(addr, record_length):
+                for i in xrange(record_length):
+                    if addr + i in self._buf:
+                        self.AddrOverlap = addr + i
+            # FIXME: addr should be wrapped on 64K boundary
+            self._buf.write(addr, bin[4:4+record_length])
 
         elif record_type == 1:
             # end of file record
@@ -209,9 +605,9 @@ class IntelHex:
         """Return default values for start and end if they are None
         """
         if start is None:
-            start = min(self._buf.keys())
+            start = self._buf.minaddr()
         if end is None:
-            end = max(self._buf.keys())
+            end = self._buf.maxaddr()
         if start > end:
             start, end = end, start
         return start, end
@@ -229,13 +625,19 @@ class IntelHex:
 
         bin = array('B')
 
-        if self._buf == {}:
+        if len(self._buf.segments()) == 0:
             return bin
 
         start, end = self._get_start_end(start, end)
 
-        for i in xrange(start, end+1):
-            bin.append(self._buf.get(i, pad))
+        # the bytes of each run are copied once, from a buffer over them
+        for ofs, run in self._buf.segments(start, end):
+            lo = max(ofs, start)
+            hi = min(ofs + len(run), end + 1)
+            if lo < hi:
+                bin.fromstring(chr(pad) * (lo - start - len(bin)))
+                bin.fromstring(_view(run, lo-ofs, hi-ofs))
+        bin.fromstring(chr(pad) * (end + 1 - start - len(bin)))
 
         return bin
 
@@ -264,26 +666,44 @@ class IntelHex:
         else:
             fclose = None
 
-        fobj.write(self.tobinstr(start, end, pad))
+        # written in windows, not all at once
+        if len(self._buf.segments()) != 0:
+            start, end = self._get_start_end(start, end)
+            for window in xrange(start, end + 1, self.window):
+                fobj.write(self.tobinstr(window, min(window + self.window, end + 1) - 1, pad))
 
         if fclose:
             fclose()
 
     def minaddr(self):
         ''' Get minimal address of HEX content. '''
-        aa = self._buf.keys()
-        if aa == []:
+        aa = self._buf.minaddr()
+        if aa is None:
             return 0
         else:
-            return min(aa)
+            return aa
 
     def maxaddr(self):
         ''' Get maximal address of HEX content. '''
-        aa = self._buf.keys()
-        if aa == []:
+        aa = self._buf.maxaddr()
+        if aa is None:
             return 0
         else:
-            return max(aa)
+            return aa
+
+    def addresses(self):
+        ''' Get sorted list of the addresses of HEX content. '''
+        return self._buf.keys()
+
+    def segments(self, start=None, end=None):
+        ''' Get the ranges of contiguous addresses of HEX content.
+        @param  start   if not None, only the ranges ending at or after start.
+        @param  end     if not None, only the ranges beginning at or before end.
+        @return         sorted list of (start, stop) pairs,
+                        stop being one past the last address.
+        '''
+        return [(ofs, ofs + len(run))
+                for ofs, run in self._buf.segments(start, end)]
 
     def __getitem__(self, addr):
         ''' Get byte from address.
@@ -296,7 +716,68 @@ class IntelHex:
     def __setitem__(self, addr, byte):
         self._buf[addr] = byte
 
-    def writefile(self, f, write_start_addr=True):
+    def putmap(self, addr, m, base=0, length=None):
+        ''' Put bytes of a memory map at given address, without copying
+        them. Changes to those bytes are made in the map, so map files with
+        ACCESS_COPY to keep them unchanged. The map is closed by close().
+        @param  addr    address of the first byte.
+        @param  m       memory map (mmap object).
+        @param  base    offset of the first byte in m.
+        @param  length  number of bytes, up to the end of m if None.
+        '''
+        self._buf.map(addr, m, base, length)
+
+    def close(self):
+        ''' Close the memory maps of the content (see putmap and loadfile
+        of binary files). The bytes that were in them are no longer there.
+        '''
+        self._buf.close()
+
+    def puts(self, addr, s):
+        ''' Put string of bytes at given address.
+        @param  addr    address of the first byte.
+        @param  s       string of bytes.
+        '''
+        self._buf.write(addr, bytearray(s))
+
+    def tofile(self, fobj, format='hex', byte_count=16):
+        ''' Write data to file.
+        @param  fobj        file name or file object.
+        @param  format      'hex' for HEX file, 'bin' for raw binary file.
+        @param  byte_count  data bytes in each record of HEX file.
+        @return True    if successful.
+        '''
+        if format == 'hex':
+            return self.writefile(fobj, byte_count=byte_count)
+        elif format == 'bin':
+            self.tobinfile(fobj)
+            return True
+        else:
+            raise ValueError('Unknown file format: %r' % format)
+
+    def dump(self):
+        ''' Get a hex dump of the content: 16 bytes per line, '--' where
+        there is no data. Lines without data are left out.
+        @return         string with the dump.
+        '''
+        lines = []
+        row = None
+        for start, run in self._buf.segments():
+            for addr in xrange(start & ~15, start + len(run), 16):
+                if addr == row:
+                    continue
+                row = addr
+                cells = []
+                for i in xrange(addr, addr + 16):
+                    byte = self._buf.get(i)
+                    if byte is None:
+                        cells.append('--')
+                    else:
+                        cells.append('%02X' % byte)
+                lines.append('%08X  %s' % (addr, ' '.join(cells)))
+        return '\n'.join(lines)
+
+    def writefile(self, f, write_start_addr=True, byte_count=16):
         """Write data to file f in HEX format.
 
         @param  f                   filename or file-like object for writing
@@ -304,9 +785,14 @@ class IntelHex:
                                     record to file (enabled by default).
                                     If there is no start address nothing
                                     will be written.
+        @param  byte_count          maximum number of data bytes in each
+                                    record, 1 to 255 (16 by default).
 
         @return True    if successful.
         """
+        if not 1 <= byte_count <= 255:
+            raise ValueError('byte_count should be between 1 and 255')
+
         fwrite = getattr(f, "write", None)
         if fwrite:
             fobj = f
@@ -357,86 +843,37 @@ class IntelHex:
                               % self.start_addr)
                 return False
 
-        # data
-        minaddr = IntelHex.minaddr(self)
-        maxaddr = IntelHex.maxaddr(self)
-        if maxaddr > 65535:
-            offset = (minaddr/65536)*65536
-        else:
-            offset = None
-
-        while True:
-            if offset != None:
-                # emit 32-bit offset record
-                high_ofs = offset / 65536
-                offset_record = ":02000004%04X" % high_ofs
-                bytes = divmod(high_ofs, 256)
-                csum = 2 + 4 + bytes[0] + bytes[1]
-                csum = (-csum) & 0x0FF
-                offset_record += "%02X\n" % csum 
-
-                ofs = offset
-                if (ofs + 65536) > maxaddr:
-                    rng = xrange(maxaddr - ofs + 1)
-                else:
-                    rng = xrange(65536)
-            else:
-                ofs = 0
-                offset_record = ''
-                rng = xrange(maxaddr + 1)
-
-            csum = 0
-            k = 0
-            record = ""
-            for addr in rng:
-                byte = self._buf.get(ofs+addr, None)
-                if byte != None:
-                    if k == 0:
-                        # optionally offset record
-                        fobj.write(offset_record)
-                        offset_record = ''
-                        # start data record
-                        record += "%04X00" % addr
-                        bytes = divmod(addr, 256)
-                        csum = bytes[0] + bytes[1]
-
-                    k += 1
-                    # continue data in record
-                    record += "%02X" % byte
-                    csum += byte
-
-                    # check for length of record
-                    if k < 16:
-                        continue
-
-                if k != 0:
-                    # close record
-                    csum += k
-                    csum = (-csum) & 0x0FF
-                    record += "%02X" % csum
-                    fobj.write(":%02X%s\n" % (k, record))
-                    # cleanup
-                    csum = 0
-                    k = 0
-                    record = ""
-            else:
-                if k != 0:
-                    # close record
-                    csum += k
-                    csum = (-csum) & 0x0FF
-                    record += "%02X" % csum
-                    fobj.write(":%02X%s\n" % (k, record))
-
-            # advance offset
-            if offset is None:
-                break
-
-            offset += 65536
-            if offset > maxaddr:
-                break
+        # data: only the runs with data are walked. Records do not cross
+        # gaps or 64K boundaries. If there is data over 64K, a 32-bit offset
+        # record is emitted before the first record of each 64K window.
+        extended = IntelHex.maxaddr(self) > 65535
+        window = None
+        lines = []
+        for start, run in self._buf.segments():
+            pos = 0
+            while pos < len(run):
+                addr = start + pos
+                if extended and (addr >> 16) != window:
+                    window = addr >> 16
+                    bytes = divmod(window, 256)
+                    csum = (-(2 + 4 + bytes[0] + bytes[1])) & 0x0FF
+                    lines.append(":02000004%04X%02X\n" % (window, csum))
+                # bytes up to the end of the run or the 64K window
+                stop = min(len(run), pos + 65536 - (addr & 0x0FFFF))
+                while pos < stop:
+                    k = min(byte_count, stop - pos)
+                    data = run[pos:pos+k]
+                    addr16 = (start + pos) & 0x0FFFF
+                    csum = (-(k + (addr16 >> 8) + (addr16 & 0x0FF) + sum(data))) & 0x0FF
+                    lines.append(":%02X%04X00%s%02X\n" % (k, addr16, hexlify(data).upper(), csum))
+                    pos += k
+                if len(lines) >= 4096:
+                    fwrite(''.join(lines))
+                    lines = []
 
         # end-of-file record
-        fobj.write(":00000001FF\n")
+        lines.append(":00000001FF\n")
+        fwrite(''.join(lines))
         if fclose:
             fclose()
 
@@ -501,19 +938,11 @@ class IntelHex16bit(IntelHex):
 
     def minaddr(self):
         '''Get minimal address of HEX content in 16-bit mode.'''
-        aa = self._buf.keys()
-        if aa == []:
-            return 0
-        else:
-            return min(aa)/2
+        return IntelHex.minaddr(self)/2
 
     def maxaddr(self):
         '''Get maximal address of HEX content in 16-bit mode.'''
-        aa = self._buf.keys()
-        if aa == []:
-            return 0
-        else:
-            return max(aa)/2
+        return IntelHex.maxaddr(self)/2
 
 #/class IntelHex16bit
 
@@ -2,6 +2,16 @@
 
 import intelhex
 import sys
+import random
+import StringIO
+import tempfile
+import os
+errores = []
+
+def error(mensaje):
+	print "error en " + mensaje
+	errores.append(mensaje)
+
 class extractor24bits:
 
 	def __init__(self, hex):
@@ -78,42 +88,197 @@ def swapHex(hex):
 
 
 def test1():
-	mihex=intelhex.IntelHex()
-#	mihex.loadhex('C:/Documents and Settings/Usuario/Escritorio/testpic/1.hex')
-	mihex.loadhex('C:/Documents and Settings/Usuario/Escritorio/test.hex')
-	mihex16=intelhex.IntelHex16bit(mihex)
-	dirs= mihex.addresses()
-	max=25
-	i=0
-	for dir in dirs:
-		print hex(dir), hex(mihex[dir])
-		i = i+1
-		if i > max:
-			break
-		#print ""
+	#swapHex invierte el orden de los bytes de cada palabra y el extractor lee y escribe palabras de 24 bits.
+	#La imagen se carga de un fichero HEX en memoria
+	original = intelhex.IntelHex()
+	original.puts(0, "".join([chr(i) for i in range(48)]))
+	original.puts(0x100, "\x10\x20\x30\x00" * 4)
+	fichero = StringIO.StringIO()
+	original.writefile(fichero)
+	mihex = intelhex.IntelHex()
+	mihex.loadfile(StringIO.StringIO(fichero.getvalue()), "hex")
+	if [mihex[dir] for dir in mihex.addresses()] != [original[dir] for dir in original.addresses()]:
+		error("test 1: lectura del fichero")
 	fixed = swapHex(mihex)
-	#print fixed.dump()
 
 	ex=extractor24bits(fixed)
-	print ex.extrae_direcciones()
-	
-	print ex.make_slices()
-
-	print hex(ex[8])
+	if ex.extrae_direcciones() != range(12) + range(0x40, 0x44):
+		error("test 1: direcciones " + str(ex.extrae_direcciones()))
+	if ex.make_slices() != [(0, 11), (0x40, 0x43)]:
+		error("test 1: rangos " + str(ex.make_slices()))
+	if ex[8] != 0x222120 or ex[0x41] != 0x302010:
+		error("test 1: lectura de palabras %#x %#x" % (ex[8], ex[0x41]))
 	ex[8] = 0xabcdef
-	print hex(ex[8])
-
-	print fixed.dump()
+	if ex[8] != 0xabcdef:
+		error("test 1: escritura de una palabra %#x" % ex[8])
 
 	unfixed = swapHex(fixed)
-	print unfixed.dump()
+	for (dir, byte) in ((32, 0xef), (33, 0xcd), (34, 0xab), (35, 0)):
+		original[dir] = byte
+	if [unfixed[dir] for dir in unfixed.addresses()] != [original[dir] for dir in original.addresses()]:
+		error("test 1: imagen deshecha")
+
+
+def escrituraAntigua(ih, byte_count=16):
+	#el escritor de registros de antes de SegmentedBuffer, recorriendo las direcciones una a una.
+	#Solo se recorren las ventanas de 64K con datos: las demas no escribian nada
+	buf = ih._buf
+	maxaddr = ih.maxaddr()
+	res = []
+	if maxaddr > 65535:
+		ventanas = sorted(set([dir >> 16 for dir in ih.addresses()]))
+	else:
+		ventanas = [None]
+	for ventana in ventanas:
+		if ventana is not None:
+			ofs = ventana << 16
+			bytes = divmod(ventana, 256)
+			offset_record = ":02000004%04X%02X\n" % (ventana, (-(2 + 4 + bytes[0] + bytes[1])) & 0x0FF)
+			rng = xrange(min(65536, maxaddr - ofs + 1))
+		else:
+			ofs = 0
+			offset_record = ''
+			rng = xrange(maxaddr + 1)
+		k = 0
+		record = ""
+		for addr in rng:
+			byte = buf.get(ofs + addr, None)
+			if byte != None:
+				if k == 0:
+					res.append(offset_record)
+					offset_record = ''
+					record = "%04X00" % addr
+					csum = (addr >> 8) + (addr & 0xff)
+				k += 1
+				record += "%02X" % byte
+				csum += byte
+				if k < byte_count:
+					continue
+			if k != 0:
+				res.append(":%02X%s%02X\n" % (k, record, (-(csum + k)) & 0x0FF))
+				k = 0
+		if k != 0:
+			res.append(":%02X%s%02X\n" % (k, record, (-(csum + k)) & 0x0FF))
+	res.append(":00000001FF\n")
+	return "".join(res)
+
+def imagenDispersa(semilla):
+	#imagen de un PIC24: programa, programming executive en 0x800000 y configuracion en 0xF80000
+	#(direcciones de programa, en bytes el doble), con huecos y tramos que cruzan ventanas de 64K
+	aleatorio = random.Random(semilla)
+	ih = intelhex.IntelHex()
+	tramos = [(0, 0x300), (0x0FFF0, 0x40), (0x1FFFE, 5), (0x800000 << 1, 0x100), (0xF80000 << 1, 24)]
+	for i in range(8):
+		tramos.append((aleatorio.randrange(0, 0x30000), aleatorio.randrange(1, 300)))
+	for (inicio, n) in tramos:
+		for dir in range(inicio, inicio + n):
+			if aleatorio.random() < 0.9:
+				ih[dir] = aleatorio.randrange(256)
+	return ih
+
+def test2():
+	#el escritor por tramos escribe lo mismo que el antiguo, y se vuelve a leer igual
+	for semilla in range(6):
+		ih = imagenDispersa(semilla)
+		for byte_count in (16, 1, 7, 32, 255):
+			nuevo = StringIO.StringIO()
+			ih.writefile(nuevo, byte_count=byte_count)
+			if nuevo.getvalue() != escrituraAntigua(ih, byte_count):
+				error("test 2: imagen %d, byte_count %d" % (semilla, byte_count))
+				continue
+			leido = intelhex.IntelHex()
+			leido.loadfile(StringIO.StringIO(nuevo.getvalue()), "hex")
+			if leido.segments() != ih.segments() or [leido[dir] for dir in leido.addresses()] != [ih[dir] for dir in ih.addresses()]:
+				error("test 2: relectura de la imagen %d, byte_count %d" % (semilla, byte_count))
+
+	#imagen por debajo de 64K, sin registros de direccion extendida
+	ih = intelhex.IntelHex()
+	ih.puts(0x100, "abcdefghijklmnopqrstuvwxyz")
+	ih[0xfff0] = 1
+	nuevo = StringIO.StringIO()
+	ih.writefile(nuevo)
+	if nuevo.getvalue() != escrituraAntigua(ih) or ":02000004" in nuevo.getvalue():
+		error("test 2: imagen de 64K")
+
+def test3():
+	#SegmentedBuffer une y separa los tramos como un diccionario de direcciones
+	buf = intelhex.SegmentedBuffer()
+	buf[10] = 1
+	buf[12] = 2
+	if [(ofs, list(run)) for (ofs, run) in buf.segments()] != [(10, [1]), (12, [2])]:
+		error("test 3: tramos separados")
+	buf[11] = 3
+	if [(ofs, list(run)) for (ofs, run) in buf.segments()] != [(10, [1, 3, 2])]:
+		error("test 3: union de tramos")
+	buf[9] = 4
+	buf[13] = 5
+	buf.write(20, [6, 7])
+	buf.write(30, [8])
+	buf.write(14, [9] * 6)
+	if [(ofs, list(run)) for (ofs, run) in buf.segments()] != [(9, [4, 1, 3, 2, 5, 9, 9, 9, 9, 9, 9, 6, 7]), (30, [8])]:
+		error("test 3: write sobre varios tramos")
+	if len(buf) != 14 or buf.minaddr() != 9 or buf.maxaddr() != 30 or buf.segments(22, 29) != []:
+		error("test 3: cuentas y limites")
+
+	#escrituras aleatorias comparadas con un diccionario
+	aleatorio = random.Random(1)
+	buf = intelhex.SegmentedBuffer()
+	modelo = {}
+	for i in range(5000):
+		dir = aleatorio.randrange(0, 2000)
+		if aleatorio.random() < 0.8:
+			buf[dir] = modelo[dir] = aleatorio.randrange(256)
+		else:
+			datos = [aleatorio.randrange(256) for j in range(aleatorio.randrange(1, 40))]
+			buf.write(dir, datos)
+			for j in range(len(datos)):
+				modelo[dir + j] = datos[j]
+	if buf.keys() != sorted(modelo) or [buf[dir] for dir in buf.keys()] != [modelo[dir] for dir in sorted(modelo)]:
+		error("test 3: escrituras aleatorias")
+	if len(buf) != len(modelo) or buf.minaddr() != min(modelo) or buf.maxaddr() != max(modelo):
+		error("test 3: cuentas de las escrituras aleatorias")
+	for ((ofs, run), (ofs2, run2)) in zip(buf.segments()[:-1], buf.segments()[1:]):
+		if ofs + len(run) >= ofs2:
+			error("test 3: tramos que se tocan sin unir %d %d" % (ofs, ofs2))
+			break
+	if buf.get(5000) is not None or 5000 in buf:
+		error("test 3: direccion sin datos")
 
-	unfixed.tofile('C:/Documents and Settings/Usuario/Escritorio/test2.hex', "hex")
+def test4():
+	#tobinarray sobre tramos en memoria y mapeados, y close libera los mapas
+	(fd, fichero) = tempfile.mkstemp(".bin")
+	os.write(fd, "".join([chr(i * 3 & 0xff) for i in range(1000)]))
+	os.close(fd)
+	descriptores = len(os.listdir("/proc/self/fd"))
+	ih = intelhex.IntelHex()
+	ih.loadfile(fichero, "bin")
+	ih.puts(2000, "abcdef")
+	ih[999] = 7
+	for (inicio, fin) in ((0, 1999), (500, 2010), (995, 1005), (1990, 2003), (None, None)):
+		(desde, hasta) = (inicio or 0, fin or ih.maxaddr())
+		esperado = [ih[dir] for dir in range(desde, hasta + 1)]
+		if list(ih.tobinarray(inicio, fin)) != esperado:
+			error("test 4: tobinarray de %s a %s" % (inicio, fin))
+	if len(os.listdir("/proc/self/fd")) != descriptores + 1:
+		error("test 4: fichero mapeado")
+	ih.close()
+	if len(os.listdir("/proc/self/fd")) != descriptores:
+		error("test 4: mapa sin cerrar")
+	if ih.segments() != [(2000, 2006)] or len(ih._buf) != 6:
+		error("test 4: datos tras close " + str(ih.segments()))
+	os.remove(fichero)
 
 
 def main():
 
 	test1()
+	test2()
+	test3()
+	test4()
+	if errores:
+		print str(len(errores)) + " errores"
+		sys.exit(1)
+	print "OK"
 
 if __name__ == "__main__":
     main()
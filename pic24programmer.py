@@ -9,13 +9,22 @@ __version__ = "1.0"
 
 
 import BitBang
+import BitBangEmulator
 import CommandProgrammer
 import ChipIdentifier
+import SerialProgrammer
+import BitBangTrace
 
 import getopt, sys
+import multiprocessing
+import threading, Queue
+import StringIO
+import binascii
+import bisect
+from array import array
 
 import intelhex
-import sys
+import ImageCache
 
 
 
@@ -23,69 +32,277 @@ import sys
 class extractor24bits:
 	"""
 	Getter and setter for reading a intel hex file containing a 16-bit PIC microcontroller program
+	The words are decoded from the image when they are accessed, so the bytes of a mapped image
+	are not copied: slices of the extractor are arrays of 32-bit words.
 	"""
 
+	# filas decodificadas de una vez al buscar las filas con datos
+	ventana = 1024
+
 	def __init__(self, hex):
 		"""Makes an instance for the specified hex object
 		Parameters:
 		hex --  a intelhex.IntelHex() object"""
 		self.mihex=hex
+		# rangos y filas ya calculados, o None
+		self.slices=None
+		self.rows=None
+		self.rowSize=64
+
+	def close(self):
+		""" Releases the memory maps the image is read from, see intelhex.IntelHex.close"""
+		self.mihex.close()
+
+	def _rangos(self):
+		#rangos de palabras (inicio, fin) con datos, juntando los que se tocan
+		rangos = []
+		for (inicio, fin) in self.mihex.segments():
+			(inicio, fin) = (inicio >> 2, (fin + 3) >> 2)
+			if rangos and inicio <= rangos[-1][1]:
+				rangos[-1][1] = max(rangos[-1][1], fin)
+			else:
+				rangos.append([inicio, fin])
+		return rangos
+
+	def _palabras(self, primero, ultimo):
+		#palabras de primero a ultimo (sin incluir), leidas solo de los tramos que tocan
+		res = array("I")
+		datos = self.mihex.tobinstr(primero << 2, (ultimo << 2) - 1, self.mihex.padding)
+		if len(datos) != (ultimo - primero) << 2:
+			#imagen vacia
+			datos = chr(self.mihex.padding) * ((ultimo - primero) << 2)
+		res.fromstring(datos)
+		if sys.byteorder == "big":
+			res.byteswap()
+		return res
 
 	def extrae_direcciones(self):
 		""" Returns the addresses used in the hex object"""
-		dirs = self.mihex.addresses()
 		res=[]
-		for dir in dirs:
-			if (dir & 0x3) == 3:
-				res.append(dir >> 2)
+		for (inicio, fin) in self.mihex.segments():
+			#palabras cuyo cuarto byte esta en el rango
+			res.extend(range(inicio >> 2, fin >> 2))
 		return res
 
 	def make_slices(self):
 		""" Returns the addresses used in the hex object as a list of pairs (begin, end)"""
-		dirs = self.extrae_direcciones()
+		if self.slices is not None:
+			return list(self.slices)
 		res = []
-		inicial =0
-		final = 0
-		anterior = -1
-		for dir in dirs:
-			if dir == anterior + 1:
-				final = dir
+		for (inicio, fin) in self.mihex.segments():
+			#palabras cuyo cuarto byte esta en el rango
+			(inicio, fin) = (inicio >> 2, fin >> 2)
+			if inicio >= fin:
+				continue
+			if res and res[-1][1] == inicio - 1:
+				res[-1] = (res[-1][0], fin - 1)
 			else:
-				res.append((inicial, final))
-				inicial = final = dir
-
-			anterior = dir
-
-		res.append((inicial, final))
+				res.append((inicio, fin - 1))
 
-		if res[0] == (0,0):
+		if res and res[0] == (0,0):
 			res.remove((0,0))
 
+		self.slices = list(res)
+		return res
+
+	def filas(self, tam=64, inicio=None, fin=None):
+		""" Returns the indexes of the first word of the rows of tam words that are not blank
+		Parameters:
+		tam -- words per row
+		inicio, fin -- if given, only the rows from index inicio up to fin (not included) are returned
+		"""
+		if self.rows is None or self.rowSize != tam:
+			self.rows = self._indexar(tam)
+			self.rowSize = tam
+		if inicio is None and fin is None:
+			return list(self.rows)
+		desde = 0
+		hasta = len(self.rows)
+		if inicio is not None:
+			desde = bisect.bisect_left(self.rows, inicio)
+		if fin is not None:
+			hasta = bisect.bisect_left(self.rows, fin)
+		return self.rows[desde:hasta]
+
+	def _indexar(self, tam):
+		#una pasada por los tramos de la imagen, una ventana de filas a la vez: los huecos entre tramos
+		#no se recorren y los bytes se comparan sin decodificar las palabras
+		res = []
+		bytesFila = tam << 2
+		blanco = chr(self.mihex.padding) * bytesFila
+		for (inicio, fin) in self._rangos():
+			desde = (inicio / tam) * tam
+			if res and res[-1] >= desde:
+				desde = res[-1] + tam
+			fin = ((fin + tam - 1) / tam) * tam
+			for ventana in range(desde, fin, self.ventana * tam):
+				hasta = min(ventana + self.ventana * tam, fin)
+				datos = self.mihex.tobinstr(ventana << 2, (hasta << 2) - 1, self.mihex.padding)
+				for k in range(0, len(datos), bytesFila):
+					if datos[k:k + bytesFila] != blanco:
+						res.append(ventana + (k >> 2))
 		return res
 
 	def __getitem__(self, addr):
 		if isinstance(addr, slice):
-			res = []
 			primero = addr.start or 0
 			ultimo = addr.stop or 0
 			incremento = addr.step or 1
-			for i in range(primero, ultimo, incremento):
-				res.append(self[i])
-			return res
+			if incremento != 1:
+				return array("I", [self[i] for i in range(primero, ultimo, incremento)])
+			if ultimo <= primero:
+				return array("I")
+			return self._palabras(primero, ultimo)
 		dir = addr << 2
-		val = self.mihex[dir + 0]
+		val = self.mihex[dir]
 		val |= self.mihex[dir + 1] << 8
 		val |= self.mihex[dir + 2] << 16
 		val |= self.mihex[dir + 3] << 24
 		return val
 
 	def __setitem__(self, addr, bits):
+		self.slices = None
+		self.rows = None
 		dir = addr << 2
 		self.mihex[dir + 0]= bits & 0xff
 		self.mihex[dir + 1]= (bits & 0xff00) >> 8
 		self.mihex[dir + 2]= (bits & 0xff0000) >> 16
 		self.mihex[dir + 3] = 0x00
 
+class EscritorHex(threading.Thread):
+	"""
+	Writes blocks of instruction words to an Intel HEX file from a background thread.
+	Each word takes 4 bytes, like in extractor24bits. The blocks must be put in increasing
+	address order. The records are the ones intelhex.IntelHex.writefile writes for the same
+	words: up to 16 bytes each, with an extended linear address record before the first
+	record of each 64 KB segment.
+	"""
+
+	def __init__(self, f, capacidad=16):
+		"""Parameters:
+		f -- file name or file object
+		capacidad -- blocks that can be waiting to be written
+		"""
+		threading.Thread.__init__(self)
+		self.daemon = True
+		self.f = f
+		self.cola = Queue.Queue(capacidad)
+		self.error = None
+
+	def put(self, indice, palabras, omitir=0xffffff):
+		"""Queues a block of words to be written.
+		Parameters:
+		indice -- the index of the first word, as in extractor24bits (the address is index << 1)
+		palabras -- the words
+		omitir -- words with this value are not written. None writes every word
+		"""
+		self.cola.put((indice, palabras, omitir))
+
+	def close(self):
+		"""Writes the end of file record and waits for the thread to finish.
+		Raises the error of the thread, if any
+		"""
+		self.cola.put(None)
+		self.join()
+		if self.error is not None:
+			raise self.error
+
+	def run(self):
+		try:
+			if hasattr(self.f, "write"):
+				self._escribir(self.f)
+			else:
+				fichero = file(self.f, "w")
+				try:
+					self._escribir(fichero)
+				finally:
+					fichero.close()
+		except Exception, e:
+			self.error = e
+			#vaciamos la cola para no bloquear al que la llena
+			while self.cola.get() is not None:
+				pass
+
+	def _escribir(self, fichero):
+		segmento = None
+		inicio = 0
+		fin = 0
+		registro = bytearray()
+		while True:
+			bloque = self.cola.get()
+			if bloque is None:
+				break
+			(indice, palabras, omitir) = bloque
+			lineas = []
+			dir = indice << 2
+			for palabra in palabras:
+				if palabra != omitir:
+					if registro and (dir != fin or len(registro) == 16 or (dir >> 16) != segmento):
+						lineas.append(_registroHex(inicio, registro))
+						registro = bytearray()
+					if (dir >> 16) != segmento:
+						segmento = dir >> 16
+						suma = (-(2 + 4 + (segmento >> 8) + (segmento & 0xff))) & 0xff
+						lineas.append(":02000004%04X%02X\n" % (segmento, suma))
+					if not registro:
+						inicio = dir
+					registro.extend((palabra & 0xff, (palabra >> 8) & 0xff, (palabra >> 16) & 0xff, 0))
+					fin = dir + 4
+				dir += 4
+			fichero.write("".join(lineas))
+		if registro:
+			fichero.write(_registroHex(inicio, registro))
+		fichero.write(":00000001FF\n")
+
+def _registroHex(dir, datos):
+	"""Returns the Intel HEX data record of the bytes datos at address dir"""
+	dir = dir & 0xffff
+	suma = (-(len(datos) + (dir >> 8) + (dir & 0xff) + sum(datos))) & 0xff
+	return ":%02X%04X00%s%02X\n" % (len(datos), dir, binascii.hexlify(datos).upper(), suma)
+
+def cargarImagen(fichero, cache=None):
+	""" Reads a program from an Intel HEX file, or from a raw binary file if its name ends in ".bin".
+	A binary file has the layout of extractor24bits from address 0, and it is memory mapped instead of read.
+	Parameters:
+	fichero -- the file name
+	cache -- an ImageCache.ImageCache. If the file is in the cache it is not parsed again,
+	    otherwise it is parsed and stored in the cache. None does not use any cache
+	Returns an instance of extractor24bits containing the program
+	"""
+	if fichero.lower().endswith(".bin"):
+		contenido=intelhex.IntelHex()
+		contenido.loadfile(fichero, "bin")
+		return extractor24bits(contenido)
+
+	if cache is None:
+		contenido=intelhex.IntelHex()
+		contenido.loadfile(fichero, "hex")
+		return extractor24bits(contenido)
+
+	f = open(fichero, "rb")
+	texto = f.read()
+	f.close()
+	#un fallo de la cache no debe impedir programar: se lee el fichero sin ella
+	try:
+		imagen = cache.load(texto)
+	except (IOError, OSError):
+		imagen = None
+	if imagen is not None:
+		(contenido, slices, filas) = imagen
+		extractor = extractor24bits(contenido)
+		extractor.slices = slices
+		extractor.rows = filas
+		return extractor
+
+	contenido=intelhex.IntelHex()
+	contenido.loadfile(StringIO.StringIO(texto), "hex")
+	extractor = extractor24bits(contenido)
+	try:
+		cache.store(texto, contenido, extractor.make_slices(), extractor.filas())
+	except (IOError, OSError):
+		pass
+	return extractor
+
 class fixRegisters:
 	"""
 	Fixes invalid values in the configuration registers
@@ -100,19 +317,67 @@ class fixRegisters:
 			self.fixPIC24HJ12GP201(extractor)
 
 
-def createProgrammer(name):
+def createProgrammer(name, enhanced=False, puerto=0, traza=None):
 	""" Returns a CommandProgrammer.Programmer object using the specified hardware.
 	Supported hardware:
 	"CheapParport" -- Basic programmer using parallel port
-	
+	"Emulator" -- Software emulated PIC24HJ12GP201 with Programming Executive, no hardware needed
+	"Serial" -- Programmer adapter on a serial port, that clocks the ICSP lines itself (see SerialProgrammer)
+	"SerialEmulator" -- The emulated chip behind a stand-in serial adapter on a pseudo-terminal
+	If enhanced is True, the programmer uses the Programming Executive when the chip has one.
+	puerto is the parallel port used by "CheapParport", as a number or a device name,
+	or the serial port used by "Serial", as a number n for /dev/ttyUSBn or a device name.
+	If traza is given, the pin states sent to the port are recorded in that file, marking the operations
+	of the programmer (see BitBangTrace). The recorder is left in the trace member of the programmer.
+	Not available with "Serial", whose adapter drives the pins.
+	With "SerialEmulator" the stand-in adapter is left in the adapter member of the programmer.
 	"""
-	if name == "CheapParport":
-		bb = BitBang.BitBangCheapParport() 
-		cp = CommandProgrammer.CommandProgrammer()
+	if name in ("CheapParport", "Emulator"):
+		if name == "CheapParport":
+			bb = BitBang.BitBangCheapParport(puerto)
+		else:
+			bb = BitBangEmulator.BitBangEmulator(executive=True)
+		if traza is not None:
+			bb = BitBangTrace.BitBangRecorder(bb, traza)
+		if enhanced:
+			cp = CommandProgrammer.EnhancedCommandProgrammer()
+			res = CommandProgrammer.EnhancedProgrammer()
+		else:
+			cp = CommandProgrammer.CommandProgrammer()
+			res = CommandProgrammer.Programmer()
 		cp.setBigBangProgrammer(bb)
+		cp.setBuffered(True, False)
 
-		res = CommandProgrammer.Programmer()
 		res.setCommandProgrammer(cp)
+		if traza is not None:
+			res.trace = bb
+			BitBangTrace.markOperations(res, bb)
+
+		return res
+	elif name in ("Serial", "SerialEmulator"):
+		if name == "Serial":
+			if isinstance(puerto, int):
+				puerto = "/dev/ttyUSB%d" % puerto
+			link = SerialProgrammer.openSerial(puerto)
+		else:
+			bb = BitBangEmulator.BitBangEmulator(executive=True)
+			if traza is not None:
+				bb = BitBangTrace.BitBangRecorder(bb, traza)
+			(dispositivo, adaptador) = SerialProgrammer.openEmulatedAdapter(bb)
+			link = SerialProgrammer.openSerial(dispositivo)
+		if enhanced:
+			cp = SerialProgrammer.SerialEnhancedCommandProgrammer(link)
+			res = CommandProgrammer.EnhancedProgrammer()
+		else:
+			cp = SerialProgrammer.SerialCommandProgrammer(link)
+			res = CommandProgrammer.Programmer()
+
+		res.setCommandProgrammer(cp)
+		if name == "SerialEmulator":
+			res.adapter = adaptador
+			if traza is not None:
+				res.trace = bb
+				BitBangTrace.markOperations(res, bb)
 
 		return res
 	else:
@@ -149,47 +414,84 @@ def leer(programador, callback=progresoLectura):
 	-- executive: the programming executive
 	-- regs: the configuration registers
 	"""	
-	programador.begin()
-	devid=programador.readDevId()
-	chip=ChipIdentifier.ChipIdentifier()
-	chip.setDevId(devid)
-	flash = chip.flash
-	#Leemos el flash
 	data_ret=[]
-
-	
-	callback("FLASH", 0)
-	for i in range(0, flash, 64):
-		res=programador.readMem(i << 1)
-		data_ret.extend(res)
-
-		porcentaje = float(i) / float(flash) * 100
-		porcentaje = porcentaje * 0.5
-		callback("FLASH", porcentaje)
-
-
-	#leemos el programming executive
 	prog_executive=[]
-	len_pe=chip.programmingExecutive
-	callback("Programming Executive", 50)
-	for i in range(0, len_pe, 64):
-		res=programador.readMem((i << 1) + 0x800000)
-		prog_executive.extend(res)
-
-		porcentaje = float(i) / float(len_pe) * 100.0
-		porcentaje = porcentaje * 0.45 + 50
-		callback("Programming Executive", porcentaje)
-		
-		#print "Leyendo programming executive: " + str(i) + " de " + str(len_pe)
+	regs=[]
+	for (indice, palabras) in leerBloques(programador, callback):
+		if indice < (0x800000 >> 1):
+			data_ret.extend(palabras)
+		elif indice < (0xf80000 >> 1):
+			prog_executive.extend(palabras)
+		else:
+			regs = palabras
 
-	programador.end()
+	return data_ret, prog_executive, regs
+
+def leerBloques(programador, callback=progresoLectura):
+	""" Reads the memory of a MCU a block at a time, see leer.
+	Parameters:
+	programador -- the programmer
+	callback -- a function for showing the progress of the reading
+	Yields a pair (index, words) as soon as each block is read: first the program memory,
+	then the programming executive and last the configuration registers.
+	The index is the one used by extractor24bits (the address is index << 1).
+	"""
 	programador.begin()
-	callback("Configuration", 95)
-	regs=programador.readConfigMem()
-	#callback("Configuration", 100)
-	programador.end()
+	try:
+		devid=programador.readDevId()
+		chip=ChipIdentifier.ChipIdentifier()
+		chip.setDevId(devid)
+		flash = chip.flash
+		#Leemos el flash
+		callback("FLASH", 0)
+		for (dir, res) in programador.readBlocks(0, flash):
+			i = dir >> 1
+			porcentaje = float(i) / float(flash) * 100
+			porcentaje = porcentaje * 0.5
+			callback("FLASH", porcentaje)
+			yield (i, res)
+
+		#leemos el programming executive
+		len_pe=chip.programmingExecutive
+		callback("Programming Executive", 50)
+		for (dir, res) in programador.readBlocks(0x800000, len_pe):
+			i = (dir - 0x800000) >> 1
+			porcentaje = float(i) / float(len_pe) * 100.0
+			porcentaje = porcentaje * 0.45 + 50
+			callback("Programming Executive", porcentaje)
+			yield (dir >> 1, res)
 
-	return data_ret, prog_executive, regs
+	finally:
+		programador.end()
+	programador.begin()
+	try:
+		callback("Configuration", 95)
+		regs=programador.readConfigMem()
+	finally:
+		programador.end()
+	yield (0xf80000 >> 1, regs)
+
+def leerHex(programador, f, callback=progresoLectura):
+	""" Reads the memory of a MCU into an Intel HEX file.
+	Each block is encoded by an EscritorHex thread while the next one is being read, so the memory
+	used does not depend on the size of the MCU. The file is the same one that leer and
+	extractor24bits would give: the blank words of the program memory and the programming
+	executive are left out.
+	Parameters:
+	programador -- the programmer
+	f -- file name or file object
+	callback -- a function for showing the progress of the reading
+	"""
+	escritor = EscritorHex(f)
+	escritor.start()
+	try:
+		for (indice, palabras) in leerBloques(programador, callback):
+			if indice < (0xf80000 >> 1):
+				escritor.put(indice, palabras)
+			else:
+				escritor.put(indice, palabras, None)
+	finally:
+		escritor.close()
 
 def progresoEscritura(region, porcentaje):
 	""" Basic callback for "escribir" function.
@@ -198,13 +500,48 @@ def progresoEscritura(region, porcentaje):
 	print "Escribiendo " + region + ": " + str(int(porcentaje)) + "% completo"
 
 
-def escribir(programador, extractor, callback=progresoEscritura):
+def planificarBorrado(programador, extractor, flash):
+	""" Chooses how to erase the flash before writing a program: a bulk erase, or erasing
+	only the pages the program uses, whatever takes less time.
+	Parameters:
+	programador -- the programmer
+	extractor -- an instance of extractor24bits containing the program
+	flash -- flash memory size, in instruction words
+	Returns a pair (mode, pages):
+	-- mode: "bulk" or "pages"
+	-- pages: list of the pages to erase, as extractor indexes (the address is index << 1)
+	"""
+	pagina = programador.pageSize
+	paginas = []
+	for fila in extractor.filas(programador.rowSize, 0, flash):
+		i = fila - fila % pagina
+		if not paginas or paginas[-1] != i:
+			paginas.append(i)
+
+	espera = programador.waiter.initialWait
+	if len(paginas) * espera(CommandProgrammer.CompletionWaiter.PAGE) < espera(CommandProgrammer.CompletionWaiter.BULK):
+		return ("pages", paginas)
+	return ("bulk", paginas)
+
+def escribir(programador, extractor, callback=progresoEscritura, borrado=None):
 	""" Writes the memory of a MCU using the specified programmer and calling the specified function for showing progress.
 	Parameters:
 	programador -- the programmer
 	extractor -- an instance of extractor24bits containing the program
 	callback -- a function for showing the progress of the writing
+	borrado -- how to erase the flash before writing:
+	    None -- no erase
+	    "bulk" -- erases the whole chip
+	    "pages" -- erases only the pages used by the program, the rest of the flash is left in place
+	    "auto" -- erases the whole chip or the pages used, whatever is faster (see planificarBorrado)
+	Raises IOError if the MCU rejects a write or an erase. The transaction is ended anyway.
 	"""	
+	CommandProgrammer.runSteps(escribirPasos(programador, extractor, callback, borrado))
+
+def escribirPasos(programador, extractor, callback=progresoEscritura, borrado=None):
+	""" Generator version of escribir, yielding the seconds to wait for each write and erase
+	(see CommandProgrammer.Scheduler)
+	"""
 	#escribe los datos del extractor24bits en el programador especificado
 
 	programador.begin()
@@ -217,63 +554,380 @@ def escribir(programador, extractor, callback=progresoEscritura):
 	max_addr_flash = chip.flash
 	max_addr_pe = chip.programmingExecutive
 
-	def vacio(area):
-		for i in area:
-			if i != 0xffffffff:
-				return False
-		return True
-
 	#escribir flash
 	callback("FLASH", 0)
 	programador.begin()
-	memoria1 = extractor[0:0+64]
+	try:
+		if borrado is not None:
+			modo, paginas = planificarBorrado(programador, extractor, max_addr_flash)
+			if borrado != "auto":
+				modo = borrado
+			if modo == "bulk":
+				for espera in programador.eraseChipSteps():
+					yield espera
+			else:
+				for i in paginas:
+					for espera in programador.erasePagesSteps(i << 1):
+						yield espera
+		memoria1 = extractor[0:0+64]
 	
-	for i in range(0, max_addr_flash, 64):
-		memoria = extractor[i:i+64]
-		if not vacio(memoria):
-			programador.writeMem(i << 1, memoria)
+		#solo se recorren las filas con datos
+		for i in extractor.filas(programador.rowSize, 0, max_addr_flash):
+			memoria = extractor[i:i+64]
+			for espera in programador.writeMemSteps(i << 1, memoria):
+				yield espera
 
 			porcentaje = float(i) / float(max_addr_flash) * 100.0
 			porcentaje = porcentaje * 0.5
 			callback("FLASH", porcentaje)
 
 
-	#escribir programming executive
-	callback("Programming Executive", 50)
-	for i in range(0x800000, 0x800000 + max_addr_pe, 64):
-		memoria = extractor[i:i+64]
-		if not vacio(memoria):
-			programador.writeMem(i << 1, memoria)
+		#escribir programming executive
+		callback("Programming Executive", 50)
+		for i in extractor.filas(programador.rowSize, 0x800000, 0x800000 + max_addr_pe):
+			memoria = extractor[i:i+64]
+			for espera in programador.writeMemSteps(i << 1, memoria):
+				yield espera
 
 			porcentaje = float(i - 0x800000) / float(max_addr_pe - 0x800000) * 100.0
 			porcentaje = porcentaje * 0.45 + 50
 			callback("Programming Executive", porcentaje)
 
 
-	#escribir registros de configuracion
-	fix=fixRegisters()
-	fix.fix(chip.descId, extractor)
-	callback("Configuration", 95)
-	dir = 0xf80000 >> 1
-	memoria = extractor[dir:dir + 12]
-	print hex(dir)
-	print "Rangos"
-	for (i,j) in extractor.make_slices():
-		print hex(i), hex(j)
-	print "Registros"
-	for i in memoria:
-		print hex(i)
-	programador.writeConfigMem(memoria)
-	programador.end()
+		#escribir registros de configuracion
+		fix=fixRegisters()
+		fix.fix(chip.descId, extractor)
+		callback("Configuration", 95)
+		dir = 0xf80000 >> 1
+		memoria = extractor[dir:dir + 12]
+		print hex(dir)
+		print "Rangos"
+		for (i,j) in extractor.make_slices():
+			print hex(i), hex(j)
+		print "Registros"
+		for i in memoria:
+			print "%#x" % i
+		for espera in programador.writeConfigMemSteps(memoria):
+			yield espera
+	finally:
+		programador.end()
+
+def progresoVerificacion(region, porcentaje):
+	""" Basic callback for "verificar" function.
+	Prints a string showing the progress.
+	"""	
+	print "Verificando " + region + ": " + str(int(porcentaje)) + "% completo"
+
+
+def _comparar(programador, inicio, esperado):
+	""" Reads back the instruction words from index inicio and returns the differences with esperado
+	as a list of (index, expected, read)"""
+	errores = []
+	for i in range(0, len(esperado), 64):
+		n = min(64, len(esperado) - i)
+		leido = programador.readMem((inicio + i) << 1, (n + 3) & ~3)
+		for j in range(n):
+			if leido[j] != esperado[i + j]:
+				errores.append((inicio + i + j, esperado[i + j], leido[j]))
+	return errores
+
+def verificar(programador, extractor, callback=progresoVerificacion, bloque=512):
+	""" Verifies the memory of a MCU against a program.
+	The CRC of each block is computed by the MCU and compared with the CRC of the program,
+	and only the blocks that differ are read back. If the programmer cannot compute CRCs
+	(no Programming Executive), every block is read back.
+	Parameters:
+	programador -- the programmer
+	extractor -- an instance of extractor24bits containing the program
+	callback -- a function for showing the progress of the verification
+	bloque -- number of instruction words of each CRC block
+	Returns a list of (index, expected, read) items, one for each instruction word that differs.
+	The index is the one used by extractor (the address is index << 1).
+	"""
+	errores = []
+	CommandProgrammer.runSteps(verificarPasos(programador, extractor, callback, bloque, errores))
+	return errores
+
+def verificarPasos(programador, extractor, callback=progresoVerificacion, bloque=512, errores=None):
+	""" Generator version of verificar, appending the differences found to the list errores.
+	There is nothing to wait for, it yields 0 after each block to let other tasks run
+	(see CommandProgrammer.Scheduler)
+	"""
+	if errores is None:
+		errores = []
+	programador.begin()
+	try:
+		devid=programador.readDevId()
+		chip=ChipIdentifier.ChipIdentifier()
+		chip.setDevId(devid)
+
+		regiones = [("FLASH", 0, chip.flash, 0, 50), ("Programming Executive", 0x800000 >> 1, chip.programmingExecutive, 50, 45)]
+		blancos = {}
+		for (region, inicio, longitud, base, peso) in regiones:
+			callback(region, base)
+			for i in range(inicio, inicio + longitud, bloque):
+				n = min(bloque, inicio + longitud - i)
+				#los bloques sin datos se comparan con la memoria borrada, sin leer la imagen
+				if extractor.filas(programador.rowSize, i, i + n):
+					esperado = [palabra & 0xffffff for palabra in extractor[i:i + n]]
+					crcEsperado = CommandProgrammer.crc16(esperado)
+				else:
+					if n not in blancos:
+						blancos[n] = ([0xffffff] * n, CommandProgrammer.crc16([0xffffff] * n))
+					(esperado, crcEsperado) = blancos[n]
+				crc = programador.crc(i << 1, n)
+				if crc is None or crc != crcEsperado:
+					errores.extend(_comparar(programador, i, esperado))
+
+				porcentaje = float(i - inicio + n) / float(longitud) * peso + base
+				callback(region, porcentaje)
+				yield 0
+
+		#los registros de configuracion son de 8 bits
+		callback("Configuration", 95)
+		fix=fixRegisters()
+		fix.fix(chip.descId, extractor)
+		dir = 0xf80000 >> 1
+		esperado = extractor[dir:dir + 12]
+		leido = programador.readConfigMem()
+		for i in range(12):
+			if (esperado[i] & 0xff) != (leido[i] & 0xff):
+				errores.append((dir + i, esperado[i] & 0xff, leido[i] & 0xff))
+	finally:
+		programador.end()
+
+def escribirIncremental(programador, extractor, callback=progresoEscritura):
+	""" Updates the memory of a MCU, rewriting only the flash pages that differ from the program.
+	Each page is compared with the MCU by CRC, or reading it back if the programmer cannot compute
+	CRCs. The pages that differ are erased and programmed again, the rest are left in place.
+	The configuration registers are only written if they differ. The programming executive is not touched.
+	Parameters:
+	programador -- the programmer
+	extractor -- an instance of extractor24bits containing the program
+	callback -- a function for showing the progress of the writing
+	Returns the list of the pages rewritten, as extractor indexes (the address is index << 1)
+	Raises IOError if the MCU rejects a write or an erase. The transaction is ended anyway.
+	"""
+	paginas = []
+	CommandProgrammer.runSteps(escribirIncrementalPasos(programador, extractor, callback, paginas))
+	return paginas
+
+def escribirIncrementalPasos(programador, extractor, callback=progresoEscritura, paginas=None):
+	""" Generator version of escribirIncremental, appending the pages rewritten to the list paginas.
+	It yields the seconds to wait for each write and erase (see CommandProgrammer.Scheduler)
+	"""
+	if paginas is None:
+		paginas = []
+	programador.begin()
+	try:
+		devid=programador.readDevId()
+		chip=ChipIdentifier.ChipIdentifier()
+		chip.setDevId(devid)
+		print chip.fullDesc()
+
+		flash = chip.flash
+		pagina = programador.pageSize
+		fila = programador.rowSize
+
+		callback("FLASH", 0)
+		for i in range(0, flash, pagina):
+			n = min(pagina, flash - i)
+			esperado = [palabra & 0xffffff for palabra in extractor[i:i + n]]
+			crc = programador.crc(i << 1, n)
+			if crc is None:
+				distinta = len(_comparar(programador, i, esperado)) > 0
+			else:
+				distinta = crc != CommandProgrammer.crc16(esperado)
+
+			if distinta:
+				for espera in programador.erasePagesSteps(i << 1):
+					yield espera
+				for j in range(0, n, fila):
+					memoria = esperado[j:j + fila]
+					if memoria.count(0xffffff) != len(memoria):
+						for espera in programador.writeMemSteps((i + j) << 1, memoria):
+							yield espera
+				paginas.append(i)
+
+				porcentaje = float(i + n) / float(flash) * 95.0
+				callback("FLASH", porcentaje)
+
+		#escribir registros de configuracion, si han cambiado
+		fix=fixRegisters()
+		fix.fix(chip.descId, extractor)
+		callback("Configuration", 95)
+		dir = 0xf80000 >> 1
+		memoria = extractor[dir:dir + 12]
+		leido = programador.readConfigMem()
+		for i in range(12):
+			if (memoria[i] & 0xff) != (leido[i] & 0xff):
+				for espera in programador.writeConfigMemSteps(memoria):
+					yield espera
+				break
+	finally:
+		programador.end()
 
 def borrar(programador):
 	""" Writes the MCU using the specified programmer.
 	programador -- the programmer
+	Raises IOError if the MCU rejects the erase. The transaction is ended anyway.
 	"""	
 	#Borra el microcontrolador
+	CommandProgrammer.runSteps(borrarPasos(programador))
+
+def borrarPasos(programador):
+	""" Generator version of borrar, yielding the seconds to wait for the erase (see CommandProgrammer.Scheduler)"""
 	programador.begin()
-	programador.eraseChip()
-	programador.end()
+	try:
+		for espera in programador.eraseChipSteps():
+			yield espera
+	finally:
+		programador.end()
+
+
+
+# imagen del programa en los procesos de un grupo de programadores
+_imagen = None
+
+def _iniciarGrupo(extractor):
+	""" Initializes a worker process of programarGrupo. The image is handed over once per process,
+	when the process is started, instead of once per task.
+	"""
+	global _imagen
+	_imagen = extractor
+
+def _silencio(region, porcentaje):
+	pass
+
+def _programarPuerto(argumentos):
+	""" Runs a command on one programmer of a gang. It runs in a worker process of programarGrupo.
+	Parameters:
+	argumentos -- a tuple (name, puerto, comando, enhanced, borrado), see programarGrupo
+	Returns a tuple (puerto, ok, resultado)
+	"""
+	(name, puerto, comando, enhanced, borrado) = argumentos
+	try:
+		prg = createProgrammer(name, enhanced, puerto)
+		with CommandProgrammer.Session(prg):
+			if comando == "identify":
+				resultado = identificar(prg)
+				ok = True
+			elif comando == "write":
+				escribir(prg, _imagen, _silencio, borrado)
+				resultado = None
+				ok = True
+			elif comando == "update":
+				resultado = escribirIncremental(prg, _imagen, _silencio)
+				ok = True
+			elif comando == "verify":
+				resultado = verificar(prg, _imagen, _silencio)
+				ok = len(resultado) == 0
+			elif comando == "erase":
+				borrar(prg)
+				resultado = None
+				ok = True
+			else:
+				raise ValueError("unknown command: " + comando)
+		prg.startPic()
+		return (puerto, ok, resultado)
+	except Exception, e:
+		return (puerto, False, e)
+
+def progresoGrupo(puerto, ok, resultado):
+	""" Basic callback for "programarGrupo" function.
+	Prints the status of a finished target.
+	"""
+	if ok:
+		print "Port " + str(puerto) + ": OK"
+	else:
+		print "Port " + str(puerto) + ": FAILED " + str(resultado)
+
+def programarGrupo(name, puertos, comando, extractor=None, enhanced=False, borrado=None, callback=progresoGrupo):
+	""" Runs a command on several programmers at the same time, one worker process per programmer.
+	A target that fails does not stop the others.
+	Parameters:
+	name -- the kind of programmer, see createProgrammer
+	puertos -- list of ports, one per programmer
+	comando -- "identify", "write", "update", "verify" or "erase"
+	extractor -- an instance of extractor24bits containing the program, for "write", "update" and "verify".
+	    It is parsed once and shared by all the workers
+	enhanced -- if True, the programmers use the Programming Executive
+	borrado -- erase mode for "write", see escribir
+	callback -- a function called with (puerto, ok, resultado) as each target finishes
+	Returns a dictionary {puerto: (ok, resultado)}, where resultado is the result of
+	identificar, escribirIncremental or verificar, or the exception raised by a failed target
+	"""
+	grupo = multiprocessing.Pool(len(puertos), _iniciarGrupo, (extractor,))
+	res = {}
+	try:
+		tareas = [(name, puerto, comando, enhanced, borrado) for puerto in puertos]
+		for (puerto, ok, resultado) in grupo.imap_unordered(_programarPuerto, tareas):
+			res[puerto] = (ok, resultado)
+			callback(puerto, ok, resultado)
+	finally:
+		grupo.close()
+		grupo.join()
+	return res
+
+def _tareaIntercalada(programador, comando, extractor, borrado, resultado):
+	""" Task of programarIntercalado running a command on one programmer.
+	It stores (ok, resultado) in the list resultado.
+	"""
+	sesion = CommandProgrammer.Session(programador)
+	sesion.open()
+	try:
+		if comando == "identify":
+			resultado.extend([True, identificar(programador)])
+		elif comando == "write":
+			for espera in escribirPasos(programador, extractor, _silencio, borrado):
+				yield espera
+			resultado.extend([True, None])
+		elif comando == "update":
+			paginas = []
+			for espera in escribirIncrementalPasos(programador, extractor, _silencio, paginas):
+				yield espera
+			resultado.extend([True, paginas])
+		elif comando == "verify":
+			errores = []
+			for espera in verificarPasos(programador, extractor, _silencio, 512, errores):
+				yield espera
+			resultado.extend([len(errores) == 0, errores])
+		elif comando == "erase":
+			for espera in borrarPasos(programador):
+				yield espera
+			resultado.extend([True, None])
+		else:
+			raise ValueError("unknown command: " + comando)
+	finally:
+		sesion.close()
+	programador.startPic()
+
+def programarIntercalado(name, puertos, comando, extractor=None, enhanced=False, borrado=None, callback=progresoGrupo):
+	""" Runs a command on several programmers from this thread, see programarGrupo.
+	While a MCU is busy in a NVM write or erase, the thread is used by the other programmers
+	(see CommandProgrammer.Scheduler), so the waits of all the targets overlap.
+	The parameters and the result are the same as in programarGrupo.
+	"""
+	planificador = CommandProgrammer.Scheduler()
+	resultados = {}
+	for puerto in puertos:
+		resultados[puerto] = []
+		try:
+			prg = createProgrammer(name, enhanced, puerto)
+		except Exception, e:
+			planificador.results[puerto] = e
+			continue
+		planificador.add(_tareaIntercalada(prg, comando, extractor, borrado, resultados[puerto]), puerto)
+	fallos = planificador.run()
+
+	res = {}
+	for puerto in puertos:
+		if fallos.get(puerto) is not None:
+			res[puerto] = (False, fallos[puerto])
+		else:
+			res[puerto] = tuple(resultados[puerto])
+		callback(puerto, res[puerto][0], res[puerto][1])
+	return res
 
 
 
@@ -288,23 +942,40 @@ Available commands:
 	identify: Identifies the chip
 	read: reads the chip
 	write: programs the chip
+	update: reprograms only the flash pages that differ from the file
 	erase: erases the chip
+	verify: compares the chip with the program memory file
 	h, -h, help, --help: shows this help
 
 Available options:
 	--write-file=<file>: Saves the read memory to the specified file in intel hex format.
-	--read-file=<file>: Reads the program memory from the specified file in intel hex format.
+	--read-file=<file>: Reads the program memory from the specified file in intel hex format,
+	                    or in raw binary format if the name ends in .bin
 	--programmer=<programmer>: Uses the specified programmer
+	--enhanced: Uses the Programming Executive (Enhanced ICSP) if the chip has one
+	--erase=<mode>: Erases the chip before writing. Modes: bulk, pages (only the pages used), auto
+	--ports=<list>: Runs the command on several programmers at once, one per port of the comma-separated list.
+	                Available for identify, write, update, verify and erase
+	--cache=<dir>: Keeps the programs read with --read-file already parsed in this directory,
+	               for example ~/.pic24programmer/cache. By default they are parsed every time
+	--no-cache: Parses the --read-file program every time, even with --cache
+	--interleave: With --ports, drives all the programmers from a single thread, using the time a MCU
+	              is busy writing or erasing to work on the others, instead of a process per programmer
+	--trace=<file>: Records the pin states sent to the MCU in a trace file, marking each operation.
+	                Not available with --ports or the Serial programmer. See BitBangTrace.py for a summary
 
 Available programmers:
 	CheapParport: basic parallel port programmer
+	Emulator: software emulated PIC24HJ12GP201 with Programming Executive, for testing without hardware
+	Serial: programmer adapter on a serial port, /dev/ttyUSB0 or the ports given with --ports
+	SerialEmulator: the emulated chip behind a stand-in serial adapter, for testing without hardware
 
 """
 
 def main():
 	"""Main function"""
 	try:
-		opts, args = getopt.getopt(sys.argv[1:], "h", ["help", "write-file=", "read-file=", "programmer="])
+		opts, args = getopt.getopt(sys.argv[1:], "h", ["help", "write-file=", "read-file=", "programmer=", "enhanced", "erase=", "ports=", "interleave", "cache=", "no-cache", "trace="])
 	except getopt.GetoptError, err:
 		# print help information and exit:
 		print str(err) # will print something like "option -a not recognized"
@@ -322,6 +993,13 @@ def main():
 	programador=""
 	write_file=""
 	read_file=""
+	enhanced=False
+	borrado=None
+	puertos=[]
+	intercalado=False
+	traza=None
+	cache_dir=None
+	sin_cache=False
 
 	for o, a in opts:
 		if o == "-v":
@@ -335,6 +1013,27 @@ def main():
 			read_file = a
 		elif o == ("--programmer"):
 			programador=a
+		elif o == ("--enhanced"):
+			enhanced=True
+		elif o == ("--erase"):
+			if a not in ("bulk", "pages", "auto"):
+				usage()
+				print "Error: unknown erase mode: " + a
+				sys.exit(2)
+			borrado=a
+		elif o == ("--cache"):
+			cache_dir=a
+		elif o == ("--no-cache"):
+			sin_cache=True
+		elif o == ("--interleave"):
+			intercalado=True
+		elif o == ("--trace"):
+			traza=a
+		elif o == ("--ports"):
+			for puerto in a.split(","):
+				if puerto.isdigit():
+					puerto = int(puerto)
+				puertos.append(puerto)
 		else:
 			usage()
 			print "Error: unknown option: " + o
@@ -345,13 +1044,56 @@ def main():
 		usage()
 		print "Error: No programmer specified"
 		sys.exit(2)
-	elif programador == ("CheapParport"):
-		prg = createProgrammer(programador)
-	else:
+	elif programador not in ("CheapParport", "Emulator", "Serial", "SerialEmulator"):
 		usage()
 		print "Error: unknown programmer: " + programador
 		sys.exit(2)
 
+	cache=None
+	if cache_dir is not None and not sin_cache:
+		#la clave cambia con el codigo que decodifica el fichero y construye la imagen
+		cache=ImageCache.ImageCache(cache_dir, ImageCache.sourceVersion([intelhex, ImageCache, sys.modules[__name__]]))
+
+	if traza is not None and (puertos or programador == "Serial"):
+		usage()
+		print "Error: --trace is not available with --ports or the Serial programmer"
+		sys.exit(2)
+
+	if puertos:
+		if comando not in ("identify", "write", "update", "verify", "erase"):
+			usage()
+			print "Error: command not available with --ports: " + comando
+			sys.exit(2)
+		extractor = None
+		if comando in ("write", "update", "verify"):
+			if read_file == "":
+				usage()
+				print "Error: read file not specified (--read-file parameter)"
+				sys.exit(2)
+			extractor=cargarImagen(read_file, cache)
+		if intercalado:
+			resultados = programarIntercalado(programador, puertos, comando, extractor, enhanced, borrado)
+		else:
+			resultados = programarGrupo(programador, puertos, comando, extractor, enhanced, borrado)
+		if extractor is not None:
+			extractor.close()
+		fallos = [puerto for puerto in puertos if not resultados[puerto][0]]
+		if comando == "identify":
+			for puerto in puertos:
+				if resultados[puerto][0]:
+					print str(puerto) + ": " + resultados[puerto][1][1]
+		print str(len(puertos) - len(fallos)) + " of " + str(len(puertos)) + " targets OK"
+		if fallos:
+			sys.exit(1)
+		sys.exit()
+
+	prg = createProgrammer(programador, enhanced, traza=traza)
+	extractor = None
+
+	sesion = CommandProgrammer.Session(prg)
+	if comando in ("identify", "read", "write", "verify", "update", "erase"):
+		sesion.open()
+
 	if comando == ("identify"):
 		devid, info=identificar(prg)
 		for i in devid:
@@ -359,6 +1101,10 @@ def main():
 		print ""
 		print info
 
+	elif comando == ("read") and write_file != "":
+		print "Reading..."
+		leerHex(prg, write_file)
+
 	elif comando == ("read"):
 		print "Reading..."
 		memoria_usuario, programming_executive, registros_configuracion = leer(prg)
@@ -373,54 +1119,74 @@ def main():
 
 		print dir
 
-		if write_file == "":
-			print "FLASH:"
-			print contenido.dump()
-
-			dir = 0
-			p_e = intelhex.IntelHex()
-			extractor2=extractor24bits(p_e)
-			for i in programming_executive:
-				if i != 0xffffff:
-					extractor2[dir + (0x800000 >> 1)] = i
-				dir = dir + 1
-
-			print "Programming executive:"
-			print p_e.dump()
-
-			print "Configuration registers:"
-			for i in range(0, 3):
-				for j in range(0,4):
-					print hex( registros_configuracion[i+j] ),
-				print ""
-		else:
-			dir = 0
-			for i in programming_executive:
-				if i != 0xffffff:
-					extractor[dir + (0x800000 >> 1)] = i
-				dir = dir + 1
-
-			dir = 0
-			for i in registros_configuracion:
-				extractor[(0xf80000 >> 1) + dir] = i
-				dir = dir + 1
-			contenido.tofile(write_file, "hex")
+		print "FLASH:"
+		print contenido.dump()
+
+		dir = 0
+		p_e = intelhex.IntelHex()
+		extractor2=extractor24bits(p_e)
+		for i in programming_executive:
+			if i != 0xffffff:
+				extractor2[dir + (0x800000 >> 1)] = i
+			dir = dir + 1
+
+		print "Programming executive:"
+		print p_e.dump()
+
+		print "Configuration registers:"
+		for i in range(0, 3):
+			for j in range(0,4):
+				print hex( registros_configuracion[i+j] ),
+			print ""
 	elif comando == ("write"):
 		if read_file == "":
 			usage()
 			print "Error: read file not specified (--read-file parameter)"
 			sys.exit(2)
 		else:
-			contenido=intelhex.IntelHex()
-			contenido.loadfile(read_file, "hex")
-			extractor=extractor24bits(contenido)
-			escribir(prg, extractor)
+			extractor=cargarImagen(read_file, cache)
+			try:
+				escribir(prg, extractor, borrado=borrado)
+			except IOError, e:
+				print "Write failed: " + str(e)
+				sys.exit(1)
+
+	elif comando == ("update"):
+		if read_file == "":
+			usage()
+			print "Error: read file not specified (--read-file parameter)"
+			sys.exit(2)
+		extractor=cargarImagen(read_file, cache)
+		try:
+			paginas = escribirIncremental(prg, extractor)
+		except IOError, e:
+			print "Update failed: " + str(e)
+			sys.exit(1)
+		print str(len(paginas)) + " pages rewritten"
 			#for i in range(0,0x84, 4):
 			#	print hex(i), hex(extractor[i]), hex(extractor[i+1]), hex(extractor[i+2]), hex(extractor[i+3])
 
+	elif comando == ("verify"):
+		if read_file == "":
+			usage()
+			print "Error: read file not specified (--read-file parameter)"
+			sys.exit(2)
+		extractor=cargarImagen(read_file, cache)
+		errores = verificar(prg, extractor)
+		for (dir, esperado, leido) in errores:
+			print "%#x %#x %#x" % (dir << 1, esperado, leido)
+		if errores:
+			print "Verification failed: " + str(len(errores)) + " differences"
+		else:
+			print "Verification OK"
+
 	elif comando == ("erase"):
 		print "Erasing..."
-		borrar(prg)
+		try:
+			borrar(prg)
+		except IOError, e:
+			print "Erase failed: " + str(e)
+			sys.exit(1)
 
 	elif comando in ("h","help"):
 		usage()
@@ -430,7 +1196,12 @@ def main():
 		print "Error: unknown command: " + comando
 		sys.exit(2)
 
+	sesion.close()
 	prg.startPic()
+	if extractor is not None:
+		extractor.close()
+	if traza is not None:
+		prg.trace.close()
 
 
 if __name__ == "__main__":